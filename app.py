@@ -37,14 +37,18 @@ import base64
 import io
 import random
 import string
+import time
+import re
 import sys
 import subprocess
+import runpy
 import logging
 import plotly.express as px
 
 logging.basicConfig(level=logging.DEBUG)
 
 from typing import List, Tuple, Any
+from functools import partial
 from io import StringIO
 from dash import dcc
 from dash import html
@@ -56,8 +60,23 @@ from demos import dash_reusable_components as drc
 from layout_content import layout_index, layout_page1
 from dash.dependencies import Input, Output, State
 from datetime import datetime
-from functions.deseq2 import calculate_size_factors, estimate_dispersion, fit_glm_nb
-from functions.edgeR import calc_norm_factors, estimate_common_dispersion, estimate_tagwise_dispersion, glm_lrt
+from functions.deseq2 import run_deseq2
+from functions.edgeR import run_edger
+from functions.limma import run_limma
+from functions.diagnostics import mds_coordinates, dispersion_plot_data
+from functions.design import design_variables, factor_levels, pairwise_contrasts, parse_contrasts, contrast_label
+from functions.data_store import new_session_id, save_frame, load_frame, put_artifact, get_artifact
+from functions.data_import import read_counts_upload, read_table_upload
+from functions.precision import compact_counts, to_float
+from functions.validation import summarize_schema, reconcile_samples
+from functions.r_worker import run_rscript
+from functions.interchange import matrix_path, write_matrix, read_matrix, contrast_path
+from functions.normalization import NATIVE_TRANSFORMATIONS, GROUPED_TRANSFORMATIONS, transform, transform_all
+from functions.rlog import rlog, cached_fit as cached_rlog_fit
+from functions.session_catalog import get_catalog, counts_hash, session_key, frames_hash, de_key, labels_hash
+from functions.artifact_store import maybe_evict
+from functions.safe_io import append_csv_rows, atomic_path, atomic_write, create_csv, locked_atomic_write
+from functions.batch_correction import split_confounders, remove_batch_effect
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 os.chdir(current_dir)
@@ -82,7 +101,7 @@ suppress_callback_exceptions is set to True for handling exceptions in callbacks
 url_bar_and_content_div = html.Div([
     dcc.Location(id='url', refresh=False),
 
-    # Data shared between pages
+    # Data shared between pages, df_counts and df_info only hold handles to the server-side data store
     dcc.Store(id='df_counts'),  # , storage_type='session'),
     dcc.Store(id='df_info'),  # storage_type='session'),
     dcc.Store(id='variable_selection1_store'),
@@ -140,6 +159,33 @@ def generate_random_string(length=7):
     return random_string
 
 
+class SessionExpired(PreventUpdate):
+    """
+    An upload or a table of a run is gone, e.g. evicted after its session expired. Callbacks
+    stop like on PreventUpdate, table_update shows the message in alert_main_table.
+    """
+
+
+def load_session_frame(handle):
+    """
+    Load an uploaded table from its dcc.Store handle, raises SessionExpired when it is gone.
+    """
+    df = load_frame(handle)
+    if df is None:
+        raise SessionExpired('The uploaded data has expired, upload the count and info tables again.')
+    return df
+
+
+def load_artifact(artifact_id):
+    """
+    Load a table of a run from its artifact id, raises SessionExpired when it is gone.
+    """
+    df = get_artifact(artifact_id)
+    if df is None:
+        raise SessionExpired('The data of this run has expired, press submit again.')
+    return df
+
+
 def write_dataset(lSamples, lExclude, id_name=None):
 
     """
@@ -170,15 +216,8 @@ def write_dataset(lSamples, lExclude, id_name=None):
         'ID Name': [id_name]
     })
 
-    # If the file exists, read the existing data and append the new data
-    if os.path.isfile(dataset_file_path):
-        df_existing = pd.read_csv(dataset_file_path)
-        df = pd.concat([df_existing, df_new], ignore_index=True)
-    else:
-        df = df_new
-
-    # Write the DataFrame to a CSV file
-    df.to_csv(dataset_file_path, index=False)
+    # Appended under a lock, concurrent saves from several workers can not lose rows
+    append_csv_rows(dataset_file_path, df_new)
 
 def load_dataset(dataset_name):
     dataset_file_path = os.path.join('data', 'datasets', 'datasets.csv')
@@ -197,88 +236,71 @@ def load_dataset(dataset_name):
 
     else:
         df = pd.DataFrame(columns=['Sample Names', 'Exclude Names', 'ID Name'])
-        # Write the DataFrame to 'data/datasets/datasets.csv'
-        df.to_csv(dataset_file_path, index=False)
+        # Under the lock of write_dataset's appends, a dataset saved meanwhile is kept
+        create_csv(dataset_file_path, df)
         return None
 
 
-def write_session_to_file(sample_names, rm_confounding, transformation, file_string, id_name=None):
-    '''
-    Writes session information to a file. This is used for tracking various parameters of a user session.
-    
-    Parameters:
-        - sample_names (list): List of sample names.
-        - rm_confounding (bool): Flag for removing confounding variables.
-        - transformation (str): The type of transformation applied.
-        - file_string (str): A string identifier for the file.
-        - id_name (str, optional): An identifier name for the session.
-
-        This function writes the session data to 'data/datasets/session_file.txt'.
-    '''
-
-    session_file_path = os.path.join('data', 'datasets', 'session_file.txt')
-    # Write the sample names to the file
-    # > sample1 sample2 sample3 transformation %id_name %file_string
-    df = pd.DataFrame({
-        'Sample Names': [' '.join(sample_names)],
-        'Transformation': [transformation],
-        'ID Name': [id_name],
-        'rm_confounding': [rm_confounding],
-        'file_string': [file_string]
-    })
-
-    if os.path.isfile(session_file_path):
-        df_existing = pd.read_csv(session_file_path, encoding='utf-8')
-        df = pd.concat([df_existing[df.columns.tolist()], df], ignore_index=True)
-        df.to_csv(session_file_path, index=False, encoding='utf-8')
-    else:
-        df.to_csv(session_file_path, index=False, encoding='utf-8')
-
-def search_session(sample_string, transformation, rm_confounding):
+def transformation_name(transformation, groups=None):
+    """
+    Name of a transformation in session keys and output files. Grouped transformations also
+    depend on the sample groups, their name carries a hash of the group labels.
     """
-    Searches for a session in the session file that matches given parameters.
+    if transformation in GROUPED_TRANSFORMATIONS and groups is not None:
+        return f'{transformation}_{labels_hash(groups)[:12]}'
+    return transformation
 
-    Parameters:
-    - sample_string (list): List of sample names.
-    - transformation (str): The type of transformation applied.
-    - rm_confounding (bool): Flag for removing confounding variables.
 
-    Returns:
-    - list or None: Returns a list of file strings if a matching session is found, otherwise None.
+def meta_unchanged(path, text):
+    """
+    True if the file at path already holds text, so it does not need to be written again.
     """
+    if not os.path.isfile(path) or os.path.getsize(path) != len(text.encode('utf-8')):
+        return False
+    with open(path, encoding='utf-8') as f:
+        return f.read() == text
 
-    session_file_path = os.path.join('data', 'datasets', 'session_file.txt')
-    outdir = os.path.join('data', 'datasets')
 
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
+def run_transformation(df_counts_raw, transformation, name_counts, name_meta, name_out, rlog_fit_path, groups=None):
+    """
+    Writes one transformation of the selected counts to name_out.
 
-    if not os.path.isfile(session_file_path):
-        df = pd.DataFrame(columns=['Sample Names', 'ID Name', 'Transformation', 'rm_confounding', 'file_string'])
-        df.to_csv(session_file_path, index=False)
-
-    df = pd.read_csv(session_file_path)
-
-    matching_rows = df[
-        (df['Sample Names'] == ' '.join(sample_string)) &
-        (df['rm_confounding'] == rm_confounding) &
-        (df['Transformation'] == transformation)
-        ]
-
-    df['rm_confounding'] = df['rm_confounding'].fillna('0')
-    rm_confounding = '0' if rm_confounding == 'None' else rm_confounding
-    condition_1 = df['Sample Names'] == ' '.join(sample_string)
-    condition_2 = df['rm_confounding'] == rm_confounding
-    df['rm_confounding'] = df['rm_confounding'].astype(type(rm_confounding))
-    condition_2 = df['rm_confounding'] == rm_confounding
-    condition_3 = df['Transformation'].str.lower() == transformation.lower()
-
-    matching_rows = df[condition_1 & condition_2 & condition_3]
-    if not matching_rows.empty:
-        file_string_return = matching_rows['file_string'].tolist()[0]
-        return file_string_return
-    
-    return None
+    Parameters:
+    - df_counts_raw (pd.DataFrame): Raw counts of the selected samples.
+    - transformation (str): Value from the transformation dropdown, or 'all' to precompute
+      every transformation next to name_out (<prefix>_normalized_<transformation_name>).
+    - name_counts (str): Counts file passed to data_transformation.R.
+    - name_meta (str): Sample information file passed to data_transformation.R.
+    - name_out (str): Output file.
+    - rlog_fit_path (str): Cache file for the rlog dispersion fit.
+    - groups (array-like, optional): Group of every sample, used by the smooth quantile normalization.
+    """
+    r_script_path = os.path.join('functions', 'data_transformation.R')
+    r_args = [name_counts, name_meta, 'nobatch', name_out, transformation]
+
+    if transformation == 'all':
+        # One NumPy pass and one R job for vsd. R's rlog is slow on many samples, it is only run
+        # when selected (table_update computes a selected transformation that is not precomputed)
+        prefix = name_out[:-len(os.path.splitext(name_out)[1])]
+        for name, df in transform_all(df_counts_raw, cached_rlog_fit(df_counts_raw, rlog_fit_path), groups).items():
+            write_matrix(df, matrix_path(f'{prefix}_{transformation_name(name, groups)}'))
+    elif transformation == 'rlog_native':
+        # The dispersion trend and prior are kept next to the matrices and reused on reruns
+        fit = cached_rlog_fit(df_counts_raw, rlog_fit_path)
+        write_matrix(pd.DataFrame(rlog(df_counts_raw, fit), index=df_counts_raw.index,
+                                  columns=df_counts_raw.columns), name_out)
+        return
+    elif transformation in NATIVE_TRANSFORMATIONS:
+        # Computed in-process with NumPy, no R round trip
+        write_matrix(transform(df_counts_raw, transformation, groups), name_out)
+        return
+
+    print(r_script_path, r_args)
+    try:
+        # Runs in a preloaded R worker, falls back to a plain Rscript call
+        run_rscript(r_script_path, r_args)
+    except subprocess.CalledProcessError as e:
+        print("Error executing command:", e)
 
 
 def file_len(fname):
@@ -300,9 +322,12 @@ class db_res:
             self.updn_dict['dn'] = indict
 
 def serve_layout():
+    # A new id on every page load keeps the uploads of different users apart in the data store
+    session_store = dcc.Store(id='session_id', data=new_session_id())
     if flask.has_request_context():
-        return url_bar_and_content_div
+        return html.Div([session_store, url_bar_and_content_div])
     return html.Div([
+        session_store,
         url_bar_and_content_div,
         layout_index,
         layout_page1,
@@ -331,7 +356,7 @@ def generate_example_data(type):
     dispersion_RV = 0.6  # Dispersion for RV, can be different to simulate biological variability
 
     # Initialize the dataframe to store the expression data
-    expression_data = np.zeros((number_genes, number_samples))
+    expression_data = np.zeros((number_genes, number_samples), dtype=np.int64)
 
     # Generate data for each tissue type
     for i, tissue in enumerate(tissues):
@@ -346,7 +371,6 @@ def generate_example_data(type):
         prob = size / (size + mean_expression)
         expression_data[:, i] = np.random.negative_binomial(size, prob, size=number_genes)
 
-    df_rnaseq = pd.DataFrame(data=expression_data, index=genes, columns=samples)
     # Select 10% of the genes to have even more exaggerated differences
     num_differential_genes = int(0.1 * number_genes)
     differential_gene_indices = np.random.choice(number_genes, num_differential_genes, replace=False)
@@ -356,6 +380,7 @@ def generate_example_data(type):
         expression_data[index, :number_samples//2] = np.random.negative_binomial(mean_expression_LV * 2, prob, size=number_samples//2)  # Double the LV mean for these genes
         expression_data[index, number_samples//2:] = np.random.negative_binomial(mean_expression_RV * 2, prob, size=number_samples//2)  # Double the RV mean for these genes
 
+    df_rnaseq = compact_counts(pd.DataFrame(data=expression_data, index=genes, columns=samples))
 
     # Metadata DataFrame creation
     metadata = {
@@ -378,31 +403,24 @@ def generate_example_data(type):
     Output('alert_import_info', 'value'),
     Output('alert_import_info_div', 'style'),
     Output('page_proceed', 'style'),
-    Input('df_counts', 'data'),
-    Input('df_info', 'data'),
+    Input('counts_columns_store', 'data'),
+    Input('info_index_store', 'data'),
     Input('variable_selection1', 'value'),
     Input('variable_selection2', 'value'),
-    Input('variable_selection3', 'value'))
-def update_alert_import(df_counts, df_info, var1, var2, var3):        
-    if df_counts is not None and df_info is not None and var1 is None and var2 is None and var3 is None:
-        df_counts = pd.read_json(StringIO(df_counts), orient='split')
-        df_info = pd.read_json(StringIO(df_info), orient='split')
-        if list(df_counts.columns) != list(df_info.index):
-            list1 = set(df_counts.columns)
-            list2 = set(df_info.index)
-            diff1 = [item for item in list1 if item not in list2]
-            # Find elements in list2 not in list1
-            diff2 = [item for item in list2 if item not in list1]
-            
-            return 'Columns in Count data does not match Rows in Info data \n' \
-                    'Items in counts columns but not in info index: {} \n' \
-                    'Items in info index but not in counts column: {}'.format(diff1, diff2), {'display': 'inline-block'}, {
-                'display': 'none'}
+    Input('variable_selection3', 'value'),
+    State('df_counts', 'data'))
+def update_alert_import(counts_columns, info_index, var1, var2, var3, df_counts):
+    # Only the id lists and the schema summary in the counts handle are used, never the matrix
+    if counts_columns is not None and info_index is not None and var1 is None and var2 is None and var3 is None:
+        counts_schema = df_counts.get('schema') if df_counts else None
+        problems = reconcile_samples(counts_columns, info_index, counts_schema)
+        if problems:
+            return ' \n'.join(problems), {'display': 'inline-block'}, {'display': 'none'}
         else:
             return 'check', {'display': 'none'}, {'display': 'none'}
 
     #Success, show proceed button
-    if df_counts is not None and df_info is not None and var1 is not None and var2 is not None and var3 is not None:
+    if counts_columns is not None and info_index is not None and var1 is not None and var2 is not None and var3 is not None:
         return 'check', {'display': 'none'}, {'display': 'inline-block', 'margin-right': '1px'}
     else:
         raise PreventUpdate
@@ -441,8 +459,9 @@ def update_checkmark(df_counts):
               Input('upload-data', 'contents'),
               Input('generate-example-data', 'n_clicks'),
               State('upload-data', 'filename'),
-              State('upload-data', 'last_modified'),)
-def update_counts_data(contents, example_data_btn, filename, date):
+              State('upload-data', 'last_modified'),
+              State('session_id', 'data'))
+def update_counts_data(contents, example_data_btn, filename, date, session_id):
 
     if example_data_btn is not None:
         df = generate_example_data('counts')
@@ -453,24 +472,23 @@ def update_counts_data(contents, example_data_btn, filename, date):
         if contents is None:
             raise PreventUpdate
 
-        content_type, content_string = contents.split(',')
-        decoded = base64.b64decode(content_string)
-
-        if filename.endswith('csv'):
-            sep = ','
-        elif filename.endswith('tab'):
-            sep = '\t'
-        elif filename.endswith('tsv'):
-            sep = '\t'
-        else:
-            return pd.DataFrame().to_json(), 'File name extension not recongized, accepted extensions are csv, tab, tsv', \
-                {'display': 'inline-block'}, [], []
+        # Decoded and parsed in chunks, accepts .gz/.bz2 compressed files
+        try:
+            df = read_counts_upload(contents, filename)
+        except ValueError as e:
+            return None, str(e), {'display': 'inline-block'}, [], []
+        # Smallest unsigned integer dtype that fits, counts are cast to float only where the math needs it
+        df = compact_counts(df)
 
-        df = pd.read_csv(io.StringIO(decoded.decode('utf-8')), sep=sep, index_col=0)
         counts_index = list(df.index)
         counts_columns = list(df.columns)
 
-    return df.to_json(date_format='iso', orient='split'), '', {'display': 'none'}, counts_index, counts_columns
+    counts_handle = save_frame(df, 'counts', session_id)
+    counts_handle['schema'] = summarize_schema(df)
+    # Part of the session key, so a new upload never reuses output made from other counts
+    counts_handle['content_hash'] = counts_hash(df)
+
+    return counts_handle, '', {'display': 'none'}, counts_index, counts_columns
 
 
 @app.callback(Output('df_info', 'data'),
@@ -480,26 +498,21 @@ def update_counts_data(contents, example_data_btn, filename, date):
               Input('upload-data-info', 'contents'),
               Input('generate-example-data', 'n_clicks'),
               State('upload-data-info', 'filename'),
-              State('upload-data-info', 'last_modified'))
-def update_info_data(contents, example_data_btn, filename, date):
+              State('upload-data-info', 'last_modified'),
+              State('session_id', 'data'))
+def update_info_data(contents, example_data_btn, filename, date, session_id):
 
     if example_data_btn is not None:
         df = generate_example_data('meta_data')
     else:
         if contents is None:
             raise PreventUpdate
-        content_type, content_string = contents.split(',')
-        decoded = base64.b64decode(content_string)
-
-        if 'csv' in filename:
-            sep = ','
-        elif 'tab' in filename or 'tsv' in filename:
-            sep = '\t'
-        else:
-            return pd.DataFrame().to_json(), [], [], {'display': 'inline-block'}
-        df = pd.read_csv(io.StringIO(decoded.decode('utf-8')), sep=sep, index_col=0)
+        try:
+            df = read_table_upload(contents, filename)
+        except ValueError:
+            return None, [], [], {'display': 'inline-block'}
 
-    return df.to_json(date_format='iso', orient='split'), list(df.columns), list(df.index), {'display': 'none'}
+    return save_frame(df, 'info', session_id), list(df.columns), list(df.index), {'display': 'none'}
 
 @app.callback(Output("content", "children"), [Input("tabs", "active_tab")])
 def switch_tab(at):
@@ -594,7 +607,7 @@ def exclude_helper(exclude, verbose=0):
               Input('df_info', 'data'))
 def select_var1(df_info):
     if df_info is not None:
-        df_info = pd.read_json(StringIO(df_info), orient='split')
+        df_info = load_session_frame(df_info)
         ret = [{'label': j, 'value': j} for j in df_info.columns.to_list()]
         return ret
 
@@ -614,7 +627,7 @@ def select_var1(df_info, variable1_value):
     if variable1_value is None:
         raise PreventUpdate
     else:
-        df_info = pd.read_json(StringIO(df_info), orient='split')
+        df_info = load_session_frame(df_info)
         ret = [{'label': j, 'value': j} for j in df_info[str(variable1_value)].unique()]
         filtered_data = [item for item in ret if item["label"] is not None and item["value"] is not None]
         return filtered_data
@@ -624,7 +637,7 @@ def select_var1(df_info, variable1_value):
               Input('df_info', 'data'))
 def select_var2(df_info):
     if df_info is not None:
-        df_info = pd.read_json(StringIO(df_info), orient='split')
+        df_info = load_session_frame(df_info)
         ret = [{'label': j, 'value': j} for j in df_info.columns.to_list()]
         return ret
 
@@ -643,7 +656,7 @@ def select_var2(df_info, variable2_value):
     if variable2_value is None:
         raise PreventUpdate
     else:
-        df_info = pd.read_json(StringIO(df_info), orient='split')
+        df_info = load_session_frame(df_info)
         ret = [{'label': j, 'value': j} for j in df_info[str(variable2_value)].unique()]
         filtered_data = [item for item in ret if item["label"] is not None and item["value"] is not None]
         return filtered_data
@@ -652,7 +665,7 @@ def select_var2(df_info, variable2_value):
               Input('df_info', 'data'))
 def select_var3(df_info):
     if df_info is not None:
-        df_info = pd.read_json(StringIO(df_info), orient='split')
+        df_info = load_session_frame(df_info)
         ret = [{'label': j, 'value': j} for j in df_info.columns.to_list()]
         return ret
 
@@ -663,7 +676,7 @@ def select_var1(df_info, variable3_value):
     if variable3_value is None:
         raise PreventUpdate
     else:
-        df_info = pd.read_json(StringIO(df_info), orient='split')
+        df_info = load_session_frame(df_info)
         ret = [{'label': j, 'value': j} for j in df_info[str(variable3_value)].unique()]
         filtered_data = [item for item in ret if item["label"] is not None and item["value"] is not None]
         return filtered_data
@@ -715,7 +728,7 @@ def exclude_dropdown(counts_columns, counts_index, info_columns):
               PreventUpdate=True)
 def select_helper(dataset, df_info, variable1, variable2, variable3):
     if dataset != 'New':
-        df_info = pd.read_json(StringIO(df_info), orient='split')
+        df_info = load_session_frame(df_info)
         lSamples, lExclude = load_dataset(dataset)
         lSamples = lSamples.split(' ')
 
@@ -746,7 +759,7 @@ def export_plot(n_clicks, indata, prefixes):
     else:
         if indata:
             datasets = json.loads(indata)
-            df_degenes = pd.read_json(StringIO(datasets['de_table']), orient='split')            
+            df_degenes = load_artifact(datasets['de_table']).copy()
             df_degenes['hgnc'] = [dTranslate.get(x, x) for x in df_degenes.index]
             file_string = datasets['file_string']
 
@@ -754,7 +767,8 @@ def export_plot(n_clicks, indata, prefixes):
             de_file_for_plot = file_string + '_for_DEplot.tab'
             de_file_for_plot_path = os.path.join(outdir, de_file_for_plot)
 
-            df_degenes.to_csv(de_file_for_plot_path, sep='\t')
+            with atomic_path(de_file_for_plot_path) as tmp_path:
+                df_degenes.to_csv(tmp_path, sep='\t')
             volcano_file = file_string + '_volcano.R'
             volcano_file_path = os.path.join('data', 'scripts', volcano_file)
             volcano_template_path = os.path.join('data', 'templates', 'volcano_template.R')
@@ -767,7 +781,7 @@ def export_plot(n_clicks, indata, prefixes):
             filedata = filedata.replace('infile_holder', de_file_for_plot_path)
             
             # Write the file out again
-            with open(volcano_file_path, 'w') as file:
+            with locked_atomic_write(volcano_file_path) as file:
                 file.write(filedata)
             return [f'Created plot file {volcano_file}']
 
@@ -797,9 +811,7 @@ def select_info(lExclude, transformation, variable1_dropdown, variable2_dropdown
     # variable1 = LV RV etc
 
     if all(var is not None for var in [variable1_dropdown, variable2_dropdown, variable3_dropdown, df_info]):
-        df_info = pd.read_json(StringIO(df_info), orient='split')
-
-        transformation = 'None' if transformation == 'Sizefactor normalization' else transformation
+        df_info = load_session_frame(df_info)
 
         df_info_temp = df_info.loc[df_info[variable1].isin(variable1_dropdown), ]
         df_info_temp = df_info_temp.loc[df_info_temp[variable2].isin(variable2_dropdown), ]
@@ -919,7 +931,8 @@ background_pipe = {
 @app.callback(
     [
         Output('intermediate-table', 'children'),
-        Output('alert_main_table', 'is_open'),
+        Output('alert_main_table', 'children'),
+        Output('alert_main_table_div', 'style'),
         #Output('submit-done', 'children'),
         #Output('select_to_explore_block', 'style'),
         #Output('sample_to_pca_block', 'style'),
@@ -930,6 +943,7 @@ background_pipe = {
      State('rm_confounding', 'value'),
      State('full_text', 'value'),
      State('force_run', 'value'),
+     State('precompute_all', 'value'),
      State('df_counts', 'data'),
      State('df_info', 'data'),
      State('variable_selection1_store', 'data'),
@@ -937,15 +951,20 @@ background_pipe = {
      State('variable_selection3_store', 'data')],
     prevent_initial_call=True
 )
-def table_update(n_clicks, selected_data, rm_confounding, fulltext, force_run, df_counts, df_info,
+def table_update(n_clicks, selected_data, rm_confounding, fulltext, force_run, precompute_all, df_counts, df_info,
                       variable_selection1, variable_selection2, variable_selection3):
     if n_clicks == 0:
         raise PreventUpdate
 
     # Perform the long-running task
     if df_counts is not None:
-        df_counts = pd.read_json(StringIO(df_counts), orient='split')
-        df_info = pd.read_json(StringIO(df_info), orient='split')
+        try:
+            counts_handle = df_counts
+            df_counts = load_session_frame(counts_handle)
+            df_info = load_session_frame(df_info)
+        except SessionExpired as e:
+            return dash.no_update, str(e), {'display': 'inline-block'}
+        content_hash = counts_handle.get('content_hash') or counts_hash(df_counts)
         out_folder = os.path.join('data', 'generated')
         if not os.path.isdir(out_folder):
             cmd = f'mkdir {out_folder}'
@@ -965,7 +984,7 @@ def table_update(n_clicks, selected_data, rm_confounding, fulltext, force_run, d
             lSamples = json.loads(datasets['samples'])
 
             if transformation is None:
-                return json.dumps({}), True
+                return json.dumps({}), 'Select transformation', {'display': 'inline-block'}
 
             if len(lSamples) == 0:
                 df_info_temp = df_info.loc[
@@ -987,44 +1006,77 @@ def table_update(n_clicks, selected_data, rm_confounding, fulltext, force_run, d
             else:
                 df_counts_raw = df_counts[df_info_temp.index]
 
-            if rm_confounding is None:
-                rm_confounding = 'None'
+            # The transformed matrix is cached without batch removal, confounders are removed
+            # afterwards in-process so changing them does not rerun the transformation
+            confounders = [rm_confounding] if isinstance(rm_confounding, str) else list(rm_confounding or [])
+
+            # Smooth quantile normalization is done within the groups of the first variable
+            groups = df_info_temp[variable_selection1].to_numpy() if variable_selection1 else None
 
-            file_string = search_session(lSamples, transformation, rm_confounding)
+            # Precomputed sessions hold every transformation side by side and are used whenever they exist
+            catalog = get_catalog()
+            samples = list(df_info_temp.index)
+            session_transformation = 'all'
+            key = session_key(content_hash, samples, 'all')
+            file_string = catalog.lookup(key)
+            if file_string is None and not precompute_all:
+                session_transformation = transformation
+                key = session_key(content_hash, samples, transformation_name(transformation, groups))
+                file_string = catalog.lookup(key)
 
             new_run = False
             if file_string is None:
                 new_run = True
                 file_string = generate_random_string()
-                write_session_to_file(list(df_info_temp.index), rm_confounding, transformation, file_string)
+                catalog.register(key, file_string, content_hash, samples, session_transformation)
            
-            name_counts_for_pca = os.path.join('data', 'generated', f'{file_string}_counts.tab')
+            # Matrices go to R in the binary interchange format (RNALYS_INTERCHANGE), the small meta table as text
+            name_counts_for_pca = matrix_path(os.path.join('data', 'generated', f'{file_string}_counts'))
             name_meta_for_pca = os.path.join('data', 'generated', f'{file_string}_meta.tab')
 
-            df_counts_raw.to_csv(name_counts_for_pca, sep='\t')
-            df_info_temp.to_csv(name_meta_for_pca, sep='\t')
-
-            name_out = os.path.join('data', 'generated', f'{file_string}_normalized.tab')
-            r_script_path = os.path.join('functions', 'data_transformation.R')
-
-            cmd = f'Rscript {r_script_path} {name_counts_for_pca} {name_meta_for_pca} {rm_confounding} {name_out} {transformation}'
-
-            print('forcerun', force_run)
-
-            if force_run or new_run:
-                print(cmd)
-                try:
-                    subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                except subprocess.CalledProcessError as e:
-                    print("Error executing command:", e)
+            # The key covers the counts of the selected samples, so a session found in the catalog
+            # already has them on disk. The meta table is not part of the key and is only
+            # rewritten when it changed, e.g. after uploading new sample information.
+            if new_run or not os.path.isfile(name_counts_for_pca):
+                write_matrix(df_counts_raw, name_counts_for_pca)
+            meta_text = df_info_temp.to_csv(sep='\t')
+            if new_run or not meta_unchanged(name_meta_for_pca, meta_text):
+                with atomic_write(name_meta_for_pca) as f:
+                    f.write(meta_text)
+
+            name_prefix = os.path.join('data', 'generated', f'{file_string}_normalized')
+            rlog_fit_path = os.path.join('data', 'generated', f'{file_string}_rlog_fit.json')
+            if session_transformation == 'all':
+                # A new grouping of a precomputed session gets its own quantilenorm_log2 file
+                name_out = matrix_path(f'{name_prefix}_{transformation_name(transformation, groups)}')
+            else:
+                name_out = matrix_path(name_prefix)
+
+            if session_transformation == 'all' and (new_run or (force_run and precompute_all)):
+                run_transformation(df_counts_raw, 'all', name_counts_for_pca, name_meta_for_pca,
+                                   matrix_path(name_prefix), rlog_fit_path, groups)
+                if not os.path.isfile(name_out):
+                    run_transformation(df_counts_raw, transformation, name_counts_for_pca, name_meta_for_pca,
+                                       name_out, rlog_fit_path, groups)
+            elif force_run or not os.path.isfile(name_out):
+                run_transformation(df_counts_raw, transformation, name_counts_for_pca, name_meta_for_pca,
+                                   name_out, rlog_fit_path, groups)
             else:
                 print('Loading file: %s' % name_out)
 
-            df_counts_temp_norm = pd.read_csv(name_out, sep='\t', index_col=0)
-            datasets = {'counts_norm': df_counts_temp_norm.to_json(orient='split', date_format='iso'),
+            df_counts_temp_norm = to_float(read_matrix(name_out))
+            counts_norm_name = 'counts_norm' if session_transformation != 'all' else f'counts_norm_{transformation}'
+            if confounders:
+                batch, covariates = split_confounders(df_info_temp, confounders)
+                df_counts_temp_norm = remove_batch_effect(df_counts_temp_norm, df_info_temp,
+                                                          batch=batch, covariates=covariates)
+                counts_norm_name += '_rm_' + re.sub(r'\W', '_', '_'.join(confounders))
+
+            # Only artifact ids are sent to the browser, the frames stay in the server-side cache
+            datasets = {'counts_norm': put_artifact(file_string, counts_norm_name, df_counts_temp_norm),
                         'transformation': transformation,
-                        'meta': df_info_temp.to_json(orient='split', date_format='iso'),
-                        'counts_raw': df_counts_raw.to_json(orient='split', date_format='iso'),
+                        'meta': put_artifact(file_string, 'meta', df_info_temp),
+                        'counts_raw': put_artifact(file_string, 'counts_raw', df_counts_raw),
                         'counts_raw_file_name': json.dumps(name_counts_for_pca),
                         'perf_file': json.dumps(name_out),
                         'file_string': json.dumps(file_string)}
@@ -1033,7 +1085,10 @@ def table_update(n_clicks, selected_data, rm_confounding, fulltext, force_run, d
 
         #block_style = {'display': 'block'}
 
-        return json.dumps(datasets), False
+        # Keeps data/generated within its quota, in the background and at most once a minute
+        maybe_evict()
+
+        return json.dumps(datasets), '', {'display': 'none'}
     else:
         raise PreventUpdate
 
@@ -1049,7 +1104,7 @@ def update_output1(indata, meta_dropdown_groupby, variable1, variable2, variable
         raise PreventUpdate
     else:
         datasets = json.loads(indata)
-        df_meta_temp = pd.read_json(StringIO(datasets['meta']), orient='split')
+        df_meta_temp = load_artifact(datasets['meta'])
         ltraces = []
 
         if meta_dropdown_groupby is None:
@@ -1078,13 +1133,14 @@ def update_output1(indata, meta_dropdown_groupby, variable1, variable2, variable
 @app.callback(
     Output('ma_plot', 'figure'),
     Input('intermediate-DEtable', 'children'),
+    Input('contrast_tabs', 'active_tab'),
 )
-def generate_maplot(indata):
+def generate_maplot(indata, active_contrast):
     if indata is None:
         raise PreventUpdate
     else:
         datasets = json.loads(indata)
-        df_matable = pd.read_json(StringIO(datasets['ma_table']), orient='split')
+        df_matable = contrast_table(datasets, 'ma_table', active_contrast)
 
         ma_plot_fig = px.scatter(
             df_matable, 
@@ -1103,10 +1159,11 @@ def generate_maplot(indata):
     [Output('volcanoplot', 'figure')],
     [Input('volcanoplot-input', 'value'),
      Input('intermediate-DEtable', 'children'),
-     Input('pvalue', 'children')],
+     Input('pvalue', 'children'),
+     Input('contrast_tabs', 'active_tab')],
     [State('volcano_xaxis', 'value'),
      State('volcano_yaxis', 'value')])
-def generate_volcano(effects, indata, psig, xaxis, yaxis):
+def generate_volcano(effects, indata, psig, active_contrast, xaxis, yaxis):
     if indata is None:
         raise PreventUpdate
     else:
@@ -1114,7 +1171,7 @@ def generate_volcano(effects, indata, psig, xaxis, yaxis):
             psig = 0.05
 
         datasets = json.loads(indata)
-        df_volcano = pd.read_json(StringIO(datasets['de_table']), orient='split')
+        df_volcano = contrast_table(datasets, 'de_table', active_contrast).copy()
         df_volcano['-log10(p)'] = df_volcano['padj'].apply(float)
         df_volcano['pvalue'] = df_volcano['pvalue'].apply(float)
 
@@ -1220,13 +1277,13 @@ def update_output1(indata, indata_de, lgenes, input_symbol, radio_grouping, lgen
         raise PreventUpdate
     else:
         datasets = json.loads(indata)
-        df_meta_temp = pd.read_json(StringIO(datasets['meta']), orient='split')
-        df_counts_temp = pd.read_json(StringIO(datasets['counts_norm']), orient='split')
+        df_meta_temp = load_artifact(datasets['meta'])
+        df_counts_temp = load_artifact(datasets['counts_norm'])
         sig_gene = 0
         try:
             #if DE anaysis has been conducted
             datasets_de = json.loads(indata_de)
-            df_degenes = pd.read_json(StringIO(datasets_de['de_table']), orient='split')
+            df_degenes = load_artifact(datasets_de['de_table'])
             df_degenes = df_degenes.loc[df_degenes['padj'] <= 0.05,]
             sig_gene = 1
         except:
@@ -1330,8 +1387,8 @@ def update_pca_and_barplot(indata, sample_names_toggle, number_of_genes, biplot_
             dropdown = variable1
 
         datasets = json.loads(indata)
-        df_meta_temp = pd.read_json(StringIO(datasets['meta']), orient='split')
-        df_counts_pca = pd.read_json(StringIO(datasets['counts_norm']), orient='split')
+        df_meta_temp = load_artifact(datasets['meta'])
+        df_counts_pca = load_artifact(datasets['counts_norm'])
 
         if number_of_genes:
             df_counts_pca = df_counts_pca.loc[
@@ -1495,12 +1552,13 @@ def populate_dataset_load(invalue):
     [Output('DE-table', 'data'),
      Output('pvalue', 'children'),
      Output('number_of_degenes', 'children')],
-    [Input('sig_submit', 'n_clicks')],
+    [Input('sig_submit', 'n_clicks'),
+     Input('contrast_tabs', 'active_tab')],
     [State('volcanoplot-input', 'value'),
      State('intermediate-DEtable', 'children'),
      State('toggle_sig', 'value'),
      State('toggle_basemean', 'value')], )
-def update_de_table(n_clicks, effects, indata, sig_value, basemean):
+def update_de_table(n_clicks, active_contrast, effects, indata, sig_value, basemean):
     if n_clicks is None:
         raise PreventUpdate
     else:
@@ -1508,7 +1566,7 @@ def update_de_table(n_clicks, effects, indata, sig_value, basemean):
             raise PreventUpdate
         else:
             datasets = json.loads(indata)
-            df_degenes = pd.read_json(StringIO(datasets['de_table']), orient='split')
+            df_degenes = contrast_table(datasets, 'de_table', active_contrast)
             radiode = datasets['DE_type']
             df_degenes = df_degenes.loc[df_degenes['padj'] <= float(sig_value),]
             if 'baseMean' in df_degenes.columns:
@@ -1521,7 +1579,8 @@ def update_de_table(n_clicks, effects, indata, sig_value, basemean):
             df_degenes2 = df_degenes.loc[df_degenes['log2FoldChange'] > effects[1],]
             df_degenes = pd.concat([df_degenes1, df_degenes2])
             number_of_degenes = df_degenes.shape[0]
-            name = f"{datasets['file_string']}_{effects[0]}_{effects[1]}_de.tab"
+            contrast = f"_{active_contrast}" if active_contrast in datasets.get('contrasts', []) else ''
+            name = f"{datasets['file_string']}{contrast}_{effects[0]}_{effects[1]}_de.tab"
             overlap_genes = list(set(df_degenes.index).intersection(set(df_symbol.index)))
 
             try:
@@ -1530,7 +1589,8 @@ def update_de_table(n_clicks, effects, indata, sig_value, basemean):
             except:
                 pass
             output_path = os.path.join('data', 'generated', name)
-            df_degenes.to_csv(output_path, sep='\t')
+            with atomic_path(output_path) as tmp_path:
+                df_degenes.to_csv(tmp_path, sep='\t')
 
             return df_degenes.to_dict('records'), sig_value, number_of_degenes
 
@@ -1546,7 +1606,8 @@ def export_de(n_clicks, indata, prefixes):
     else:
         if indata:
             datasets = json.loads(indata)
-            df_degenes = pd.read_json(StringIO(datasets['de_table']), orient='split')
+            # All contrasts in long format, with a contrast column
+            df_degenes = load_artifact(datasets.get('de_long', datasets['de_table'])).copy()
             try:
                 df_degenes['hgnc'] = [dTranslate.get(x, x) for x in df_degenes.index]
             except:
@@ -1555,7 +1616,8 @@ def export_de(n_clicks, indata, prefixes):
             file_string = datasets['file_string']
             de_file_for_plot = file_string + '_for_DEplot.tab'
             output_path = os.path.join('data', 'generated', de_file_for_plot)
-            df_degenes.to_csv(output_path, sep='\t')
+            with atomic_path(output_path) as tmp_path:
+                df_degenes.to_csv(tmp_path, sep='\t')
             print('Written to file: %s' % de_file_for_plot)
 
             return ['Written to file: %s' % de_file_for_plot]
@@ -1564,119 +1626,95 @@ def export_de(n_clicks, indata, prefixes):
             print('Run DE analysis first')
             return ['Nothing to export']
 
-# DE ANALYSIS
 @app.callback(
-    Output('intermediate-DEtable', 'children'),
-    Output('temp', 'children'),
-    Output('submit-de-done', 'children'),
-    Input('btn-DE', 'n_clicks'),
+    Output('heartbeat_done', 'children'),
+    Input('heartbeat', 'n_intervals'),
     State('intermediate-table', 'children'),
-    State('program', 'value'),
-    State('transformation', 'value'),
-    State('force_run', 'value'),
-    State('rowsum', 'value'),
-    State('design', 'value'),
-    State('reference', 'value'))
-def run_DE_analysis(n_clicks, indata, program, transformation, force_run, rowsum, design, reference):
-    if n_clicks is None:
-        raise PreventUpdate
-    else:
-        datasets = json.loads(indata)
-        outdir = os.path.join('data','generated')
-        name_counts = json.loads(datasets['counts_raw_file_name'])
-        file_string = json.loads(datasets['file_string'])
-        logfile = os.path.join(outdir, file_string + '_DE.log')
-
-        data = {
-            'program': [program],
-            'transformation': [transformation],
-            'rowsum': [rowsum],
-            'design': [design],
-            'reference': [reference],
-            'ID': [file_string]
-        }
-        df_new = pd.DataFrame(data)
-        df_new['timestamp'] = datetime.now()
-        
-        if os.path.isfile(logfile):
-            df_log = pd.read_csv(logfile)
-            df_log = pd.concat([df_log, df_new], ignore_index=True)
-        else:
-            # if logfile does not exist, use the new dataframe
-            df_log = df_new
-
-        df_log.to_csv(logfile, index=False)
-
-        name_meta = os.path.join('data', 'generated', f'{file_string}_meta.tab')
-        name_out = os.path.join('data', 'generated', f'{file_string}_DE.tab')
-
-        name_ma_table = None
-
-        if program == 'DESeq2':
-            name_ma_table =  os.path.join('data', 'generated', f'{file_string}_maplot.tab')
-            r_script_path = os.path.join('functions', 'run_deseq2.R')
-            cmd = f'Rscript {r_script_path} {name_counts} {name_meta} {rowsum} {design} {reference} {name_out} {name_ma_table}'
-            
-
-        elif program == 'edgeR':
-            r_script_path = os.path.join('functions', 'run_edgeR.R')
-            cmd = f'Rscript {r_script_path} {name_counts} {name_meta} {design} {reference} {name_out}'
-        
-        '''
-        elif program == 'limma':
-            if sTotal.count('@') > 1:
-                cmd = 'Rscript ./functions/run_limma_de.R %s %s %s %s %s' % (
-                name_counts, name_meta, 'batch', reference,
-                name_out)
-            else:
-                cmd = 'Rscript ./functions/run_limma_de.R %s %s %s %s %s' % (
-                name_counts, name_meta, 'none', reference,
-                name_out)
-        '''
+    State('intermediate-DEtable', 'children'),
+    State('session_id', 'data'))
+def heartbeat(n_intervals, indata, indata_de, session_id):
+    # The runs shown on this page and its uploads are still in use, eviction keeps them
+    file_strings = [session_id]
+    if indata:
+        file_strings.append(json.loads(json.loads(indata)['file_string']))
+    if indata_de:
+        file_strings.append(json.loads(indata_de)['file_string'])
+    get_catalog().heartbeat(file_strings)
+    return ''
+
+
+def contrast_table(datasets, name, active_contrast):
+    """
+    Return the table name ('de_table' or 'ma_table') of the contrast in the active tab, the
+    only table of runs without contrasts.
+    """
+    return load_artifact(datasets.get(f'{name}s', {}).get(active_contrast, datasets[name]))
 
-        if os.path.isfile(name_out) and not force_run:
-            print("Output file already exists. Use 'force_run' to override.")
-        else:
-            try:
-                # Run the subprocess command
-                #result = subprocess.run(cmd, check=True, text=True, capture_output=True)
-                subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                print("DE analysis completed successfully.")
-                #print("Output:", result.stdout)
-            except subprocess.CalledProcessError as e:
-                print("Failed to run DE analysis.")
-                print("Error:", e.stderr)
 
-        df_degenes = pd.read_csv(name_out, sep='\t')
+@app.callback(
+    Output('dispersion_plot', 'figure'),
+    Output('mds_plot', 'figure'),
+    Input('de_plot_tabs', 'active_tab'),
+    Input('intermediate-DEtable', 'children'),
+    State('intermediate-table', 'children'))
+def generate_diagnostics(active_tab, indata, indata_counts):
+    # Computed only when the diagnostics tab is open, the MDS is cached per dataset
+    if active_tab != 'diagnostics' or indata is None or indata_counts is None:
+        raise PreventUpdate
+    datasets = json.loads(indata)
+    dispersion_fig = go.Figure(layout={'title': 'No dispersion estimates for this run'})
+    if datasets.get('dispersion') and os.path.isfile(datasets['dispersion']):
+        df_plot, xlabel, ylabel, log_scale = dispersion_plot_data(read_matrix(datasets['dispersion']))
+        dispersion_fig = px.scatter(df_plot, x='x', y='y', color='estimate', log_x=log_scale, log_y=log_scale,
+                                    labels={'x': xlabel, 'y': ylabel}, title='Dispersion', render_mode='webgl')
+
+    mds_id = f"{datasets['file_string']}_mds"
+    df_mds = get_artifact(mds_id)  # None is a cache miss
+    if df_mds is None:
+        df_mds = mds_coordinates(load_artifact(json.loads(indata_counts)['counts_raw']))
+        put_artifact(datasets['file_string'], 'mds', df_mds)
+    mds_fig = px.scatter(df_mds, x='dim1', y='dim2', text=df_mds.index,
+                         labels={'dim1': 'Leading logFC dim 1', 'dim2': 'Leading logFC dim 2'}, title='MDS')
+    return dispersion_fig, mds_fig
 
-        if program == 'edgeR':
-            df_degenes.rename(columns={'logFC': 'log2FoldChange', 'FDR': 'padj', 'PValue': 'pvalue'}, inplace=True)
-            df_degenes['Ensembl'] = df_degenes['genes']
 
-        df_degenes['Ensembl'] = df_degenes.index
-        df_degenes = df_degenes.sort_values(by=['log2FoldChange'])
-        df_degenes['padj'] = df_degenes['padj'].apply(str)
-        df_degenes['pvalue'] = df_degenes['pvalue'].apply(str)
-        overlap_genes = list(set(df_degenes.index).intersection(set(df_symbol.index)))
-        try:
-            dTranslate = dict(df_symbol.loc[overlap_genes]['hgnc_symbol'])
-            df_degenes['hgnc'] = [dTranslate.get(x, x) for x in df_degenes.index]
-        except:
-            pass
+@app.callback(
+    Output('contrasts', 'options'),
+    Input('design', 'value'),
+    Input('reference', 'value'),
+    Input('intermediate-table', 'children'))
+def contrast_options(design, reference, indata):
+    if indata is None:
+        raise PreventUpdate
+    datasets = json.loads(indata)
+    meta = load_artifact(datasets.get('meta'))
+    try:
+        levels = factor_levels(meta[design_variables(design)[-1]], reference or None)
+    except (ValueError, KeyError, TypeError):
+        return []
+    return [{'label': 'All pairwise', 'value': 'all'}] + \
+        [{'label': f'{num} vs {den}', 'value': f'{num} vs {den}'} for num, den in pairwise_contrasts(levels)]
 
-        if name_ma_table:
-            ma_table = pd.read_csv(name_ma_table, sep='\t')
-        else:
-            ma_table = pd.DataFrame()
-
-        datasets = {'de_table': df_degenes.to_json(orient='split'), 'DE_type': program, 'file_string': file_string, 'ma_table': ma_table.to_json(orient='split')}
-        
-        print('DE done')
-        return json.dumps(datasets), 'temp', ''
 
+@app.callback(
+    Output('contrast_tabs', 'children'),
+    Output('contrast_tabs', 'active_tab'),
+    Input('intermediate-DEtable', 'children'))
+def contrast_tabs(indata):
+    if indata is None:
+        raise PreventUpdate
+    labels = json.loads(indata).get('contrasts', [])
+    tabs = [dbc.Tab(label=label.replace('_vs_', ' vs '), tab_id=label) for label in labels]
+    return tabs, labels[0] if labels else None
+
+# DE programs with an in-process Python engine, they take (counts, meta, design, reference, rowsum,
+# contrasts) and return the DE table and the MA table written by the R scripts and the dispersion
+# estimates, in long format with a contrast column when contrasts are given
+PYTHON_DE_PROGRAMS = {'DESeq2': run_deseq2, 'edgeR': run_edger, 'edgeR exact': partial(run_edger, test='exact'),
+                      'limma': run_limma}
+# Programs with an R script, the others always run in Python
+R_DE_PROGRAMS = ('DESeq2', 'edgeR')
 
-#For future removal of Rscript with interal deseq2 algorithms
-'''
 # DE ANALYSIS
 @app.callback(
     Output('intermediate-DEtable', 'children'),
@@ -1689,13 +1727,18 @@ def run_DE_analysis(n_clicks, indata, program, transformation, force_run, rowsum
     State('force_run', 'value'),
     State('rowsum', 'value'),
     State('design', 'value'),
-    State('reference', 'value'))
-def run_DE_analysis(n_clicks, indata, program, transformation, force_run, rowsum, design, reference):
+    State('reference', 'value'),
+    State('de_engine', 'value'),
+    State('contrasts', 'value'))
+def run_DE_analysis(n_clicks, indata, program, transformation, force_run, rowsum, design, reference, de_engine,
+                    contrast_values):
     if n_clicks is None:
         raise PreventUpdate
     else:
         datasets = json.loads(indata)
-        outdir = os.path.join('data', 'generated')
+        df_counts_raw = load_artifact(datasets['counts_raw'])
+        df_meta = load_artifact(datasets['meta'])
+        outdir = os.path.join('data','generated')
         name_counts = json.loads(datasets['counts_raw_file_name'])
         file_string = json.loads(datasets['file_string'])
         logfile = os.path.join(outdir, file_string + '_DE.log')
@@ -1710,117 +1753,140 @@ def run_DE_analysis(n_clicks, indata, program, transformation, force_run, rowsum
         }
         df_new = pd.DataFrame(data)
         df_new['timestamp'] = datetime.now()
+        append_csv_rows(logfile, df_new)
+
+        # Results are cached per input and parameter set, everything that changes the result is in the key
+        catalog = get_catalog()
+        # Keeps the session pinned in data/generated while it is being analysed
+        catalog.touch(file_string)
+        use_python = program in PYTHON_DE_PROGRAMS and (de_engine == 'Python' or program not in R_DE_PROGRAMS)
+        if de_engine == 'Python' and not use_python:
+            print('No Python engine for %s, running it in R' % program)
+        parameters = {'program': program, 'rowsum': rowsum, 'design': design, 'reference': reference,
+                      'engine': 'Python' if use_python else 'R'}
+        contrasts = None
+        if contrast_values:
+            try:
+                variable = design_variables(design)[-1]
+                contrasts = parse_contrasts(contrast_values, factor_levels(df_meta[variable], reference or None))
+                parameters['contrasts'] = [f'{num} vs {den}' for num, den in contrasts]
+            except (ValueError, KeyError) as e:
+                print("Invalid contrasts, testing the last variable against the reference.")
+                print("Error:", e)
+        input_hash = frames_hash(df_counts_raw, df_meta)
+        key = de_key(input_hash, parameters)
+        result_id = f'{file_string}_{key[:12]}'
 
-        if os.path.isfile(logfile):
-            df_log = pd.read_csv(logfile)
-            df_log = pd.concat([df_log, df_new], ignore_index=True)
-        else:
-            df_log = df_new
-
-        df_log.to_csv(logfile, index=False)
-
-        # Load counts and metadata
         name_meta = os.path.join('data', 'generated', f'{file_string}_meta.tab')
-        name_out = os.path.join('data', 'generated', f'{file_string}_DE.tab')
-
-        counts = pd.read_csv(name_counts, sep='\t', index_col=0)
-        metadata = pd.read_csv(name_meta, sep='\t', index_col=0)
-
-        # Remove rows with low counts if rowsum parameter is set
-        if rowsum is not None and rowsum != '':
-            rowsum_threshold = int(rowsum)
-            counts = counts[counts.sum(axis=1) >= rowsum_threshold]
-
-        # Prepare the design matrix
-        design_factors = design.replace('~', '').split('+')
-        design_factors = [factor.strip() for factor in design_factors]
-        design_matrix = metadata[design_factors]
-        design_matrix.index = metadata.index  # Ensure the index aligns with counts columns
-
-        # Convert categorical variables to appropriate format
-        for col in design_matrix.columns:
-            if design_matrix[col].dtype == object or str(design_matrix[col].dtype).startswith('category'):
-                design_matrix[col] = pd.Categorical(design_matrix[col])
-
-        # Ensure counts columns match design matrix index
-        counts = counts.loc[:, design_matrix.index]
-
-        # Prepare the contrast or coefficient to test
-        coef_name = design_factors[-1]  # Testing the last factor in the design
-
-        # Handle reference level if specified
-        if reference and ':' in reference:
-            factor, ref_level = reference.split(':')
-            if factor in design_matrix.columns:
-                design_matrix[factor] = pd.Categorical(design_matrix[factor])
-                design_matrix[factor].cat.set_categories([ref_level] + [x for x in design_matrix[factor].cat.categories if x != ref_level], inplace=True)
-            else:
-                print(f"Reference factor {factor} not in design matrix columns")
-
-        # Run the DE analysis using the appropriate function
-        if program == 'DESeq2':
-            # Normalize counts
-            size_factors = calculate_size_factors(counts)
-            normalized_counts = counts.div(size_factors, axis=1)
+        name_out = matrix_path(os.path.join('data', 'generated', f'{result_id}_DE'))
 
-            # Estimate dispersion
-            dispersions = estimate_dispersion(counts, design_matrix, size_factors)
+        name_ma_table = None
+        # Dispersion estimates per gene for the diagnostics tab, from the Python engines and edgeR in R
+        name_dispersion = matrix_path(os.path.join('data', 'generated', f'{result_id}_dispersion'))
 
-            # Fit the model and get results
-            results_df = fit_glm_nb(counts, design_matrix, size_factors, dispersions, coef_name)
+        if program == 'DESeq2':
+            name_ma_table = matrix_path(os.path.join('data', 'generated', f'{result_id}_maplot'))
+            r_script_path = os.path.join('functions', 'run_deseq2.R')
+            r_args = [name_counts, name_meta, rowsum, design, reference, name_out, name_ma_table]
+            if contrasts:
+                r_args.append(','.join(f'{num}|{den}' for num, den in contrasts))
 
-            # Adjust p-values
-            results_df['padj'] = multipletests(results_df['p_value'], method='fdr_bh')[1]
-            results_df.rename(columns={'p_value': 'pvalue'}, inplace=True)
-            df_degenes = results_df
 
         elif program == 'edgeR':
-            # Normalize counts
-            norm_factors = calc_norm_factors(counts)
-
-            # Estimate dispersion
-            groups = design_matrix[coef_name].values
-            common_dispersion = estimate_common_dispersion(counts, groups, norm_factors)
-            tagwise_dispersion = estimate_tagwise_dispersion(counts, groups, norm_factors, common_dispersion)
-
-            # Fit the model and get results
-            results_df = glm_lrt(counts, design_matrix, norm_factors, tagwise_dispersion, coef_name)
-
-            # Adjust p-values
-            results_df['padj'] = multipletests(results_df['p_value'], method='fdr_bh')[1]
-            results_df.rename(columns={'logFC': 'log2FoldChange', 'p_value': 'pvalue'}, inplace=True)
-            df_degenes = results_df
-
+            r_script_path = os.path.join('functions', 'run_edgeR.R')
+            r_args = [name_counts, name_meta, design, reference, name_out, name_dispersion]
+            if contrasts:
+                r_args.append(','.join(f'{num}|{den}' for num, den in contrasts))
+
+        # limma (voom) has no R script, it always runs in Python
+
+        # With contrasts every comparison has its own DE and MA file, in the order of contrasts
+        labels = [contrast_label(num, den) for num, den in contrasts] if contrasts else [None]
+        de_files = [contrast_path(name_out, i) if contrasts else name_out for i in range(len(labels))]
+        ma_files = [contrast_path(name_ma_table, i) if contrasts else name_ma_table
+                    for i in range(len(labels))] if name_ma_table else []
+        result_files = de_files + ma_files
+        if not force_run and catalog.lookup_de(key) is not None:
+            print("Using cached DE result %s. Use 'force_run' to override." % result_id)
         else:
-            print("Unknown program specified.")
-            return None, None, None
-
-        # Save the results to name_out
-        df_degenes.to_csv(name_out, sep='\t')
-
-        # The rest of the code remains the same
-        df_degenes['Ensembl'] = df_degenes.index
-        df_degenes = df_degenes.sort_values(by=['log2FoldChange'])
-        df_degenes['padj'] = df_degenes['padj'].apply(str)
-        df_degenes['pvalue'] = df_degenes['pvalue'].apply(str)
-        overlap_genes = list(set(df_degenes.index).intersection(set(df_symbol.index)))
-        try:
-            dTranslate = dict(df_symbol.loc[overlap_genes]['hgnc_symbol'])
-            df_degenes['hgnc'] = [dTranslate.get(x, x) for x in df_degenes.index]
-        except:
-            pass
-
-        # Since we didn't compute MA plot data, we'll set ma_table to an empty DataFrame
-        ma_table = pd.DataFrame()
-
-        datasets = {'de_table': df_degenes.to_json(orient='split'), 'DE_type': program, 'file_string': file_string, 'ma_table': ma_table.to_json(orient='split')}
-
-        print('DE analysis completed.')
+            # A rerun replaces the files, the old entry must not point at them half-written
+            catalog.invalidate_de(key)
+            try:
+                start_time = time.perf_counter()
+                if use_python:
+                    df_result, df_ma, df_dispersion = PYTHON_DE_PROGRAMS[program](df_counts_raw, df_meta, design,
+                                                                                  reference, rowsum,
+                                                                                  contrasts=contrasts)
+                    for i, label in enumerate(labels):
+                        # The binary formats hold numbers only, the contrast column is in the file name
+                        write_matrix(df_result[df_result['contrast'] == label].drop(columns='contrast')
+                                     if contrasts else df_result, de_files[i])
+                        if name_ma_table:
+                            write_matrix(df_ma[df_ma['contrast'] == label].drop(columns='contrast')
+                                         if contrasts else df_ma, ma_files[i])
+                    # The voom mean-variance trend for limma
+                    write_matrix(df_dispersion, name_dispersion)
+                    result_files.append(name_dispersion)
+                else:
+                    # Runs in a preloaded R worker, falls back to a plain Rscript call
+                    run_rscript(r_script_path, r_args)
+                    if program == 'edgeR':
+                        result_files.append(name_dispersion)
+                missing = [f for f in result_files if not os.path.isfile(f)]
+                if missing:
+                    raise FileNotFoundError('No result written to %s' % ', '.join(missing))
+            except Exception as e:
+                # Every engine failure ends here: R errors, singular designs, a broken worker pool
+                print("Failed to run DE analysis.")
+                print("Error:", getattr(e, 'stderr', None) or e)
+                return dash.no_update, 'temp', f'DE analysis failed: {e}'
+            # Registered only once every file is written
+            catalog.register_de(key, file_string, input_hash, parameters, result_files,
+                                time.perf_counter() - start_time)
+            print("DE analysis completed successfully.")
+
+        de_tables, ma_tables = {}, {}
+        for i, label in enumerate(labels):
+            df_degenes = read_matrix(de_files[i])
+
+            if program in ('edgeR', 'edgeR exact'):
+                df_degenes.rename(columns={'logFC': 'log2FoldChange', 'FDR': 'padj', 'PValue': 'pvalue'}, inplace=True)
+            elif program == 'limma':
+                df_degenes.rename(columns={'logFC': 'log2FoldChange', 'adj.P.Val': 'padj', 'P.Value': 'pvalue'},
+                                  inplace=True)
+
+            df_degenes['Ensembl'] = df_degenes.index
+            df_degenes = df_degenes.sort_values(by=['log2FoldChange'])
+            overlap_genes = list(set(df_degenes.index).intersection(set(df_symbol.index)))
+            try:
+                dTranslate = dict(df_symbol.loc[overlap_genes]['hgnc_symbol'])
+                df_degenes['hgnc'] = [dTranslate.get(x, x) for x in df_degenes.index]
+            except:
+                pass
+            de_tables[label] = df_degenes
+            ma_tables[label] = read_matrix(ma_files[i]) if name_ma_table else pd.DataFrame()
+
+        first = labels[0]
+        datasets = {'de_table': put_artifact(result_id, 'de_table', de_tables[first]), 'DE_type': program,
+                    'file_string': file_string, 'result_id': result_id,
+                    'ma_table': put_artifact(result_id, 'ma_table', ma_tables[first]),
+                    'dispersion': name_dispersion if os.path.isfile(name_dispersion) else None}
+        if contrasts:
+            # One table per contrast for the tabs, and all of them in long format for the export
+            datasets['contrasts'] = labels
+            datasets['de_tables'] = {label: put_artifact(result_id, f'de_table_{label}', de_tables[label])
+                                     for label in labels}
+            datasets['ma_tables'] = {label: put_artifact(result_id, f'ma_table_{label}', ma_tables[label])
+                                     for label in labels}
+            de_long = pd.concat([df.assign(contrast=label) for label, df in de_tables.items()])
+            datasets['de_long'] = put_artifact(result_id, 'de_long',
+                                               de_long[['contrast'] + list(de_long.columns[:-1])])
+        maybe_evict()
+        
+        print('DE done')
         return json.dumps(datasets), 'temp', ''
 
 
-'''
-
 conditions = [
     ("GO_bp_up", "GO_bp_up_ph"),
     ("GO_bp_dn", "GO_bp_dn_ph"),
@@ -1881,7 +1947,8 @@ def split_genes_by_expression(de_genes_df, sig_value):
 
 def run_enrichr_analysis(datasets, gene_splits):
     radiode = datasets['DE_type']
-    file_string = datasets['file_string']
+    # Enrichr results belong to one DE result, not to the whole session
+    file_string = datasets.get('result_id', datasets['file_string'])
     databases = ['GO_Biological_Process_2018', 'GO_Cellular_Component_2018', 'GO_Molecular_Function_2018', 'KEGG_2016']
     out_folder = os.path.join('data', 'generated', 'enrichr')
     os.makedirs(out_folder, exist_ok=True)
@@ -1900,7 +1967,7 @@ def run_enrichr_analysis(datasets, gene_splits):
 
 def write_genes_to_file(genes_df, file_string, state, out_folder):
     file_path = os.path.join(out_folder, f'{file_string}_{state}_DE_genes.txt')
-    with open(file_path, 'w') as wf:
+    with atomic_write(file_path) as wf:
         for hgnc in genes_df['hgnc']:
             if isinstance(hgnc, list):
                 hgnc = hgnc[0]
@@ -1909,7 +1976,8 @@ def write_genes_to_file(genes_df, file_string, state, out_folder):
 
 def perform_enrichr_query(file_path, db, state, file_string, out_folder):
     output_path = os.path.join(out_folder, f'{file_string}_{state}_{db}')
-    if not os.path.isfile(output_path):
+    # The query script writes output_path + '.txt', a missing or evicted file is a cache miss
+    if not os.path.isfile(output_path + '.txt'):
         enrichr_path = os.path.join('enrichr-api', 'query_enrichr_py3.py')
         cmd = f'{sys.executable} {enrichr_path} {file_path} {state}_{db} {db} {output_path}'
         run_subprocess(cmd)
@@ -1966,7 +2034,7 @@ def export_enrichr_plot(n_clicks, indata, prefixes):
             filedata = filedata.replace('_fileid_', file_string)
             
             # Write the file out again
-            with open(enrichr_file_path, 'w') as file:
+            with locked_atomic_write(enrichr_file_path) as file:
                 file.write(filedata)
             return [f'Created enrichr plot file {enrichr_file}']
 
@@ -1975,7 +2043,6 @@ def export_enrichr_plot(n_clicks, indata, prefixes):
             return ['Can not create plot (run the analysis)']
 
 if __name__ == "__main__":
-    ascii_banner = pyfiglet.figlet_format("\\\ Rnalys")
-    print(ascii_banner)
-    #app.run_server(debug=True, host='localhost')
-    app.run_server(debug=True, dev_tools_ui=True, dev_tools_props_check=True)
+    # Started through run.py, the spawned DE worker processes would otherwise load this
+    # whole app again as their main module
+    runpy.run_path(os.path.join(current_dir, 'run.py'), run_name='__main__')
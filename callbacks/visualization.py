@@ -2,7 +2,8 @@ import plotly.graph_objs as go
 import pandas as pd
 import numpy as np
 from dash.dependencies import Input, Output
-from app import app
+from dash.exceptions import PreventUpdate
+from app import app, load_artifact
 from io import StringIO
 import json
 
@@ -17,7 +18,7 @@ def update_barplot(indata, groupby_var):
         raise PreventUpdate
     
     datasets = json.loads(indata)
-    df_meta_temp = pd.read_json(StringIO(datasets['meta']), orient='split')
+    df_meta_temp = load_artifact(datasets['meta'])
     ltraces = []
 
     for x in df_meta_temp[groupby_var].unique():
@@ -0,0 +1,200 @@
+# artifact_store.py
+
+#Size and age limits for data/generated. Every file there starts with the file_string of
+#the session that made it (counts, meta, normalized matrices, DE and MA tables, enrichr
+#results, cached frames), so whole sessions are evicted, least recently used first, when
+#the directory is over its quota or a session is older than the TTL. Sessions used within
+#the pin window are never evicted. Open pages send a heartbeat for the runs they show
+#(SessionCatalog.heartbeat), so their artifacts stay pinned as long as the page is open.
+#Uploaded tables in data/sessions/<session_id>/ are evicted the same way, per browser
+#session, and count towards the same quota. Evicted sessions are removed from the session catalog,
+#so later lookups are cache misses. Usage report and manual eviction:
+#
+#   python -m functions.artifact_store report|evict
+
+import os
+import re
+import sys
+import time
+import logging
+import threading
+
+import pandas as pd
+
+from functions.data_store import DATA_STORE_DIR
+from functions.session_catalog import get_catalog
+
+GENERATED_DIR = os.path.join('data', 'generated')
+UPLOADS_DIR = DATA_STORE_DIR
+
+# Byte quota for data/generated, sessions unused for TTL seconds are evicted regardless
+QUOTA_BYTES = int(os.environ.get('RNALYS_GENERATED_QUOTA', str(10 * 1024 ** 3)))
+TTL_SECONDS = float(os.environ.get('RNALYS_GENERATED_TTL', str(30 * 24 * 3600)))
+# Sessions used more recently than this are pinned, much longer than the heartbeat interval
+PIN_SECONDS = float(os.environ.get('RNALYS_GENERATED_PIN', str(2 * 3600)))
+# Minimum time between two automatic evictions
+EVICT_INTERVAL = 60
+
+# DE results carry a 12 character parameter key after the file_string
+_DE_KEY = re.compile(r'^[0-9a-f]{12}_')
+
+
+def artifact_type(file_name):
+    """
+    Type of a generated file from its name, e.g. 'abc_normalized_vsd.rbin' -> 'normalized.rbin'.
+    """
+    rest = file_name.split('_', 1)[1] if '_' in file_name else file_name
+    rest, extension = os.path.splitext(_DE_KEY.sub('', rest))
+    word = re.match(r'[A-Za-z0-9]*', rest).group(0) or 'other'
+    return word + extension
+
+
+def scan(directory=GENERATED_DIR):
+    """
+    Return one row per generated file with its session, type, size and modification time.
+    """
+    rows = []
+    # Includes subfolders such as data/generated/enrichr, their name is the type
+    for root, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            stat = os.stat(path)
+            file_type = artifact_type(file_name) if root == directory else os.path.basename(root)
+            rows.append({'path': path, 'session': file_name.split('_', 1)[0],
+                         'type': file_type, 'size': stat.st_size, 'mtime': stat.st_mtime})
+    return pd.DataFrame(rows, columns=['path', 'session', 'type', 'size', 'mtime'])
+
+
+def scan_uploads(directory=UPLOADS_DIR):
+    """
+    Return one row per uploaded table, the session is the browser session of its folder.
+    """
+    rows = []
+    if os.path.isdir(directory):
+        for session in os.listdir(directory):
+            folder = os.path.join(directory, session)
+            for file_name in os.listdir(folder) if os.path.isdir(folder) else []:
+                path = os.path.join(folder, file_name)
+                stat = os.stat(path)
+                rows.append({'path': path, 'session': session, 'type': 'upload',
+                             'size': stat.st_size, 'mtime': stat.st_mtime})
+    return pd.DataFrame(rows, columns=['path', 'session', 'type', 'size', 'mtime'])
+
+
+def scan_all(directory=GENERATED_DIR, uploads_directory=UPLOADS_DIR):
+    """
+    Generated files and uploaded tables together, the files under the quota.
+    """
+    frames = [files for files in (scan(directory), scan_uploads(uploads_directory)) if not files.empty]
+    return pd.concat(frames, ignore_index=True) if frames else scan(directory)
+
+
+def session_usage(files, last_used=None):
+    """
+    Bytes, file count and last use of every session, last use is the later of the newest
+    file and the catalog's last lookup.
+    """
+    sessions = files.groupby('session').agg(size=('size', 'sum'), files=('path', 'count'),
+                                            last_used=('mtime', 'max'))
+    if last_used:
+        catalog_times = pd.Series(last_used, dtype=float).reindex(sessions.index)
+        sessions['last_used'] = sessions['last_used'].combine(catalog_times, max).fillna(sessions['last_used'])
+    return sessions.sort_values('last_used')
+
+
+def plan_eviction(sessions, quota=QUOTA_BYTES, ttl=TTL_SECONDS, pin=PIN_SECONDS, now=None):
+    """
+    Choose the sessions to evict: expired ones first, then least recently used until
+    the total is within the quota. Pinned sessions are kept even if that leaves it over.
+
+    Returns:
+    - list: Sessions to evict.
+    """
+    now = time.time() if now is None else now
+    age = now - sessions['last_used']
+    evictable = sessions[age > pin]
+    evict = list(evictable.index[age[evictable.index] > ttl])
+
+    total = sessions['size'].sum() - sessions.loc[evict, 'size'].sum()
+    for session, row in evictable.drop(evict).iterrows():
+        if total <= quota:
+            break
+        evict.append(session)
+        total -= row['size']
+    return evict
+
+
+def evict(directory=GENERATED_DIR, quota=QUOTA_BYTES, ttl=TTL_SECONDS, pin=PIN_SECONDS,
+          uploads_directory=UPLOADS_DIR):
+    """
+    Delete the files of the sessions chosen by plan_eviction and drop them from the catalog.
+
+    Returns:
+    - list: Evicted sessions.
+    """
+    catalog = get_catalog()
+    files = scan_all(directory, uploads_directory)
+    if files.empty:
+        return []
+    sessions = plan_eviction(session_usage(files, catalog.last_used()), quota, ttl, pin)
+    for session in sessions:
+        # Out of the catalog first, so nobody looks up a session while its files disappear
+        catalog.invalidate(file_string=session)
+        for path in files.loc[files['session'] == session, 'path']:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        try:
+            # The emptied folder of an upload session
+            os.rmdir(os.path.join(uploads_directory, session))
+        except OSError:
+            pass
+    if sessions:
+        logging.info('Evicted %d sessions from %s', len(sessions), directory)
+    return sessions
+
+
+_last_eviction = 0
+_eviction_lock = threading.Lock()
+
+
+def maybe_evict():
+    """
+    Run evict in a background thread, at most once every EVICT_INTERVAL seconds.
+    """
+    global _last_eviction
+    with _eviction_lock:
+        if time.time() - _last_eviction < EVICT_INTERVAL:
+            return
+        _last_eviction = time.time()
+    threading.Thread(target=evict, daemon=True).start()
+
+
+def report(directory=GENERATED_DIR):
+    """
+    Usage per artifact type and per session.
+
+    Returns:
+    - tuple: (per type, per session) DataFrames.
+    """
+    files = scan_all(directory)
+    by_type = files.groupby('type').agg(size=('size', 'sum'), files=('path', 'count'))
+    by_session = session_usage(files, get_catalog().last_used())
+    by_session['pinned'] = time.time() - by_session['last_used'] <= PIN_SECONDS
+    return by_type.sort_values('size', ascending=False), by_session.sort_values('size', ascending=False)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in ('report', 'evict'):
+        sys.exit('Usage: python -m functions.artifact_store report|evict')
+
+    if sys.argv[1] == 'evict':
+        print('Evicted sessions: %s' % ', '.join(evict()))
+    else:
+        by_type, by_session = report()
+        print('Total %d bytes of %d quota in %s\n' % (by_type['size'].sum(), QUOTA_BYTES, GENERATED_DIR))
+        print(by_type.to_string())
+        print()
+        by_session['last_used'] = pd.to_datetime(by_session['last_used'], unit='s').dt.strftime('%Y-%m-%d %H:%M')
+        print(by_session.to_string())
@@ -0,0 +1,85 @@
+# batch_correction.py
+
+#Removal of batch effects from a transformed matrix, the NumPy counterpart of
+#limma::removeBatchEffect. The batch design is fitted once for all genes with a
+#single least-squares solve.
+
+import numpy as np
+import pandas as pd
+
+
+def _sum_to_zero(column):
+    # contr.sum coding: one column per level except the last, which is coded -1 everywhere
+    levels = pd.unique(column.astype(str))
+    codes = pd.Categorical(column.astype(str), categories=levels).codes
+    X = np.zeros((len(column), len(levels) - 1))
+    for j in range(len(levels) - 1):
+        X[codes == j, j] = 1
+    X[codes == len(levels) - 1, :] = -1
+    return X
+
+
+def batch_design(meta, batch=None, covariates=None):
+    """
+    Build the batch part of the design matrix.
+
+    Parameters:
+    - meta (pd.DataFrame): Sample information, one row per sample.
+    - batch (list, optional): Categorical columns, coded with sum-to-zero contrasts.
+    - covariates (list, optional): Numeric columns, centered.
+
+    Returns:
+    - np.ndarray: Samples x batch terms.
+    """
+    blocks = [_sum_to_zero(meta[column]) for column in batch or []]
+    for column in covariates or []:
+        values = meta[column].to_numpy(dtype=np.float64)
+        blocks.append((values - values.mean())[:, None])
+    if not blocks:
+        return np.zeros((meta.shape[0], 0))
+    return np.hstack(blocks)
+
+
+def split_confounders(meta, columns):
+    """
+    Split confounder columns into categorical batch columns and numeric covariates.
+
+    Returns:
+    - tuple: (batch, covariates)
+    """
+    batch = [c for c in columns if not pd.api.types.is_numeric_dtype(meta[c])]
+    covariates = [c for c in columns if pd.api.types.is_numeric_dtype(meta[c])]
+    return batch, covariates
+
+
+def remove_batch_effect(values, meta, batch=None, covariates=None, design=None):
+    """
+    Remove batch effects and covariates from a transformed matrix.
+
+    The model [design, batch terms] is fitted to all genes with one least-squares
+    solve and the fitted batch component is subtracted, as in limma::removeBatchEffect.
+
+    Parameters:
+    - values (pd.DataFrame): Transformed values, genes x samples.
+    - meta (pd.DataFrame): Sample information, indexed by sample.
+    - batch (list, optional): Categorical batch columns in meta.
+    - covariates (list, optional): Numeric covariate columns in meta.
+    - design (np.ndarray, optional): Design of the effects to keep, defaults to an intercept.
+
+    Returns:
+    - pd.DataFrame: Corrected values with the same shape, index and columns.
+    """
+    meta = meta.loc[values.columns]
+    X_batch = batch_design(meta, batch, covariates)
+    if X_batch.shape[1] == 0:
+        return values
+
+    if design is None:
+        design = np.ones((meta.shape[0], 1))
+    X = np.hstack([design, X_batch])
+
+    y = values.to_numpy(dtype=np.float64)
+    coefficients = np.linalg.lstsq(X, y.T, rcond=None)[0]
+    batch_effect = X_batch @ coefficients[design.shape[1]:]
+    corrected = (y - batch_effect.T).astype(values.dtypes.iloc[0], copy=False)
+    return pd.DataFrame(corrected, index=values.index, columns=values.columns)
@@ -0,0 +1,279 @@
+# data_import.py
+
+#Streaming import of uploaded tables. The base64 payload from dcc.Upload is decoded
+#in chunks and parsed batch by batch, so the decoded file is never held in memory
+#as a whole. pyarrow's multi-threaded csv reader is used when it is installed.
+
+import io
+import bz2
+import csv
+import gzip
+import base64
+import logging
+import itertools
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+    pa_csv = None
+
+SEPARATORS = {'csv': ',', 'tab': '\t', 'tsv': '\t', 'txt': '\t'}
+COMPRESSIONS = {'gz': gzip.GzipFile, 'bz2': bz2.BZ2File}
+
+# Base64 characters decoded per read, must be a multiple of 4
+DECODE_CHUNK_CHARS = 4 * 2 ** 20
+# Rows per chunk for the pandas parser
+PARSE_CHUNK_ROWS = 50000
+# Block size for the pyarrow parser
+ARROW_BLOCK_SIZE = 16 * 2 ** 20
+
+
+class Base64Stream(io.RawIOBase):
+    """
+    Read-only binary stream over the base64 part of a dcc.Upload contents string.
+    """
+
+    def __init__(self, contents, chunk_chars=DECODE_CHUNK_CHARS):
+        # Skip the 'data:<type>;base64,' prefix without copying the payload
+        self._contents = contents
+        self._pos = contents.find(',') + 1
+        self._chunk_chars = chunk_chars
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and self._pos < len(self._contents):
+            chunk = self._contents[self._pos:self._pos + self._chunk_chars]
+            self._pos += len(chunk)
+            self._buffer = base64.b64decode(chunk)
+
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def split_filename(filename):
+    """
+    Return the separator and compression for an uploaded file name.
+
+    Parameters:
+    - filename (str): Name of the uploaded file, e.g. 'counts.tsv.gz'.
+
+    Returns:
+    - tuple: (separator, compression), compression is None for plain files.
+
+    Raises:
+    - ValueError: If the extension is not one of csv, tab, tsv or txt (optionally .gz/.bz2).
+    """
+    parts = filename.lower().split('.')
+    compression = parts.pop() if len(parts) > 2 and parts[-1] in COMPRESSIONS else None
+    if len(parts) < 2 or parts[-1] not in SEPARATORS:
+        raise ValueError('File name extension not recongized, accepted extensions are csv, tab, tsv '
+                         '(optionally compressed with gz or bz2)')
+    return SEPARATORS[parts[-1]], compression
+
+
+def open_upload(contents, filename):
+    """
+    Open an upload as a buffered binary stream, decompressing on the fly.
+
+    Returns:
+    - tuple: (stream, separator)
+    """
+    sep, compression = split_filename(filename)
+    stream = io.BufferedReader(Base64Stream(contents), buffer_size=2 ** 20)
+    if compression is not None:
+        stream = COMPRESSIONS[compression](fileobj=stream, mode='rb')
+    return stream, sep
+
+
+class _MatrixBuffer:
+    """
+    Growable row buffer for the numeric part of a count matrix.
+    """
+
+    def __init__(self, n_columns, capacity=PARSE_CHUNK_ROWS):
+        self.data = np.empty((capacity, n_columns), dtype=np.int64)
+        self.n_rows = 0
+
+    def append(self, values):
+        values = np.asarray(values)
+        if self.data.dtype.kind == 'i' and values.dtype.kind == 'f':
+            # Only fall back to floats when the values really are fractional (or missing)
+            if np.isfinite(values).all() and (values == np.round(values)).all():
+                values = values.astype(np.int64)
+            else:
+                self.data = self.data.astype(np.float64)
+        elif values.dtype.kind not in 'iufb':
+            values = values.astype(np.float64)
+            self.data = self.data.astype(np.float64)
+
+        end = self.n_rows + values.shape[0]
+        if end > self.data.shape[0]:
+            grown = np.empty((max(end, 2 * self.data.shape[0]), self.data.shape[1]), dtype=self.data.dtype)
+            grown[:self.n_rows] = self.data[:self.n_rows]
+            self.data = grown
+        self.data[self.n_rows:end] = values
+        self.n_rows = end
+
+    def result(self):
+        return self.data[:self.n_rows]
+
+
+def _assemble(index, columns, numeric_columns, buffer, other_values):
+    df = pd.DataFrame(buffer.result(), index=pd.Index(index), columns=numeric_columns)
+    for position, column in enumerate(columns):
+        if column in other_values:
+            df.insert(position, column, other_values[column])
+    return df
+
+
+def _check_header(names):
+    # Duplicate sample names would be renamed (pandas) or mixed up (pyarrow), refuse them
+    duplicates = sorted({str(name) for name in names if list(names).count(name) > 1})
+    if duplicates:
+        raise ValueError(f'Duplicate column names in the uploaded file: {", ".join(duplicates)}')
+
+
+def _read_header(contents, filename):
+    # Column names as written in the file, before the parsers rename duplicates. Tables written
+    # by R with row names have no name for the index column, their header has one field less
+    # than the rows, an empty index name is put first so both parsers see the same columns.
+    stream, sep = open_upload(contents, filename)
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    rows = list(itertools.islice(csv.reader(text, delimiter=sep), 2))
+    if not rows or not any(rows[0]):
+        raise ValueError(f'The uploaded file {filename} is empty')
+    header = rows[0]
+    if len(rows) == 2 and len(rows[1]) == len(header) + 1:
+        header = [''] + header
+    return header
+
+
+def _read_counts_arrow(contents, filename, header):
+    stream, sep = open_upload(contents, filename)
+    reader = pa_csv.open_csv(
+        stream,
+        read_options=pa_csv.ReadOptions(use_threads=True, block_size=ARROW_BLOCK_SIZE,
+                                        column_names=header, skip_rows=1),
+        parse_options=pa_csv.ParseOptions(delimiter=sep),
+        convert_options=pa_csv.ConvertOptions(strings_can_be_null=True))
+
+    names = reader.schema.names
+    index_name, columns = names[0], names[1:]
+    numeric_columns = [c for c in columns
+                       if pa.types.is_integer(reader.schema.field(c).type)
+                       or pa.types.is_floating(reader.schema.field(c).type)]
+    buffer = _MatrixBuffer(len(numeric_columns))
+    index = []
+    other_values = {c: [] for c in columns if c not in numeric_columns}
+
+    for batch in reader:
+        index.extend(batch.column(0).to_pylist())
+        if numeric_columns:
+            block = np.column_stack([batch.column(names.index(c)).to_numpy(zero_copy_only=False)
+                                     for c in numeric_columns])
+            buffer.append(block)
+        for c in other_values:
+            other_values[c].extend(batch.column(names.index(c)).to_pylist())
+
+    df = _assemble(index, columns, numeric_columns, buffer, other_values)
+    df.index.name = index_name or None
+    return df
+
+
+def _read_counts_pandas(contents, filename, header):
+    stream, sep = open_upload(contents, filename)
+    buffer = None
+    index = []
+    other_values = {}
+
+    for chunk in pd.read_csv(stream, sep=sep, header=0, names=header, index_col=0, chunksize=PARSE_CHUNK_ROWS):
+        if buffer is None:
+            columns = list(chunk.columns)
+            numeric_columns = list(chunk.select_dtypes(include=[np.number]).columns)
+            other_values = {c: [] for c in columns if c not in numeric_columns}
+            buffer = _MatrixBuffer(len(numeric_columns))
+            index_name = chunk.index.name
+        index.extend(chunk.index.tolist())
+        buffer.append(chunk[numeric_columns].to_numpy())
+        for c in other_values:
+            other_values[c].extend(chunk[c].tolist())
+
+    if buffer is None:
+        return pd.DataFrame()
+    df = _assemble(index, columns, numeric_columns, buffer, other_values)
+    df.index.name = index_name or None
+    return df
+
+
+def read_counts_upload(contents, filename):
+    """
+    Parse an uploaded count matrix (genes x samples) with the first column as index.
+
+    Numeric columns are written batch by batch into one integer matrix, which is
+    widened to floats only if the file contains fractional or missing values.
+
+    Parameters:
+    - contents (str): The 'contents' property of dcc.Upload.
+    - filename (str): The uploaded file name, used for separator and compression.
+
+    Returns:
+    - pd.DataFrame: The count matrix.
+
+    Raises:
+    - ValueError: For an unknown extension, an empty file or duplicate column names.
+    """
+    header = _read_header(contents, filename)
+    _check_header(header[1:])
+    if pa_csv is not None:
+        try:
+            return _read_counts_arrow(contents, filename, header)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            # Type inference on the first block can fail for mixed columns, retry with pandas
+            logging.info('pyarrow could not parse %s (%s), using the pandas parser', filename, e)
+    try:
+        return _read_counts_pandas(contents, filename, header)
+    except pd.errors.EmptyDataError:
+        raise ValueError(f'The uploaded file {filename} is empty')
+
+
+def read_table_upload(contents, filename):
+    """
+    Parse an uploaded sample information table with the first column as index.
+
+    Returns:
+    - pd.DataFrame: The table with pandas' usual dtype inference.
+
+    Raises:
+    - ValueError: For an unknown extension, an empty file or duplicate column names.
+    """
+    header = _read_header(contents, filename)
+    _check_header(header)
+    stream, sep = open_upload(contents, filename)
+    if pa_csv is not None:
+        try:
+            # Empty fields are missing values, as with pandas
+            table = pa_csv.read_csv(stream,
+                                    read_options=pa_csv.ReadOptions(use_threads=True, column_names=header,
+                                                                    skip_rows=1),
+                                    parse_options=pa_csv.ParseOptions(delimiter=sep),
+                                    convert_options=pa_csv.ConvertOptions(strings_can_be_null=True))
+            df = table.to_pandas()
+            df = df.set_index(df.columns[0])
+            df.index.name = df.index.name or None
+            return df
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            logging.info('pyarrow could not parse %s (%s), using the pandas parser', filename, e)
+            stream, sep = open_upload(contents, filename)
+    df = pd.read_csv(stream, sep=sep, header=0, names=header, index_col=0)
+    df.index.name = df.index.name or None
+    return df
@@ -0,0 +1,180 @@
+# data_store.py
+
+#Server-side storage for uploaded tables. Callbacks only pass a small handle
+#through dcc.Store, the frames themselves stay on the server in binary form.
+
+import os
+import uuid
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from functions.safe_io import atomic_path
+
+DATA_STORE_DIR = os.path.join('data', 'sessions')
+
+# Bytes of frames (uploads and artifacts) kept in memory per worker process, least recently used go first
+MEMORY_BYTES = int(float(os.environ.get('RNALYS_MEMORY_CACHE_MB', '256')) * 2 ** 20)
+
+# key -> (frame, (mtime_ns, size) of its file, bytes)
+_memory = OrderedDict()
+_memory_bytes = 0
+_memory_lock = threading.Lock()
+
+
+def new_session_id():
+    """
+    Generate an identifier used to group the uploads of one browser session.
+    """
+    return uuid.uuid4().hex
+
+
+def _dataset_path(session_id, dataset_id, kind):
+    return os.path.join(DATA_STORE_DIR, session_id, f'{kind}_{dataset_id}.pkl')
+
+
+def _file_version(path):
+    # Changes when the file is replaced, e.g. by another worker, or is gone (None)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _forget(key):
+    global _memory_bytes
+    entry = _memory.pop(key, None)
+    if entry is not None:
+        _memory_bytes -= entry[2]
+
+
+def _remember(key, df, path):
+    global _memory_bytes
+    nbytes = int(df.memory_usage(index=True, deep=True).sum())
+    with _memory_lock:
+        _forget(key)
+        if nbytes > MEMORY_BYTES:
+            return
+        _memory[key] = (df, _file_version(path), nbytes)
+        _memory_bytes += nbytes
+        while _memory_bytes > MEMORY_BYTES:
+            _forget(next(iter(_memory)))
+
+
+def _recall(key, path):
+    # The copy in memory is only used while its file is unchanged
+    version = _file_version(path)
+    with _memory_lock:
+        entry = _memory.get(key)
+        if entry is None:
+            return None
+        if entry[1] != version:
+            _forget(key)
+            return None
+        _memory.move_to_end(key)
+        return entry[0]
+
+
+def save_frame(df, kind, session_id=None):
+    """
+    Store a DataFrame on the server and return a handle for it.
+
+    Parameters:
+    - df (pd.DataFrame): Table to store.
+    - kind (str): Type of table, e.g. 'counts' or 'info'.
+    - session_id (str, optional): Session the table belongs to.
+
+    Returns:
+    - dict: Handle with the dataset id, session id, kind and shape of the table.
+    """
+    session_id = session_id or new_session_id()
+    dataset_id = uuid.uuid4().hex
+    path = _dataset_path(session_id, dataset_id, kind)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_path(path) as tmp_path:
+        df.to_pickle(tmp_path)
+    _remember(dataset_id, df, path)
+
+    return {
+        'dataset_id': dataset_id,
+        'session_id': session_id,
+        'kind': kind,
+        'shape': list(df.shape),
+    }
+
+
+def load_frame(handle):
+    """
+    Load the DataFrame referenced by a handle created with save_frame.
+
+    Returns:
+    - pd.DataFrame or None: The stored table, None if the handle is empty or the file is gone.
+    """
+    if not handle:
+        return None
+
+    dataset_id = handle['dataset_id']
+    path = _dataset_path(handle['session_id'], dataset_id, handle['kind'])
+    df = _recall(dataset_id, path)
+    if df is not None:
+        return df
+
+    if not os.path.isfile(path):
+        return None
+    df = pd.read_pickle(path)
+    _remember(dataset_id, df, path)
+    return df
+
+
+#Artifacts are tables derived from a run (normalized counts, DE tables, ...). They are
+#keyed by the run's file_string so every callback of the run can read them directly.
+
+ARTIFACT_DIR = os.path.join('data', 'generated')
+
+
+def _artifact_path(artifact_id):
+    return os.path.join(ARTIFACT_DIR, f'{artifact_id}.pkl')
+
+
+def put_artifact(file_string, name, df):
+    """
+    Store a table produced by a run and return its artifact id.
+
+    Parameters:
+    - file_string (str): Identifier of the run.
+    - name (str): Name of the table within the run, e.g. 'counts_norm' or 'de_table'.
+    - df (pd.DataFrame): Table to store.
+
+    Returns:
+    - str: Artifact id to put in the intermediate divs.
+    """
+    artifact_id = f'{file_string}_{name}'
+    path = _artifact_path(artifact_id)
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    with atomic_path(path) as tmp_path:
+        df.to_pickle(tmp_path)
+    _remember(artifact_id, df, path)
+    return artifact_id
+
+
+def get_artifact(artifact_id):
+    """
+    Return the table stored under an artifact id, or None if it does not exist.
+
+    The returned frame is shared between callbacks, copy it before modifying it.
+    """
+    if not artifact_id:
+        return None
+
+    path = _artifact_path(artifact_id)
+    df = _recall(artifact_id, path)
+    if df is not None:
+        return df
+
+    if not os.path.isfile(path):
+        return None
+    df = pd.read_pickle(path)
+    _remember(artifact_id, df, path)
+    return df
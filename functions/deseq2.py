@@ -1,81 +1,131 @@
 # deseq2.py
 
-##under construction
-#import numpy as np
-#import pandas as pd
-#from scipy import stats
-#from statsmodels.formula.api import glm
-#import statsmodels.api as sm
+#DESeq2 recreated in python, the Python engine for program='DESeq2'. The GLMs of all
+#genes are fitted together by functions/nb_glm.py. Differences to the R package: no
+#independent filtering or Cook's distance outlier handling in the results.
+import numpy as np
+import pandas as pd
+
+from functions.normalization import size_factors
+from functions.dispersion import estimate_dispersions
+from functions.nb_glm import fit_nb_glm, contrast_wald_test, p_adjust_bh
+from functions.design import (model_matrix, design_variables, factor_levels, contrast_label,
+                              contrast_vector)
+from functions.parallel import map_gene_chunks
 
-#DESeq2 recreated in python
 
 def calculate_size_factors(counts):
     """
     Calculate size factors for normalization using the median-of-ratios method.
     """
-    geometric_means = counts.apply(lambda x: stats.gmean(x + 1), axis=1)
-    ratios = counts.div(geometric_means, axis=0)
-    size_factors = ratios.median()
-    return size_factors
+    return pd.Series(size_factors(counts), index=counts.columns)
+
+def estimate_dispersion(counts, design, size_factors, fit_type='parametric'):
+    """
+    Estimate dispersions with trend fitting and MAP shrinkage, see functions/dispersion.py.
+
+    Parameters:
+    - counts (pd.DataFrame): Counts, genes x samples.
+    - design (pd.DataFrame): Model matrix, samples x coefficients.
+    - size_factors (pd.Series): One size factor per sample.
+    - fit_type (str): Dispersion trend, 'parametric', 'local' or 'mean'.
+
+    Returns:
+    - pd.DataFrame: Per gene baseMean, dispGeneEst, dispFit, dispMAP, dispersion and dispOutlier.
+    """
+    return estimate_dispersions(counts, design, size_factors.to_numpy(), fit_type)
 
-def estimate_dispersion(counts, design, size_factors):
+def fit_glm_nb_contrasts(counts, design, size_factors, dispersions, contrasts):
     """
-    Estimate gene-wise dispersion parameters.
+    Fit the negative binomial GLM of every gene once and test several contrasts.
+
+    Parameters:
+    - counts (pd.DataFrame): Counts, genes x samples.
+    - design (pd.DataFrame): Model matrix, samples x coefficients.
+    - size_factors (pd.Series): One size factor per sample.
+    - dispersions (pd.Series): One dispersion per gene.
+    - contrasts (dict): Name -> coefficient weights.
+
+    Returns:
+    - dict: Name -> DataFrame with log2FoldChange, lfcSE, stat and pvalue per gene.
     """
-    dispersions = {}
-    for gene in counts.index:
-        counts_gene = counts.loc[gene]
-        # Offset by log(size factors)
-        offset = np.log(size_factors)
-        # Fit initial model to get mu
-        data = design.copy()
-        data['counts'] = counts_gene
-        data['offset'] = offset
-        # Fit Poisson model to get initial estimates
-        formula = 'counts ~ ' + ' + '.join(design.columns[1:])  # Adjust as needed
-        poisson_model = glm(formula, data=data, family=sm.families.Poisson(), offset=data['offset']).fit()
-        mu = poisson_model.fittedvalues
-        # Calculate dispersion (alpha)
-        residuals = (counts_gene - mu)**2 - counts_gene
-        alpha = max((residuals / mu**2).mean(), 1e-8)
-        dispersions[gene] = alpha
-    return pd.Series(dispersions)
+    # Blocks of genes are fitted in the DE worker pool
+    fit = map_gene_chunks(fit_nb_glm, {'counts': counts.to_numpy(dtype=np.float64),
+                                       'dispersions': dispersions.reindex(counts.index).to_numpy()},
+                          {'X': design.to_numpy(dtype=np.float64), 'size_factors': size_factors.to_numpy()})
+    results = {}
+    for name, contrast in contrasts.items():
+        log2_fold_change, lfc_se, stat, pvalue = contrast_wald_test(fit['beta'], fit['covariance'], contrast)
+        results[name] = pd.DataFrame({'log2FoldChange': log2_fold_change, 'lfcSE': lfc_se, 'stat': stat,
+                                      'pvalue': pvalue}, index=counts.index)
+    return results
 
 def fit_glm_nb(counts, design, size_factors, dispersions, coef_name):
     """
     Fit a negative binomial GLM for each gene and perform hypothesis testing.
+
+    Parameters:
+    - counts (pd.DataFrame): Counts, genes x samples.
+    - design (pd.DataFrame): Model matrix, samples x coefficients.
+    - size_factors (pd.Series): One size factor per sample.
+    - dispersions (pd.Series): One dispersion per gene.
+    - coef_name (str): Column of design to test.
+
+    Returns:
+    - pd.DataFrame: log2FoldChange, lfcSE, stat and pvalue per gene.
     """
-    results = []
-    for gene in counts.index:
-        counts_gene = counts.loc[gene]
-        # Log-transform size factors for offset
-        offset = np.log(size_factors)
-        # Create dataframe for modeling
-        data = design.copy()
-        data['counts'] = counts_gene
-        data['offset'] = offset
-        # Define the model formula
-        formula = 'counts ~ ' + ' + '.join(design.columns[1:])  # Adjust as needed
-        # Fit the model
-        nb_family = sm.families.NegativeBinomial(alpha=dispersions[gene])
-        model = glm(formula, data=data, family=nb_family, offset=data['offset']).fit()
-        # Extract results for the coefficient of interest
-        if coef_name in model.params:
-            beta = model.params[coef_name]
-            std_err = model.bse[coef_name]
-            wald_stat = beta / std_err
-            p_value = 2 * (1 - stats.norm.cdf(abs(wald_stat)))
-            results.append({
-                'gene': gene,
-                'log2FoldChange': beta / np.log(2),  # Convert from natural log to log2
-                'p_value': p_value
-            })
-        else:
-            # Coefficient not found (e.g., due to collinearity)
-            results.append({
-                'gene': gene,
-                'log2FoldChange': np.nan,
-                'p_value': np.nan
-            })
-    results_df = pd.DataFrame(results).set_index('gene')
-    return results_df
+    coef = (design.columns == coef_name).astype(np.float64)
+    return fit_glm_nb_contrasts(counts, design, size_factors, dispersions, {coef_name: coef})[coef_name]
+
+def _finish_results(res, base_mean):
+    # baseMean, adjusted p-values and the MA table of one comparison
+    res.insert(0, 'baseMean', base_mean)
+    res['padj'] = p_adjust_bh(res['pvalue'])
+    res = res.dropna()
+    ma_table = pd.DataFrame({'mean_norm_counts': res['baseMean'], 'log2FoldChange': res['log2FoldChange']})
+    return res, ma_table
+
+def run_deseq2(counts, meta, design, reference, rowsum, contrasts=None):
+    """
+    Python counterpart of run_DE in run_deseq2.R.
+
+    Genes whose median normalized count is below rowsum are removed, the last variable of
+    the design is tested with its reference level, and rows with missing values are dropped.
+    With contrasts, every (numerator, denominator) pair of levels of the last variable is
+    tested from the same fit and the tables are returned in long format.
+
+    Parameters:
+    - counts (pd.DataFrame): Raw counts, genes x samples.
+    - meta (pd.DataFrame): Sample information, indexed by sample.
+    - design (str): Design formula, e.g. '~ batch + condition'.
+    - reference (str): Reference level of the last design variable.
+    - rowsum (float): Threshold on the median normalized count.
+    - contrasts (list, optional): (numerator, denominator) level pairs.
+
+    Returns:
+    - tuple: (results with baseMean, log2FoldChange, lfcSE, stat, pvalue and padj,
+      MA table with mean_norm_counts and log2FoldChange, dispersion estimates per gene).
+      With contrasts, both tables start with a contrast column.
+    """
+    meta = meta.loc[counts.columns]
+    counts = counts[counts.sum(axis=1) > 0]
+    norm_counts = counts / calculate_size_factors(counts)
+    counts = counts[norm_counts.median(axis=1) >= float(rowsum or 0)]
+
+    X = model_matrix(meta, design, reference or None)
+    sf = calculate_size_factors(counts)
+    dispersions = estimate_dispersion(counts, X, sf)
+    if contrasts is None:
+        res = fit_glm_nb(counts, X, sf, dispersions['dispersion'], X.columns[-1])
+        res, ma_table = _finish_results(res, dispersions['baseMean'])
+        return res, ma_table, dispersions
+
+    variable = design_variables(design)[-1]
+    ref_level = factor_levels(meta[variable], reference or None)[0]
+    weights = {contrast_label(num, den): contrast_vector(X.columns, variable, num, den, ref_level)
+               for num, den in contrasts}
+    tables = [_finish_results(res, dispersions['baseMean'])
+              for res in fit_glm_nb_contrasts(counts, X, sf, dispersions['dispersion'], weights).values()]
+    res = pd.concat([table.assign(contrast=name) for name, (table, _) in zip(weights, tables)])
+    ma_table = pd.concat([table.assign(contrast=name) for name, (_, table) in zip(weights, tables)])
+    return res[['contrast'] + list(res.columns[:-1])], ma_table[['contrast'] + list(ma_table.columns[:-1])], dispersions
@@ -0,0 +1,135 @@
+# design.py
+
+#Design matrices from the R-style formulas typed in the Design field ('~ batch + condition')
+#for the Python DE engines. Only additive main effects are supported. Text columns become
+#treatment-coded factors with alphabetically sorted levels like R's factor(), numeric
+#columns enter as they are. The last variable is the one tested and is always a factor,
+#as in run_deseq2.R. Contrasts between two of its levels are weights on the coefficients,
+#so every comparison can be read from one fit.
+
+import re
+
+import numpy as np
+import pandas as pd
+
+
+def design_variables(design):
+    """
+    Return the variables of a design formula in order, e.g. '~ batch + condition' -> ['batch', 'condition'].
+    """
+    if not design or '~' not in design:
+        raise ValueError(f'Design formula must look like ~ variable1 + variable2, got {design!r}')
+    terms = [term.strip() for term in design.split('~', 1)[1].split('+')]
+    if any(re.search(r'[:*|()]', term) for term in terms):
+        raise ValueError(f'Only additive designs are supported by the Python engine, got {design!r}')
+    variables = [term for term in terms if term and term != '1']
+    if not variables:
+        raise ValueError('No variable found in the design formula.')
+    return variables
+
+
+def factor_levels(values, reference=None):
+    """
+    Levels of a factor, sorted, with reference first when it is given.
+    """
+    levels = sorted(pd.unique(values.astype(str)))
+    if reference is not None:
+        if str(reference) not in levels:
+            raise ValueError(f'Reference {reference!r} is not one of the levels {levels}')
+        levels.remove(str(reference))
+        levels.insert(0, str(reference))
+    return levels
+
+
+def model_matrix(meta, design, reference=None):
+    """
+    Build the model matrix of an additive design.
+
+    Parameters:
+    - meta (pd.DataFrame): Sample information, one row per sample.
+    - design (str): Formula, e.g. '~ batch + condition'.
+    - reference (str, optional): Reference level of the last (tested) variable.
+
+    Returns:
+    - pd.DataFrame: Samples x coefficients. Factor columns are named
+      '<variable>_<level>_vs_<reference level>' like DESeq2's resultsNames.
+
+    Raises:
+    - ValueError: For unknown variables, unsupported formulas or a design that is not full rank.
+    """
+    variables = design_variables(design)
+    missing = [v for v in variables if v not in meta.columns]
+    if missing:
+        raise ValueError(f'Design variables {missing} are not columns of the sample information')
+
+    columns = {'Intercept': np.ones(len(meta))}
+    for variable in variables:
+        values = meta[variable]
+        # The tested variable is always a factor, run_deseq2.R converts it with factor()
+        if pd.api.types.is_numeric_dtype(values) and variable != variables[-1]:
+            columns[variable] = values.to_numpy(dtype=np.float64)
+            continue
+        levels = factor_levels(values, reference if variable == variables[-1] else None)
+        for level in levels[1:]:
+            columns[f'{variable}_{level}_vs_{levels[0]}'] = (values.astype(str) == level).to_numpy(dtype=np.float64)
+
+    X = pd.DataFrame(columns, index=meta.index)
+    if np.linalg.matrix_rank(X.to_numpy()) < X.shape[1]:
+        raise ValueError(f'The design {design} is not full rank, a variable is confounded with another')
+    return X
+
+
+def pairwise_contrasts(levels):
+    """
+    All pairwise comparisons of the levels as (numerator, denominator), every level against
+    the ones before it, so with the reference first it is the denominator of its comparisons.
+    """
+    return [(levels[j], levels[i]) for i in range(len(levels)) for j in range(i + 1, len(levels))]
+
+
+def parse_contrasts(values, levels):
+    """
+    Contrasts chosen in the app, 'all' or labels like 'trt vs ctrl', as (numerator, denominator).
+
+    Raises:
+    - ValueError: For a level that is not in levels.
+    """
+    if 'all' in values:
+        return pairwise_contrasts(levels)
+    contrasts = []
+    for value in values:
+        numerator, denominator = (level.strip() for level in value.split(' vs ', 1))
+        for level in (numerator, denominator):
+            if level not in levels:
+                raise ValueError(f'Contrast level {level!r} is not one of the levels {levels}')
+        if (numerator, denominator) not in contrasts:
+            contrasts.append((numerator, denominator))
+    return contrasts
+
+
+def contrast_label(numerator, denominator):
+    """
+    Name of a contrast, e.g. 'trt_vs_ctrl'.
+    """
+    return f'{numerator}_vs_{denominator}'
+
+
+def contrast_vector(columns, variable, numerator, denominator, reference):
+    """
+    Coefficient weights of numerator - denominator for a factor coded by model_matrix.
+
+    Parameters:
+    - columns (list): Columns of the model matrix.
+    - variable (str): The factor.
+    - numerator, denominator (str): Levels compared.
+    - reference (str): Reference level of the factor.
+
+    Returns:
+    - np.ndarray: One weight per column.
+    """
+    columns = list(columns)
+    vector = np.zeros(len(columns))
+    for level, sign in ((numerator, 1), (denominator, -1)):
+        if level != reference:
+            vector[columns.index(f'{variable}_{level}_vs_{reference}')] += sign
+    return vector
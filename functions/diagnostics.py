@@ -0,0 +1,75 @@
+# diagnostics.py
+
+#Data for the diagnostic plots of a DE run, computed when the diagnostics tab is opened
+#instead of as PDFs in every run. The dispersion plot reads the dispersion table written
+#with the results, the MDS plot is computed here from the counts (limma's plotMDS).
+
+import numpy as np
+import pandas as pd
+
+from functions.edgeR import calc_norm_factors
+
+
+def mds_coordinates(counts, top=500, prior_count=2):
+    """
+    Two-dimensional MDS of the samples from leading log2 fold change distances, the root mean
+    square of the top largest squared differences of each pair of samples (plotMDS with
+    gene.selection='pairwise').
+
+    Genes need a CPM above 1 in at least two samples and the libraries are TMM normalized, as
+    in the edgeR DE run.
+
+    Parameters:
+    - counts (pd.DataFrame): Raw counts, genes x samples.
+    - top (int): Number of genes behind every distance.
+    - prior_count (float): Count added before the log, like edgeR's cpm(log=TRUE).
+
+    Returns:
+    - pd.DataFrame: dim1 and dim2 per sample.
+    """
+    counts = counts[((counts / counts.sum() * 1e6) > 1).sum(axis=1) >= 2]
+    lib_sizes = counts.sum().to_numpy(dtype=np.float64) * calc_norm_factors(counts).to_numpy()
+    # Prior scaled by library size, as edgeR's cpm(log=TRUE)
+    prior = prior_count * lib_sizes / lib_sizes.mean()
+    log_cpm = np.log2((counts.to_numpy(dtype=np.float64) + prior) / (lib_sizes + 2 * prior) * 1e6)
+
+    n = log_cpm.shape[1]
+    top = min(top, len(log_cpm))
+    distance = np.zeros((n, n))
+    for i in range(n - 1):
+        squared = (log_cpm[:, i + 1:] - log_cpm[:, [i]]) ** 2
+        # The top largest squared differences of every pair, without sorting all genes
+        leading = np.partition(squared, len(squared) - top, axis=0)[-top:]
+        distance[i, i + 1:] = distance[i + 1:, i] = np.sqrt(leading.mean(axis=0))
+
+    # Classical scaling of the distances (R's cmdscale)
+    centering = np.eye(n) - 1 / n
+    values, vectors = np.linalg.eigh(-0.5 * centering @ distance ** 2 @ centering)
+    order = np.argsort(values)[::-1][:2]
+    coordinates = vectors[:, order] * np.sqrt(np.maximum(values[order], 0))
+    return pd.DataFrame(coordinates, index=counts.columns, columns=['dim1', 'dim2'])
+
+
+def dispersion_plot_data(dispersions):
+    """
+    Long table for the dispersion plot of an engine's dispersion table: edgeR's BCV plot, the
+    DESeq2 dispersion estimates or the voom mean-variance trend.
+
+    Returns:
+    - tuple: (DataFrame with x, y and estimate columns, x label, y label, whether the axes are log scale)
+    """
+    if 'tagwise.dispersion' in dispersions.columns:
+        columns = {'tagwise.dispersion': 'Tagwise', 'trended.dispersion': 'Trend', 'common.dispersion': 'Common'}
+        x, labels = dispersions['AveLogCPM'], ('Average log CPM', 'Biological coefficient of variation')
+        transform, log_scale = np.sqrt, False
+    elif 'dispGeneEst' in dispersions.columns:
+        columns = {'dispGeneEst': 'Gene-est', 'dispersion': 'Final', 'dispFit': 'Fitted'}
+        x, labels = dispersions['baseMean'], ('Mean of normalized counts', 'Dispersion')
+        transform, log_scale = np.asarray, True
+    else:
+        columns = {'sy': 'Gene', 'trend': 'Trend'}
+        x, labels = dispersions['sx'], ('log2(count size + 0.5)', 'Sqrt(standard deviation)')
+        transform, log_scale = np.asarray, False
+    data = pd.concat([pd.DataFrame({'x': x, 'y': transform(dispersions[column]), 'estimate': name})
+                      for column, name in columns.items() if column in dispersions.columns])
+    return data, labels[0], labels[1], log_scale
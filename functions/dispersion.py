@@ -0,0 +1,274 @@
+# dispersion.py
+
+#Negative binomial dispersion estimation for all genes at once, shared by the Python DESeq2
+#and edgeR engines. The Cox-Reid adjusted profile log-likelihood of every gene is evaluated
+#on a common grid of log dispersions (one vectorized evaluation per grid point), which gives
+#  - gene-wise maximum likelihood estimates (coarse grid, then a fine grid around the maximum,
+#    like DESeq2's fitDispGrid),
+#  - a mean-dispersion trend (parametric, local or mean, DESeq2's fitType),
+#  - MAP estimates with a log-normal prior centred on the trend (DESeq2's estimateDispersionsMAP),
+#  - weighted likelihood empirical Bayes estimates (edgeR's common, trended and tagwise dispersion).
+#The fitted means are held fixed at a GLM fit with a rough dispersion while the dispersion
+#is estimated, as in DESeq2. The gene-wise steps run on blocks of genes through
+#functions/parallel.py.
+
+import numpy as np
+import pandas as pd
+from scipy.special import gammaln, polygamma
+
+from functions.nb_glm import fit_nb_glm
+from functions.normalization import fit_parametric_trend
+from functions.parallel import map_gene_chunks
+
+MIN_DISP = 1e-8
+GRID_SIZE = 30
+FINE_GRID_SIZE = 20
+
+
+def cox_reid_loglik(y, mu, X, alpha):
+    """
+    Cox-Reid adjusted profile log-likelihood of every gene for the dispersions alpha:
+    the log-likelihood minus half the log determinant of X'WX. Terms that do not depend
+    on alpha (log y! and y log mu) are left out, they do not move the maximum.
+    """
+    r = 1 / alpha[:, None]
+    loglik = (gammaln(y + r) - gammaln(r) + r * np.log(r) - (r + y) * np.log(r + mu)).sum(axis=1)
+    w = mu / (1 + alpha[:, None] * mu)
+    xtwx = np.einsum('np,gn,nq->gpq', X, w, X, optimize=True)
+    return loglik - 0.5 * np.linalg.slogdet(xtwx)[1]
+
+
+def _log_range(n_samples):
+    # Search range of DESeq2: minDisp / 10 to max(10, number of samples)
+    return np.log(MIN_DISP / 10), np.log(max(10, n_samples))
+
+
+def _grid_maximum(y, mu, X, log_grid, prior_mean=None, prior_var=None):
+    # Maximize over the grid points (shared, or one row of points per gene) for all genes,
+    # with a normal prior on the log dispersion (one mean per gene) when prior_mean is given
+    log_grid = np.broadcast_to(log_grid, (len(y), log_grid.shape[-1]))
+    values = np.empty(log_grid.shape)
+    for k in range(log_grid.shape[1]):
+        values[:, k] = cox_reid_loglik(y, mu, X, np.exp(log_grid[:, k]))
+        if prior_mean is not None:
+            values[:, k] -= (log_grid[:, k] - prior_mean) ** 2 / (2 * prior_var)
+    best = np.nanargmax(np.where(np.isfinite(values), values, -np.inf), axis=1)
+    return log_grid[np.arange(len(y)), best], values
+
+
+def maximize_dispersion(y, mu, X, prior_mean=None, prior_var=None):
+    """
+    Dispersion maximizing the Cox-Reid adjusted likelihood (plus log prior) of every gene,
+    on a coarse grid and then a fine grid around its maximum.
+
+    Parameters:
+    - y (np.ndarray): Counts, genes x samples.
+    - mu (np.ndarray): Fitted means, genes x samples.
+    - X (np.ndarray): Design matrix, samples x coefficients.
+    - prior_mean (np.ndarray, optional): Mean of the normal prior of the log dispersion, one per gene.
+    - prior_var (float, optional): Variance of that prior.
+
+    Returns:
+    - np.ndarray: One dispersion per gene.
+    """
+    low, high = _log_range(y.shape[1])
+    coarse = np.linspace(low, high, GRID_SIZE)
+    best, _ = _grid_maximum(y, mu, X, coarse, prior_mean, prior_var)
+    step = coarse[1] - coarse[0]
+    fine = best[:, None] + np.linspace(-step, step, FINE_GRID_SIZE)[None, :]
+    best, _ = _grid_maximum(y, mu, X, fine, prior_mean, prior_var)
+    return np.exp(best)
+
+
+def rough_dispersion(y, mu, n_coefficients):
+    """
+    Moment estimate from a fitted Poisson model, the starting value of the GLM fit.
+    """
+    alpha = (((y - mu) ** 2 - y) / mu ** 2).sum(axis=1) / max(y.shape[1] - n_coefficients, 1)
+    return np.clip(alpha, MIN_DISP, max(10, y.shape[1]))
+
+
+def local_trend(means, dispersions, span=0.7, n_points=50):
+    """
+    Local linear regression of log dispersion on log mean with nearest-neighbour tricube
+    weights and the means as prior weights (DESeq2's localDispersionFit uses locfit).
+
+    Returns:
+    - callable: Trend dispersion for an array of means.
+    """
+    use = np.isfinite(dispersions) & (dispersions >= 100 * MIN_DISP) & (means > 0)
+    x, y, w = np.log(means[use]), np.log(dispersions[use]), means[use]
+    if len(x) < 3:
+        raise ValueError('Too few genes with positive dispersion to fit a dispersion trend')
+    points = np.linspace(x.min(), x.max(), n_points)
+    distance = np.abs(x[None, :] - points[:, None])
+    bandwidth = np.maximum(np.quantile(distance, span, axis=1), 1e-8)
+    k = w * np.clip(1 - (distance / bandwidth[:, None]) ** 3, 0, None) ** 3
+    s0, s1, s2 = k.sum(axis=1), (k * x).sum(axis=1), (k * x ** 2).sum(axis=1)
+    t0, t1 = (k * y).sum(axis=1), (k * x * y).sum(axis=1)
+    slope = (s0 * t1 - s1 * t0) / np.maximum(s0 * s2 - s1 ** 2, 1e-12)
+    fitted = (t0 - slope * s1) / s0 + slope * points
+    return lambda m: np.exp(np.interp(np.log(m), points, fitted))
+
+
+def fit_trend(means, dispersions, fit_type='parametric'):
+    """
+    Fit the mean-dispersion trend, DESeq2's fitType. 'parametric' falls back to 'local'
+    when the parametric fit fails, as in DESeq2.
+
+    Returns:
+    - tuple: (fit type used, callable giving the trend dispersion for an array of means)
+    """
+    if fit_type == 'parametric':
+        try:
+            asympt_disp, extra_pois = fit_parametric_trend(means, dispersions, MIN_DISP)
+            return 'parametric', lambda m: asympt_disp + extra_pois / m
+        except ValueError as e:
+            print('Parametric dispersion trend failed, using a local fit instead:', e)
+            fit_type = 'local'
+    if fit_type == 'local':
+        return 'local', local_trend(means, dispersions)
+    if fit_type == 'mean':
+        use = dispersions >= 100 * MIN_DISP
+        sorted_disp = np.sort(dispersions[use])
+        trim = int(0.001 * len(sorted_disp))
+        mean_disp = sorted_disp[trim:len(sorted_disp) - trim].mean()
+        return 'mean', lambda m: np.full(np.shape(m), mean_disp)
+    raise ValueError(f'Unknown dispersion fit type {fit_type!r}')
+
+
+def prior_variance(log_residuals, n_samples, n_coefficients):
+    """
+    Variance of the log-normal dispersion prior: the squared MAD of the log residuals from
+    the trend minus their expected sampling variance, at least 0.25 (DESeq2's dispPriorVar).
+
+    Returns:
+    - tuple: (prior variance, variance of the log residuals)
+    """
+    residuals = log_residuals[np.isfinite(log_residuals)]
+    var_log_disp = (1.4826 * np.median(np.abs(residuals - np.median(residuals)))) ** 2
+    df = n_samples - n_coefficients
+    expected = polygamma(1, df / 2) if df > 0 else 0
+    return max(var_log_disp - expected, 0.25), var_log_disp
+
+
+def _gene_wise_chunk(counts, X, size_factors, min_mu):
+    # Fitted means at a rough dispersion and the gene-wise MLEs of a block of genes
+    poisson = fit_nb_glm(counts, X, size_factors, np.zeros(len(counts)), min_mu=min_mu)
+    rough = rough_dispersion(counts, poisson['mu'], X.shape[1])
+    mu = fit_nb_glm(counts, X, size_factors, rough, min_mu=min_mu)['mu']
+    return {'mu': mu, 'dispersion': maximize_dispersion(counts, mu, X)}
+
+
+def _map_chunk(counts, mu, prior_mean, X, prior_var):
+    return maximize_dispersion(counts, mu, X, prior_mean, prior_var)
+
+
+def _loglik_chunk(counts, X, size_factors, grid):
+    # Cox-Reid likelihood of a block of genes on the grid, means fitted at a rough dispersion
+    poisson = fit_nb_glm(counts, X, size_factors, np.zeros(len(counts)), min_mu=1e-8)
+    rough = rough_dispersion(counts, poisson['mu'], X.shape[1])
+    mu = fit_nb_glm(counts, X, size_factors, rough, min_mu=1e-8)['mu']
+    return _grid_maximum(counts, mu, X, grid)[1]
+
+
+def estimate_dispersions(counts, X, size_factors, fit_type='parametric'):
+    """
+    DESeq2's estimateDispersions: gene-wise estimates, trend and MAP shrinkage.
+
+    Parameters:
+    - counts (pd.DataFrame): Counts, genes x samples.
+    - X (pd.DataFrame or np.ndarray): Design matrix, samples x coefficients.
+    - size_factors (np.ndarray): One size factor per sample.
+    - fit_type (str): 'parametric', 'local' or 'mean'.
+
+    Returns:
+    - pd.DataFrame: Per gene baseMean, dispGeneEst, dispFit, dispMAP, dispersion (the final
+      value) and dispOutlier, the data of DESeq2's plotDispEsts.
+    """
+    y = counts.to_numpy(dtype=np.float64)
+    X = np.asarray(X, dtype=np.float64)
+    sf = np.asarray(size_factors, dtype=np.float64)
+    n_samples, n_coef = X.shape
+    max_disp = max(10, n_samples)
+    base_mean = (y / sf).mean(axis=1)
+
+    gene_wise = map_gene_chunks(_gene_wise_chunk, {'counts': y}, {'X': X, 'size_factors': sf, 'min_mu': 0.5})
+    mu = gene_wise['mu']
+    disp_gene = np.clip(gene_wise['dispersion'], MIN_DISP, max_disp)
+
+    _, trend = fit_trend(base_mean, disp_gene, fit_type)
+    disp_fit = trend(base_mean)
+    use = disp_gene >= 100 * MIN_DISP
+    prior_var, var_log_disp = prior_variance(np.log(disp_gene[use]) - np.log(disp_fit[use]), n_samples, n_coef)
+
+    log_fit = np.log(disp_fit)
+    disp_map = map_gene_chunks(_map_chunk, {'counts': y, 'mu': mu, 'prior_mean': log_fit},
+                               {'X': X, 'prior_var': prior_var})
+    disp_map = np.clip(disp_map, MIN_DISP, max_disp)
+    # Genes far above the trend keep their own estimate
+    outlier = np.log(disp_gene) > log_fit + 2 * np.sqrt(var_log_disp)
+    return pd.DataFrame({'baseMean': base_mean, 'dispGeneEst': disp_gene, 'dispFit': disp_fit,
+                         'dispMAP': disp_map, 'dispersion': np.where(outlier, disp_gene, disp_map),
+                         'dispOutlier': outlier}, index=counts.index)
+
+
+def _moving_average(values, window):
+    # Centred moving average of the rows, shrinking at the ends
+    cumulative = np.vstack([np.zeros((1, values.shape[1])), np.cumsum(values, axis=0)])
+    rows = np.arange(len(values))
+    lower = np.clip(rows - window // 2, 0, len(values))
+    upper = np.clip(rows + window // 2 + 1, 0, len(values))
+    return (cumulative[upper] - cumulative[lower]) / (upper - lower)[:, None]
+
+
+def _parabolic_maximum(grid, values):
+    # Grid maximum of every row refined by a parabola through it and its neighbours
+    best = np.clip(np.argmax(values, axis=1), 1, len(grid) - 2)
+    rows = np.arange(len(values))
+    left, centre, right = values[rows, best - 1], values[rows, best], values[rows, best + 1]
+    curvature = left - 2 * centre + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.where(curvature < 0, 0.5 * (left - right) / curvature, 0)
+    return grid[best] + np.clip(shift, -1, 1) * (grid[1] - grid[0])
+
+
+def weighted_likelihood_eb(counts, X, offsets, prior_df=10, span=None):
+    """
+    edgeR's estimateDisp: common, trended and tagwise dispersions by weighted likelihood
+    empirical Bayes. The tagwise likelihood of a gene is its own plus prior_df / residual df
+    times the average likelihood of the genes of similar abundance.
+
+    Parameters:
+    - counts (pd.DataFrame): Counts, genes x samples.
+    - X (pd.DataFrame or np.ndarray): Design matrix, samples x coefficients.
+    - offsets (np.ndarray): Effective library sizes (library size x norm factor), one per sample.
+    - prior_df (float): Prior degrees of freedom.
+    - span (float, optional): Fraction of genes averaged for the trend, edgeR's default if not given.
+
+    Returns:
+    - pd.DataFrame: Per gene AveLogCPM, common.dispersion, trended.dispersion and tagwise.dispersion.
+    """
+    y = counts.to_numpy(dtype=np.float64)
+    X = np.asarray(X, dtype=np.float64)
+    lib_size = np.asarray(offsets, dtype=np.float64)
+    n_genes, (n_samples, n_coef) = len(y), X.shape
+    ave_log_cpm = np.log2((y / lib_size * 1e6 + 0.5).mean(axis=1))
+
+    # Offsets relative to their geometric mean, the fitted means are the same
+    scaled = lib_size / np.exp(np.log(lib_size).mean())
+    # edgeR searches dispersions from 1e-4 up
+    grid = np.linspace(np.log(1e-4), _log_range(n_samples)[1], GRID_SIZE)
+    loglik = map_gene_chunks(_loglik_chunk, {'counts': y}, {'X': X, 'size_factors': scaled, 'grid': grid})
+
+    common = np.exp(_parabolic_maximum(grid, loglik.sum(axis=0)[None, :])[0])
+    if span is None:
+        span = 1.0 if n_genes <= 50 else 0.25 + 0.75 * (50 / n_genes) ** 0.5
+    order = np.argsort(ave_log_cpm, kind='stable')
+    shared = np.empty_like(loglik)
+    shared[order] = _moving_average(loglik[order], max(int(span * n_genes), 1))
+    trended = np.exp(_parabolic_maximum(grid, shared))
+    prior_n = prior_df / max(n_samples - n_coef, 1)
+    tagwise = np.exp(_parabolic_maximum(grid, loglik + prior_n * shared))
+    return pd.DataFrame({'AveLogCPM': ave_log_cpm, 'common.dispersion': common,
+                         'trended.dispersion': trended, 'tagwise.dispersion': tagwise}, index=counts.index)
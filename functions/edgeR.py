@@ -1,171 +1,376 @@
 # edgeR.py
 
-#under construction
-#import numpy as np
-#import pandas as pd
-#from scipy import stats
-#from statsmodels.formula.api import glm
-#import statsmodels.api as sm
-
-
-#EdgeR recreated in python
-
-def calc_norm_factors(counts):
-    """
-    Calculate normalization factors using the TMM method.
-    """
-    # Reference sample (use the sample with median library size)
-    lib_sizes = counts.sum()
-    ref_column = counts.columns[np.argmin(abs(lib_sizes - np.median(lib_sizes)))]
-    ref_counts = counts[ref_column]
-
-    norm_factors = {}
-    for sample in counts.columns:
-        if sample == ref_column:
-            norm_factors[sample] = 1.0
-            continue
-        test_counts = counts[sample]
-        log_ratios = np.log2((test_counts + 1) / (ref_counts + 1))
-        abs_log_ratios = np.abs(log_ratios)
-        sum_counts = test_counts + ref_counts
-
-        # Exclude genes with low counts or extreme log ratios
-        valid = (sum_counts > 0) & (abs_log_ratios < np.log2(10))
-        trimmed = log_ratios[valid]
-        # Trim the log ratios (e.g., remove top and bottom 30%)
-        trim_fraction = 0.3
-        lower = trimmed.quantile(trim_fraction)
-        upper = trimmed.quantile(1 - trim_fraction)
-        trimmed = trimmed[(trimmed >= lower) & (trimmed <= upper)]
-        # Compute the mean of trimmed log ratios
-        norm_factors[sample] = 2 ** (trimmed.mean())
-    # Normalize so that the product of norm factors equals 1
-    scaling_factor = np.prod(list(norm_factors.values())) ** (1 / len(norm_factors))
-    norm_factors = {k: v / scaling_factor for k, v in norm_factors.items()}
-    return pd.Series(norm_factors)
+#EdgeR recreated in python, the Python engine for program='edgeR'. TMM normalization and the
+#GLM likelihood ratio test work on all samples and genes at once, the GLMs are fitted by
+#functions/nb_glm.py and the dispersions estimated by functions/dispersion.py.
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.linalg import null_space
+from scipy.special import betaln, ndtri_exp
+
+from functions.design import contrast_label, contrast_vector, design_variables, factor_levels, model_matrix
+from functions.dispersion import MIN_DISP, weighted_likelihood_eb
+from functions.nb_glm import fit_nb_glm, p_adjust_bh
+from functions.parallel import map_gene_chunks
+
+def calc_norm_factors(counts, logratio_trim=0.3, sum_trim=0.05):
+    """
+    Calculate normalization factors using the TMM method (edgeR's calcNormFactors).
+
+    The reference is the sample whose upper quartile is closest to the mean upper quartile.
+    The log ratios (M) and mean log expressions (A) of all samples against it are ranked
+    column-wise in one pass, genes in the central 40% of M and 90% of A are kept and the
+    factor is their precision-weighted mean M. The factors have a geometric mean of 1.
+
+    Parameters:
+    - counts (pd.DataFrame): Counts, genes x samples.
+    - logratio_trim (float): Fraction of M values trimmed at each end.
+    - sum_trim (float): Fraction of A values trimmed at each end.
+
+    Returns:
+    - pd.Series: One normalization factor per sample.
+    """
+    values = counts.to_numpy(dtype=np.float64)
+    lib_sizes = values.sum(axis=0)
+    upper_quartiles = np.quantile(values / lib_sizes, 0.75, axis=0)
+    ref_column = np.argmin(np.abs(upper_quartiles - upper_quartiles.mean()))
+    ref, ref_lib = values[:, [ref_column]], lib_sizes[ref_column]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_obs, log_ref = np.log2(values / lib_sizes), np.log2(ref / ref_lib)
+        m_values = log_obs - log_ref
+        a_values = (log_obs + log_ref) / 2
+        variances = (lib_sizes - values) / lib_sizes / values + (ref_lib - ref) / ref_lib / ref
+    finite = np.isfinite(m_values) & np.isfinite(a_values)
+    m_values, a_values = np.where(finite, m_values, np.nan), np.where(finite, a_values, np.nan)
+
+    # Ranks per sample with ties averaged, genes with a zero in the pair are left out
+    m_ranks = pd.DataFrame(m_values).rank(method='average').to_numpy()
+    a_ranks = pd.DataFrame(a_values).rank(method='average').to_numpy()
+    n = finite.sum(axis=0)
+    lo_m, lo_a = np.floor(n * logratio_trim) + 1, np.floor(n * sum_trim) + 1
+    keep = ((m_ranks >= lo_m) & (m_ranks <= n + 1 - lo_m) & (a_ranks >= lo_a) & (a_ranks <= n + 1 - lo_a))
+
+    weights = np.where(keep, 1 / np.where(keep, variances, 1), 0)
+    log_factors = (weights * np.where(keep, m_values, 0)).sum(axis=0) / weights.sum(axis=0)
+    # A sample identical to the reference has no usable genes left after trimming
+    log_factors = np.where(np.isfinite(log_factors), log_factors, 0)
+    factors = 2 ** log_factors
+    return pd.Series(factors / np.exp(np.log(factors).mean()), index=counts.columns)
+
+def estimate_disp(counts, groups, norm_factors, prior_df=10):
+    """
+    Estimate common, trended and tagwise dispersions of a one-way layout for all genes
+    at once (edgeR's estimateDisp), see functions/dispersion.py.
+
+    Parameters:
+    - counts (pd.DataFrame): Counts, genes x samples.
+    - groups (array-like): Group of every sample.
+    - norm_factors (pd.Series): TMM normalization factor of every sample.
+    - prior_df (float): Prior degrees of freedom of the tagwise shrinkage.
+
+    Returns:
+    - pd.DataFrame: Per gene AveLogCPM, common.dispersion, trended.dispersion and tagwise.dispersion.
+    """
+    X = model_matrix(pd.DataFrame({'group': np.asarray(groups)}, index=counts.columns), '~ group')
+    lib_sizes = counts.sum().to_numpy(dtype=np.float64) * np.asarray(norm_factors, dtype=np.float64)
+    return weighted_likelihood_eb(counts, X, lib_sizes, prior_df)
 
 def estimate_common_dispersion(counts, groups, norm_factors):
     """
     Estimate common dispersion across all genes.
     """
-    lib_sizes = counts.sum()
-    normed_lib_sizes = lib_sizes * norm_factors
-    normed_counts = counts.div(norm_factors, axis=1)
-
-    group_labels = np.unique(groups)
-    if len(group_labels) != 2:
-        raise ValueError("Common dispersion estimation is implemented for two groups only.")
-
-    group1 = counts.columns[groups == group_labels[0]]
-    group2 = counts.columns[groups == group_labels[1]]
-
-    dispersions = []
-    for gene in counts.index:
-        y1 = normed_counts.loc[gene, group1]
-        y2 = normed_counts.loc[gene, group2]
-        mean1 = y1.mean()
-        mean2 = y2.mean()
-        var1 = y1.var()
-        var2 = y2.var()
-        # Pooled variance estimate
-        pooled_var = ((len(y1) - 1) * var1 + (len(y2) - 1) * var2) / (len(y1) + len(y2) - 2)
-        if mean1 > 0 and mean2 > 0:
-            dispersion = (pooled_var - (mean1 + mean2) / 2) / ((mean1 + mean2) / 2) ** 2
-            dispersions.append(dispersion)
-    common_dispersion = np.median(dispersions)
-    return max(common_dispersion, 1e-8)  # Avoid negative or zero dispersion
-
-def estimate_tagwise_dispersion(counts, groups, norm_factors, common_dispersion):
-    """
-    Estimate tagwise (gene-wise) dispersion.
-    """
-    # For simplicity, we'll shrink gene-wise dispersions towards the common dispersion
-    tagwise_dispersion = {}
-    for gene in counts.index:
-        y = counts.loc[gene]
-        lib_sizes = counts.sum()
-        normed_lib_sizes = lib_sizes * norm_factors
-        mu = y.sum() / normed_lib_sizes.sum() * normed_lib_sizes
-        variance = mu + mu ** 2 * common_dispersion
-        residual = (y - mu) ** 2 - variance
-        dispersion = (residual.sum()) / (mu ** 2).sum()
-        # Shrink towards common dispersion
-        dispersion = 0.1 * dispersion + 0.9 * common_dispersion
-        tagwise_dispersion[gene] = max(dispersion, 1e-8)
-    return pd.Series(tagwise_dispersion)
-
-def exact_test(counts, groups, norm_factors, dispersions):
-    """
-    Perform exact tests for differential expression between two groups.
-    """
-    group_labels = np.unique(groups)
-    if len(group_labels) != 2:
+    return estimate_disp(counts, groups, norm_factors)['common.dispersion'].iloc[0]
+
+def estimate_tagwise_dispersion(counts, groups, norm_factors, prior_df=10):
+    """
+    Estimate tagwise (gene-wise) dispersion, shrunk towards the abundance trend.
+    """
+    return estimate_disp(counts, groups, norm_factors, prior_df)['tagwise.dispersion']
+
+def _group_abundance(y, lib_sizes, dispersions):
+    # Log abundance per unit library size of every gene in one group (edgeR's mglmOneGroup)
+    X = np.ones((y.shape[1], 1))
+    return fit_nb_glm(y, X, lib_sizes, dispersions, min_mu=1e-8)['beta'][:, 0]
+
+def q2q_nbinom(x, input_mean, output_mean, dispersions):
+    """
+    Move counts from negative binomial distributions with input_mean to the same quantiles
+    of ones with output_mean, averaging a normal and a gamma approximation (edgeR's q2qnbinom).
+    """
+    input_mean = np.where(input_mean < 1e-14, input_mean + 0.25, input_mean)
+    output_mean = np.where(output_mean < 1e-14, output_mean + 0.25, output_mean)
+    ri, ro = 1 + dispersions * input_mean, 1 + dispersions * output_mean
+    upper = x >= input_mean
+    sign = np.where(upper, -1, 1)
+    # Tail probabilities on the side of the mean, the normal ones on the log scale like edgeR
+    sd_in, sd_out = np.sqrt(input_mean * ri), np.sqrt(output_mean * ro)
+    log_p_norm = np.where(upper, stats.norm.logsf(x, input_mean, sd_in), stats.norm.logcdf(x, input_mean, sd_in))
+    q_norm = output_mean + sign * sd_out * ndtri_exp(log_p_norm)
+    x, shape_in, shape_out = np.broadcast_arrays(x, input_mean / ri, output_mean / ro)
+    ri, ro = np.broadcast_arrays(ri, ro)
+    q_gamma = np.empty(x.shape)
+    for tail, probability, quantile in ((upper, stats.gamma.sf, stats.gamma.isf),
+                                        (~upper, stats.gamma.cdf, stats.gamma.ppf)):
+        p_gamma = probability(x[tail], shape_in[tail], scale=ri[tail])
+        q_gamma[tail] = quantile(p_gamma, shape_out[tail], scale=ro[tail])
+    # Gamma tails beyond double precision only have the normal quantile
+    q_gamma = np.where(np.isfinite(q_gamma), q_gamma, q_norm)
+    return (q_norm + q_gamma) / 2
+
+def equalize_lib_sizes(counts, groups, norm_factors, dispersions):
+    """
+    Quantile-adjusted pseudo-counts for a common library size, the geometric mean of the
+    effective library sizes (edgeR's equalizeLibSizes).
+
+    Returns:
+    - pd.DataFrame: Pseudo-counts, genes x samples.
+    """
+    y = counts.to_numpy(dtype=np.float64)
+    groups = np.asarray(groups)
+    lib_sizes = _effective_lib_sizes(counts, norm_factors)
+    dispersions = np.asarray(dispersions, dtype=np.float64)
+    input_mean, output_mean = np.empty_like(y), np.empty_like(y)
+    for group in np.unique(groups):
+        in_group = groups == group
+        abundance = np.exp(_group_abundance(y[:, in_group], lib_sizes[in_group], dispersions))
+        input_mean[:, in_group] = abundance[:, None] * lib_sizes[in_group]
+        # The scaled library sizes have a geometric mean of 1
+        output_mean[:, in_group] = abundance[:, None]
+    pseudo = q2q_nbinom(y, input_mean, output_mean, dispersions[:, None])
+    return pd.DataFrame(np.maximum(pseudo, 0), index=counts.index, columns=counts.columns)
+
+def _beta_binomial_cdf(x, size, a, b, max_cells=2 ** 22):
+    # P(X <= x) for X ~ BetaBinomial(size, a, b), one table per distinct (size, a, b) row shared
+    # by every gene that uses it. Tables are built in blocks of similar length.
+    keys, inverse = np.unique(np.column_stack([size, a, b]), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    length = np.zeros(len(keys), dtype=np.int64)
+    np.maximum.at(length, inverse, x + 1)
+    cdf_at_x = np.empty(len(x))
+    # Blocks of keys whose tables need at most 2^k entries
+    block = np.ceil(np.log2(length)).astype(int)
+    for k in np.unique(block):
+        rows = np.flatnonzero(block == k)
+        width = 2 ** k
+        for chunk in np.array_split(rows, max(1, len(rows) * width // max_cells)):
+            n, alpha, beta = (keys[chunk, j][:, None] for j in range(3))
+            i = np.arange(width - 1)[None, :]
+            # pmf(i + 1) / pmf(i) = (n - i) (i + alpha) / ((i + 1) (n - i - 1 + beta)), from pmf(0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                log_ratio = np.log((n - i) * (i + alpha) / ((i + 1) * (n - i - 1 + beta)))
+            log_pmf = np.cumsum(np.hstack([betaln(alpha, n + beta) - betaln(alpha, beta), log_ratio]), axis=1)
+            cdf = np.cumsum(np.where(np.arange(width)[None, :] <= n, np.exp(log_pmf), 0), axis=1)
+            position = np.full(len(keys), -1)
+            position[chunk] = np.arange(len(chunk))
+            genes = np.flatnonzero(position[inverse] >= 0)
+            cdf_at_x[genes] = cdf[position[inverse[genes]], x[genes]]
+    return cdf_at_x
+
+def _exact_test_beta_approx(s1, s2, n1, n2, dispersions):
+    # Beta approximation of the exact test for large counts (edgeR's exactTestBetaApprox)
+    s = s1 + s2
+    mu = s / (n1 + n2)
+    alpha1 = n1 * mu / (1 + dispersions * mu)
+    alpha2 = n2 / n1 * alpha1
+    median = stats.beta.ppf(0.5, alpha1, alpha2)
+    pvalues = np.ones(len(s))
+    left = (s1 + 0.5) / s < median
+    right = (s1 - 0.5) / s > median
+    pvalues[left] = 2 * stats.beta.cdf((s1[left] + 0.5) / s[left], alpha1[left], alpha2[left])
+    pvalues[right] = 2 * stats.beta.sf((s1[right] - 0.5) / s[right], alpha1[right], alpha2[right])
+    return np.minimum(pvalues, 1)
+
+def exact_test_double_tail(s1, s2, n1, n2, dispersions, big_count=900, dispersion_bin=0.01):
+    """
+    Two-sided conditional exact test of the group totals s1 and s2 (edgeR's exactTestDoubleTail).
+
+    Given the total s, the count of a group follows a beta-binomial distribution with
+    shapes n1 / dispersion and n2 / dispersion, and the p-value is twice the tail on the side
+    of the smaller count. The tables are shared by genes with the same total and dispersion
+    bin (dispersion_bin on the log scale). Genes with both totals above big_count use a beta
+    approximation.
+
+    Returns:
+    - np.ndarray: One p-value per gene.
+    """
+    s1, s2 = np.round(s1).astype(np.int64), np.round(s2).astype(np.int64)
+    dispersions = np.exp(np.round(np.log(np.maximum(dispersions, MIN_DISP)) / dispersion_bin) * dispersion_bin)
+    s = s1 + s2
+    mu1 = n1 * s / (n1 + n2)
+    pvalues = np.ones(len(s))
+
+    big = (s1 > big_count) & (s2 > big_count)
+    if big.any():
+        pvalues[big] = _exact_test_beta_approx(s1[big], s2[big], n1, n2, dispersions[big])
+    left, right = (s1 < mu1) & ~big, (s1 > mu1) & ~big
+    tested = left | right
+    if tested.any():
+        # Tail of the smaller side: group 1 on the left, group 2 on the right
+        x = np.where(left, s1, s2)[tested]
+        a = np.where(left, n1, n2)[tested] / dispersions[tested]
+        b = np.where(left, n2, n1)[tested] / dispersions[tested]
+        pvalues[tested] = 2 * _beta_binomial_cdf(x, s[tested], a, b)
+    return np.minimum(pvalues, 1)
+
+def exact_test(counts, groups, norm_factors, dispersions, pair=None, prior_count=0.125, big_count=900):
+    """
+    Exact tests for differential expression between two groups (edgeR's exactTest), for all
+    genes at once on quantile-adjusted pseudo-counts.
+
+    Parameters:
+    - counts (pd.DataFrame): Counts, genes x samples.
+    - groups (array-like): Group of every sample.
+    - norm_factors (pd.Series): Normalization factor of every sample.
+    - dispersions (pd.Series or np.ndarray): One dispersion per gene.
+    - pair (list, optional): [reference, other] groups, the sorted groups if not given.
+    - prior_count (float): Count added before computing the log fold changes.
+    - big_count (int): Totals above which the beta approximation is used.
+
+    Returns:
+    - pd.DataFrame: logFC (other vs reference) and PValue per gene.
+    """
+    groups = np.asarray(groups).astype(str)
+    pair = list(pair) if pair is not None else sorted(np.unique(groups))
+    if len(np.unique(groups)) != 2 or len(pair) != 2:
         raise ValueError("Exact test is implemented for two groups only.")
+    dispersions = np.asarray(dispersions, dtype=np.float64)
+    pseudo = equalize_lib_sizes(counts, groups, norm_factors, dispersions).to_numpy()
+    in_1, in_2 = groups == pair[0], groups == pair[1]
+    pvalues = exact_test_double_tail(pseudo[:, in_1].sum(axis=1), pseudo[:, in_2].sum(axis=1),
+                                     in_1.sum(), in_2.sum(), dispersions, big_count)
+
+    y = counts.to_numpy(dtype=np.float64)
+    lib_sizes = _effective_lib_sizes(counts, norm_factors)
+    prior = prior_count * lib_sizes / lib_sizes.mean()
+    abundance_1 = _group_abundance(y[:, in_1] + prior[in_1], lib_sizes[in_1] + 2 * prior[in_1], dispersions)
+    abundance_2 = _group_abundance(y[:, in_2] + prior[in_2], lib_sizes[in_2] + 2 * prior[in_2], dispersions)
+    return pd.DataFrame({'logFC': (abundance_2 - abundance_1) / np.log(2), 'PValue': pvalues}, index=counts.index)
+
+def _effective_lib_sizes(counts, norm_factors):
+    # Library size x norm factor, relative to the geometric mean (the fitted means are unchanged)
+    lib_sizes = counts.sum().to_numpy(dtype=np.float64) * np.asarray(norm_factors, dtype=np.float64)
+    return lib_sizes / np.exp(np.log(lib_sizes).mean())
+
+def _lrt_chunk(counts, dispersions, X, contrasts, lib_sizes, prior_count):
+    # Full and prior count fits of a block of genes, one reduced fit per contrast
+    full = fit_nb_glm(counts, X, lib_sizes, dispersions, min_mu=1e-8)
+    prior = prior_count * lib_sizes / lib_sizes.mean()
+    shrunk = fit_nb_glm(counts + prior, X, lib_sizes + 2 * prior, dispersions, min_mu=1e-8)
+    lr = np.empty((len(counts), len(contrasts)))
+    for k, contrast in enumerate(contrasts):
+        # The reduced model spans the coefficients orthogonal to the contrast, like glmLRT
+        reduced = fit_nb_glm(counts, X @ null_space(contrast[None, :]), lib_sizes, dispersions, min_mu=1e-8)
+        lr[:, k] = np.maximum(reduced['deviance'] - full['deviance'], 0)
+    return {'logFC': shrunk['beta'] @ contrasts.T / np.log(2), 'LR': lr}
+
+def glm_lrt_contrasts(counts, design, norm_factors, dispersions, contrasts, prior_count=0.125):
+    """
+    Fit the negative binomial GLMs of all genes once and compute a likelihood ratio test for
+    each contrast of the coefficients (edgeR's glmFit and glmLRT with contrast).
+
+    The log fold changes come from a fit with prior_count added to the counts, like edgeR,
+    so genes with zeros in a group get a finite value.
+
+    Parameters:
+    - counts (pd.DataFrame): Counts, genes x samples.
+    - design (pd.DataFrame): Model matrix, samples x coefficients.
+    - norm_factors (pd.Series): Normalization factor of every sample.
+    - dispersions (pd.Series or np.ndarray): One dispersion per gene.
+    - contrasts (dict): Name -> coefficient weights.
+
+    Returns:
+    - dict: Name -> DataFrame with logFC, LR and PValue per gene.
+    """
+    X = design.to_numpy(dtype=np.float64)
+    lib_sizes = _effective_lib_sizes(counts, norm_factors)
+    # Blocks of genes are fitted in the DE worker pool
+    res = map_gene_chunks(_lrt_chunk, {'counts': counts.to_numpy(dtype=np.float64),
+                                       'dispersions': np.asarray(dispersions, dtype=np.float64)},
+                          {'X': X, 'contrasts': np.array(list(contrasts.values()), dtype=np.float64),
+                           'lib_sizes': lib_sizes, 'prior_count': prior_count})
+    return {name: pd.DataFrame({'logFC': res['logFC'][:, k], 'LR': res['LR'][:, k],
+                                'PValue': stats.chi2.sf(res['LR'][:, k], df=1)}, index=counts.index)
+            for k, name in enumerate(contrasts)}
+
+def glm_lrt(counts, design, norm_factors, dispersions, coef_name, prior_count=0.125):
+    """
+    Likelihood ratio tests of the coefficient coef_name, see glm_lrt_contrasts.
+
+    Returns:
+    - pd.DataFrame: logFC, LR and PValue per gene.
+    """
+    coef = (design.columns == coef_name).astype(np.float64)
+    return glm_lrt_contrasts(counts, design, norm_factors, dispersions, {coef_name: coef}, prior_count)[coef_name]
+
+def _finish_results(res, ave_log_cpm):
+    # logCPM, FDR and topTags order of one comparison
+    res.insert(1, 'logCPM', ave_log_cpm)
+    res['FDR'] = p_adjust_bh(res['PValue'])
+    res = res.sort_values('PValue', kind='stable')
+    return res, pd.DataFrame({'logCPM': res['logCPM'], 'logFC': res['logFC']})
+
+def run_edger(counts, meta, design, reference, rowsum=None, test='glm', contrasts=None):
+    """
+    Python counterpart of run_DE in run_edgeR.R.
+
+    Genes need a CPM above 1 in at least two samples, the last variable of the design is
+    tested with its reference level and tagwise dispersions are used. test='exact' runs the
+    classic exact test instead of the GLM likelihood ratio test, for designs with a single
+    variable. With contrasts, every (numerator, denominator) pair of levels of the last
+    variable is tested, the GLMs are fitted once and the exact test uses the samples of the
+    two levels, and the tables are returned in long format.
+
+    Parameters:
+    - counts (pd.DataFrame): Raw counts, genes x samples.
+    - meta (pd.DataFrame): Sample information, indexed by sample.
+    - design (str): Design formula, e.g. '~ batch + condition'.
+    - reference (str): Reference level of the last design variable.
+    - rowsum: Not used, as in run_edgeR.R.
+    - test (str): 'glm' or 'exact'.
+    - contrasts (list, optional): (numerator, denominator) level pairs.
+
+    Returns:
+    - tuple: (results with logFC, logCPM, LR (GLM only), PValue and FDR sorted by PValue like
+      topTags, MA table with logCPM and logFC, dispersion estimates per gene). With
+      contrasts, both tables start with a contrast column.
+    """
+    meta = meta.loc[counts.columns]
+    cpm = counts / counts.sum() * 1e6
+    counts = counts[(cpm > 1).sum(axis=1) >= 2]
+    if counts.empty:
+        raise ValueError('No genes pass the filtering criteria. Adjust the filter or check data quality.')
+
+    X = model_matrix(meta, design, reference or None)
+    norm_factors = calc_norm_factors(counts)
+    lib_sizes = counts.sum().to_numpy(dtype=np.float64) * norm_factors.to_numpy()
+    dispersions = weighted_likelihood_eb(counts, X, lib_sizes)
+    tagwise = dispersions['tagwise.dispersion']
+    variables = design_variables(design)
+    levels = factor_levels(meta[variables[-1]], reference or None)
+    if test == 'exact':
+        groups = meta[variables[-1]].astype(str)
+        if len(variables) > 1 or len(levels) < 2 or (contrasts is None and len(levels) != 2):
+            raise ValueError(f'The exact test needs a design with one two-level variable, got {design}. Use the GLM test.')
+        pairs = contrasts if contrasts is not None else [(levels[1], levels[0])]
+        tables = {}
+        for num, den in pairs:
+            # Only the samples of the two levels, like exactTest with pair
+            keep = groups.isin([num, den]).to_numpy()
+            tables[contrast_label(num, den)] = exact_test(counts.loc[:, keep], groups[keep], norm_factors[keep],
+                                                          tagwise, pair=[den, num])
+    elif contrasts is not None:
+        weights = {contrast_label(num, den): contrast_vector(X.columns, variables[-1], num, den, levels[0])
+                   for num, den in contrasts}
+        tables = glm_lrt_contrasts(counts, X, norm_factors, tagwise, weights)
+    else:
+        tables = {X.columns[-1]: glm_lrt(counts, X, norm_factors, tagwise, X.columns[-1])}
 
-    group1 = counts.columns[groups == group_labels[0]]
-    group2 = counts.columns[groups == group_labels[1]]
-
-    results = []
-    for gene in counts.index:
-        y1 = counts.loc[gene, group1]
-        y2 = counts.loc[gene, group2]
-        n1 = len(y1)
-        n2 = len(y2)
-        dispersion = dispersions[gene]
-        size_factors1 = norm_factors[group1]
-        size_factors2 = norm_factors[group2]
-        lib_sizes1 = counts[group1].sum() * size_factors1
-        lib_sizes2 = counts[group2].sum() * size_factors2
-        # Compute the exact test statistic (for simplicity, we'll use a normal approximation)
-        mu1 = y1.mean()
-        mu2 = y2.mean()
-        var1 = mu1 + mu1 ** 2 * dispersion
-        var2 = mu2 + mu2 ** 2 * dispersion
-        se = np.sqrt(var1 / n1 + var2 / n2)
-        if se == 0:
-            p_value = 1.0
-            log_fc = 0.0
-        else:
-            z = (mu1 - mu2) / se
-            p_value = 2 * (1 - stats.norm.cdf(abs(z)))
-            log_fc = np.log2((mu2 + 1e-8) / (mu1 + 1e-8))
-        results.append({
-            'gene': gene,
-            'logFC': log_fc,
-            'p_value': p_value
-        })
-    results_df = pd.DataFrame(results).set_index('gene')
-    return results_df
-
-def glm_lrt(counts, design, norm_factors, dispersions, coef_name):
-    """
-    Fit a negative binomial GLM and perform likelihood ratio tests.
-    """
-    results = []
-    for gene in counts.index:
-        counts_gene = counts.loc[gene]
-        # Offset by log(norm_factors)
-        offset = np.log(norm_factors)
-        # Create dataframe for modeling
-        data = design.copy()
-        data['counts'] = counts_gene
-        data['offset'] = offset
-        # Fit full model
-        nb_family = sm.families.NegativeBinomial(alpha=dispersions[gene])
-        formula_full = 'counts ~ ' + ' + '.join(design.columns[1:])  # Adjust as needed
-        model_full = glm(formula_full, data=data, family=nb_family, offset=data['offset']).fit()
-        # Fit reduced model (without the coefficient of interest)
-        reduced_terms = [term for term in design.columns[1:] if term != coef_name]
-        formula_reduced = 'counts ~ ' + ' + '.join(reduced_terms) if reduced_terms else 'counts ~ 1'
-        model_reduced = glm(formula_reduced, data=data, family=nb_family, offset=data['offset']).fit()
-        # Likelihood ratio test
-        lr_stat = 2 * (model_full.llf - model_reduced.llf)
-        p_value = stats.chi2.sf(lr_stat, df=1)
-        log_fc = model_full.params.get(coef_name, np.nan) / np.log(2)
-        results.append({
-            'gene': gene,
-            'logFC': log_fc,
-            'p_value': p_value
-        })
-    results_df = pd.DataFrame(results).set_index('gene')
-    return results_df
+    tables = {name: _finish_results(res, dispersions['AveLogCPM']) for name, res in tables.items()}
+    if contrasts is None:
+        res, ma_table = next(iter(tables.values()))
+        return res, ma_table, dispersions
+    res = pd.concat([res.assign(contrast=name) for name, (res, _) in tables.items()])
+    ma_table = pd.concat([ma.assign(contrast=name) for name, (_, ma) in tables.items()])
+    return res[['contrast'] + list(res.columns[:-1])], ma_table[['contrast'] + list(ma_table.columns[:-1])], dispersions
@@ -0,0 +1,137 @@
+# interchange.py
+
+#Readers and writers for the matrices exchanged with the R scripts. The format is
+#picked from the file extension, the R side (functions/interchange.R) does the same:
+#   .feather  Arrow/Feather, needs pyarrow here and the arrow package in R
+#   .rbin     Raw little-endian binary, needs nothing but numpy and base R
+#   other     Tab-separated text, as written by to_csv(sep='\t') / write.table
+#
+#.rbin layout: b'RNALYSB1', int32 n_rows, n_cols, type (0 = int32, 1 = float64),
+#int32 byte length + '\n'-joined UTF-8 row names, the same for column names,
+#then the values in column-major order.
+
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+from functions.safe_io import atomic_path
+
+# 'rbin', 'feather' or 'tab'
+INTERCHANGE = os.environ.get('RNALYS_INTERCHANGE', 'rbin')
+
+RBIN_MAGIC = b'RNALYSB1'
+ROW_COLUMN = '_row'
+EXTENSIONS = {'rbin': '.rbin', 'feather': '.feather', 'tab': '.tab'}
+
+
+def _feather_available():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def interchange_format(fmt=None):
+    """
+    Return the interchange format to use, falling back to rbin when feather is not available.
+    """
+    fmt = fmt or INTERCHANGE
+    if fmt not in EXTENSIONS:
+        raise ValueError(f'Unknown interchange format {fmt}, use one of {list(EXTENSIONS)}')
+    if fmt == 'feather' and not _feather_available():
+        logging.warning('pyarrow is not installed, using rbin instead of feather')
+        return 'rbin'
+    return fmt
+
+
+def matrix_path(prefix, fmt=None):
+    """
+    Return prefix plus the file extension of the interchange format, e.g. 'data/generated/abc_counts.rbin'.
+    """
+    return prefix + EXTENSIONS[interchange_format(fmt)]
+
+
+def contrast_path(path, index):
+    """
+    Return the file of contrast number index (from 0) of a DE run next to path, e.g.
+    'data/generated/abc_DE_c1.rbin' (contrast_path in interchange.R).
+    """
+    root, extension = os.path.splitext(path)
+    return f'{root}_c{index}{extension}'
+
+
+def _write_names(f, names):
+    data = '\n'.join(str(x) for x in names).encode('utf-8')
+    f.write(np.array([len(data)], dtype='<i4').tobytes())
+    f.write(data)
+
+
+def _read_names(f):
+    n_bytes = int(np.frombuffer(f.read(4), dtype='<i4')[0])
+    if n_bytes == 0:
+        return []
+    return f.read(n_bytes).decode('utf-8').split('\n')
+
+
+def write_rbin(df, path):
+    values = df.to_numpy()
+    if values.dtype.kind in 'iub' and (values.size == 0 or values.max() <= np.iinfo(np.int32).max):
+        type_code, dtype = 0, '<i4'
+    else:
+        type_code, dtype = 1, '<f8'
+
+    with open(path, 'wb') as f:
+        f.write(RBIN_MAGIC)
+        f.write(np.array([df.shape[0], df.shape[1], type_code], dtype='<i4').tobytes())
+        _write_names(f, df.index)
+        _write_names(f, df.columns)
+        f.write(np.asfortranarray(values, dtype=dtype).tobytes(order='F'))
+
+
+def read_rbin(path):
+    with open(path, 'rb') as f:
+        if f.read(len(RBIN_MAGIC)) != RBIN_MAGIC:
+            raise ValueError(f'{path} is not an rbin file')
+        n_rows, n_cols, type_code = np.frombuffer(f.read(12), dtype='<i4')
+        index = _read_names(f)
+        columns = _read_names(f)
+        dtype = '<i4' if type_code == 0 else '<f8'
+        values = np.fromfile(f, dtype=dtype, count=int(n_rows) * int(n_cols))
+
+    values = values.reshape((int(n_rows), int(n_cols)), order='F')
+    return pd.DataFrame(values, index=index or None, columns=columns or None)
+
+
+def write_matrix(df, path):
+    """
+    Write a numeric table (genes x samples) in the format given by the file extension.
+    The file is written under a temporary name and renamed, readers never see a partial file.
+    """
+    with atomic_path(path) as tmp_path:
+        if path.endswith('.feather'):
+            out = df.copy()
+            out.columns = [str(c) for c in out.columns]
+            out.insert(0, ROW_COLUMN, [str(x) for x in df.index])
+            out.reset_index(drop=True).to_feather(tmp_path)
+        elif path.endswith('.rbin'):
+            write_rbin(df, tmp_path)
+        else:
+            df.to_csv(tmp_path, sep='\t')
+
+
+def read_matrix(path):
+    """
+    Read a table written by write_matrix or by the R side, detecting the format.
+
+    Returns:
+    - pd.DataFrame: Table with the first column (row names) as index.
+    """
+    if path.endswith('.feather'):
+        df = pd.read_feather(path)
+        return df.set_index(ROW_COLUMN).rename_axis(None)
+    if path.endswith('.rbin'):
+        return read_rbin(path)
+    return pd.read_csv(path, sep='\t', index_col=0)
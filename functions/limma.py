@@ -0,0 +1,226 @@
+# limma.py
+
+#limma-voom recreated in python, the Python engine for program='limma'. voom turns the
+#counts into log-CPM values with precision weights from the mean-variance trend, the
+#linear models of all genes are fitted together and eBayes moderates the gene-wise
+#variances towards a common prior. Without weights one QR decomposition of the design is
+#shared by all genes; with the voom weights every gene has its own weighted design, which
+#is decomposed for blocks of genes at once. No B-statistic in the results.
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.special import digamma, polygamma
+
+from functions.design import contrast_label, contrast_vector, design_variables, factor_levels, model_matrix
+from functions.edgeR import calc_norm_factors
+from functions.nb_glm import p_adjust_bh
+
+# Largest genes x samples x coefficients block of the weighted fits
+MAX_BLOCK_CELLS = 2 ** 22
+
+
+def _lowess(x, y, span=0.5, iterations=3, n_points=200):
+    # Robust local linear regression with tricube weights on the nearest span of the points
+    # (R's lowess), evaluated on a grid; returns (grid, fitted values)
+    points = np.linspace(x.min(), x.max(), n_points)
+    dx = x[None, :] - points[:, None]
+    bandwidth = np.maximum(np.quantile(np.abs(dx), span, axis=1), 1e-8)
+    tricube = np.clip(1 - (np.abs(dx) / bandwidth[:, None]) ** 3, 0, None) ** 3
+    robustness = np.ones_like(y)
+    for _ in range(iterations + 1):
+        k = tricube * robustness
+        s0, s1, s2 = k.sum(axis=1), (k * dx).sum(axis=1), (k * dx ** 2).sum(axis=1)
+        t0, t1 = k @ y, (k * dx) @ y
+        slope = (s0 * t1 - s1 * t0) / np.maximum(s0 * s2 - s1 ** 2, 1e-12)
+        fitted = (t0 - slope * s1) / np.maximum(s0, 1e-12)
+        residuals = y - np.interp(x, points, fitted)
+        scale = np.median(np.abs(residuals))
+        if scale == 0:
+            break
+        robustness = np.clip(1 - (residuals / (6 * scale)) ** 2, 0, None) ** 2
+    return points, fitted
+
+
+def lm_fit(E, X, weights=None):
+    """
+    Least squares fits of the linear models of all genes (limma's lmFit).
+
+    Parameters:
+    - E (np.ndarray): Expression values, genes x samples.
+    - X (np.ndarray): Design matrix, samples x coefficients.
+    - weights (np.ndarray, optional): Precision weights, genes x samples.
+
+    Returns:
+    - dict: coefficients (genes x p), r_inverse (p x p, or genes x p x p with weights) with
+      (X'WX)^-1 = r_inverse r_inverse', sigma and df_residual.
+    """
+    n, p = X.shape
+    if weights is None:
+        q, r = np.linalg.qr(X)
+        coefficients = np.linalg.solve(r, q.T @ E.T).T
+        residuals = E - coefficients @ X.T
+        r_inverse = np.linalg.inv(r)
+    else:
+        coefficients, residuals = np.empty((len(E), p)), np.empty_like(E)
+        r_inverse = np.empty((len(E), p, p))
+        block = max(1, MAX_BLOCK_CELLS // (n * p))
+        for start in range(0, len(E), block):
+            rows = slice(start, start + block)
+            sw = np.sqrt(weights[rows])
+            q, r = np.linalg.qr(sw[:, :, None] * X)
+            effects = np.einsum('gnp,gn->gp', q, sw * E[rows])
+            coefficients[rows] = np.linalg.solve(r, effects[..., None])[..., 0]
+            residuals[rows] = sw * (E[rows] - coefficients[rows] @ X.T)
+            r_inverse[rows] = np.linalg.inv(r)
+    df_residual = n - p
+    return {'coefficients': coefficients, 'r_inverse': r_inverse,
+            'sigma': np.sqrt((residuals ** 2).sum(axis=1) / df_residual), 'df_residual': df_residual}
+
+
+def voom(counts, X, lib_sizes, span=0.5):
+    """
+    log2-CPM values and precision weights from the mean-variance trend (limma's voom).
+
+    Parameters:
+    - counts (pd.DataFrame): Counts, genes x samples.
+    - X (np.ndarray): Design matrix, samples x coefficients.
+    - lib_sizes (np.ndarray): Effective library size of every sample.
+    - span (float): Fraction of the genes in the lowess trend.
+
+    Returns:
+    - tuple: (log2-CPM, weights, both genes x samples, and a DataFrame with the mean sx,
+      the square root residual standard deviation sy and the trend per gene)
+    """
+    y = counts.to_numpy(dtype=np.float64)
+    log_lib = np.log2(np.asarray(lib_sizes, dtype=np.float64) + 1)
+    E = np.log2(y + 0.5) - log_lib + np.log2(1e6)
+    fit = lm_fit(E, X)
+    sx = E.mean(axis=1) + log_lib.mean() - np.log2(1e6)
+    sy = np.sqrt(fit['sigma'])
+    # Genes with only zeros do not enter the trend
+    expressed = y.sum(axis=1) > 0
+    points, trend = _lowess(sx[expressed], sy[expressed], span)
+    fitted_log_count = fit['coefficients'] @ X.T + log_lib - np.log2(1e6)
+    weights = 1 / np.interp(fitted_log_count, points, trend) ** 4
+    mean_variance = pd.DataFrame({'sx': sx, 'sy': sy, 'trend': np.interp(sx, points, trend)}, index=counts.index)
+    return E, weights, mean_variance
+
+
+def _trigamma_inverse(x):
+    # Newton iteration of limma's trigammaInverse
+    if x > 1e7:
+        return 1 / np.sqrt(x)
+    if x < 1e-6:
+        return 1 / x
+    y = 0.5 + 1 / x
+    for _ in range(50):
+        tri = polygamma(1, y)
+        step = tri * (1 - tri / x) / polygamma(2, y)
+        y += step
+        if -step / y < 1e-8:
+            break
+    return y
+
+
+def squeeze_var(var, df):
+    """
+    Posterior variances shrunk towards a scaled inverse chi-square prior fitted to all genes
+    by moments of the log variances (limma's squeezeVar and fitFDist).
+
+    Returns:
+    - tuple: (posterior variances, prior degrees of freedom, prior variance)
+    """
+    x = np.maximum(var, 0)
+    median = np.median(x)
+    x = np.maximum(x, 1e-5 * (median if median > 0 else 1))
+    e = np.log(x) - digamma(df / 2) + np.log(df / 2)
+    e_mean = e.mean()
+    e_var = e.var(ddof=1) - polygamma(1, df / 2)
+    if e_var > 0:
+        df_prior = 2 * _trigamma_inverse(e_var)
+        var_prior = np.exp(e_mean + digamma(df_prior / 2) - np.log(df_prior / 2))
+        return (df * var + df_prior * var_prior) / (df + df_prior), df_prior, var_prior
+    var_prior = np.exp(e_mean)
+    return np.full_like(var, var_prior), np.inf, var_prior
+
+
+def ebayes(fit, contrasts):
+    """
+    Moderated t-tests of contrasts of the coefficients (limma's contrasts.fit and eBayes).
+
+    Parameters:
+    - fit (dict): Result of lm_fit.
+    - contrasts (dict): Name -> coefficient weights.
+
+    Returns:
+    - dict: Name -> DataFrame columns logFC, t and P.Value as arrays.
+    """
+    df = fit['df_residual']
+    var_post, df_prior, _ = squeeze_var(fit['sigma'] ** 2, df)
+    # Capped at the pooled residual degrees of freedom, like eBayes
+    df_total = min(df + df_prior, df * len(var_post))
+    tests = {}
+    for name, contrast in contrasts.items():
+        stdev_unscaled = np.linalg.norm(contrast @ fit['r_inverse'], axis=-1)
+        log_fc = fit['coefficients'] @ contrast
+        t = log_fc / (stdev_unscaled * np.sqrt(var_post))
+        tests[name] = {'logFC': log_fc, 't': t, 'P.Value': 2 * stats.t.sf(np.abs(t), df_total)}
+    return tests
+
+
+def run_limma(counts, meta, design, reference, rowsum=None, contrasts=None):
+    """
+    limma-voom differential expression, the Python engine for program='limma'.
+
+    Genes need a CPM above 1 in at least two samples, as for edgeR, and the libraries are TMM
+    normalized before voom. The last variable of the design is tested with its reference
+    level. With contrasts, every (numerator, denominator) pair of levels of the last variable
+    is tested from the same fit and the tables are returned in long format.
+
+    Parameters:
+    - counts (pd.DataFrame): Raw counts, genes x samples.
+    - meta (pd.DataFrame): Sample information, indexed by sample.
+    - design (str): Design formula, e.g. '~ batch + condition'.
+    - reference (str): Reference level of the last design variable.
+    - rowsum: Not used.
+    - contrasts (list, optional): (numerator, denominator) level pairs.
+
+    Returns:
+    - tuple: (results with logFC, AveExpr, t, P.Value and adj.P.Val sorted by P.Value like
+      topTable, MA table with AveExpr and logFC, voom mean-variance trend per gene). With
+      contrasts, both tables start with a contrast column.
+    """
+    meta = meta.loc[counts.columns]
+    cpm = counts / counts.sum() * 1e6
+    counts = counts[(cpm > 1).sum(axis=1) >= 2]
+    if counts.empty:
+        raise ValueError('No genes pass the filtering criteria. Adjust the filter or check data quality.')
+
+    X = model_matrix(meta, design, reference or None)
+    lib_sizes = counts.sum().to_numpy(dtype=np.float64) * calc_norm_factors(counts).to_numpy()
+    E, weights, mean_variance = voom(counts, X.to_numpy(dtype=np.float64), lib_sizes)
+    fit = lm_fit(E, X.to_numpy(dtype=np.float64), weights)
+
+    if contrasts is None:
+        weights_by_name = {X.columns[-1]: (X.columns == X.columns[-1]).astype(np.float64)}
+    else:
+        variable = design_variables(design)[-1]
+        ref_level = factor_levels(meta[variable], reference or None)[0]
+        weights_by_name = {contrast_label(num, den): contrast_vector(X.columns, variable, num, den, ref_level)
+                           for num, den in contrasts}
+
+    tables = {}
+    for name, test in ebayes(fit, weights_by_name).items():
+        res = pd.DataFrame({'logFC': test['logFC'], 'AveExpr': E.mean(axis=1), 't': test['t'],
+                            'P.Value': test['P.Value']}, index=counts.index)
+        res['adj.P.Val'] = p_adjust_bh(res['P.Value'])
+        res = res.sort_values('P.Value', kind='stable')
+        tables[name] = res, pd.DataFrame({'AveExpr': res['AveExpr'], 'logFC': res['logFC']})
+
+    if contrasts is None:
+        res, ma_table = next(iter(tables.values()))
+        return res, ma_table, mean_variance
+    res = pd.concat([res.assign(contrast=name) for name, (res, _) in tables.items()])
+    ma_table = pd.concat([ma.assign(contrast=name) for name, (_, ma) in tables.items()])
+    return res[['contrast'] + list(res.columns[:-1])], ma_table[['contrast'] + list(ma_table.columns[:-1])], mean_variance
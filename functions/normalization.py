@@ -0,0 +1,272 @@
+# normalization.py
+
+#In-process normalizations working on the whole count matrix with NumPy, used instead
+#of the data_transformation.R round trip for the transformations listed in
+#NATIVE_TRANSFORMATIONS.
+
+import numpy as np
+import pandas as pd
+
+
+def size_factors(counts):
+    """
+    Calculate size factors with the median-of-ratios method (DESeq2's estimateSizeFactors).
+
+    Genes with a zero in any sample are left out of the reference, as in DESeq2.
+
+    Parameters:
+    - counts (pd.DataFrame or np.ndarray): Raw counts, genes x samples.
+
+    Returns:
+    - np.ndarray: One size factor per sample.
+    """
+    with np.errstate(divide='ignore'):
+        log_counts = np.log(np.asarray(counts, dtype=np.float64))
+    log_geo_means = log_counts.mean(axis=1)
+    use = np.isfinite(log_geo_means)
+    if not use.any():
+        raise ValueError('Every gene contains at least one zero, size factors can not be estimated')
+    return np.exp(np.median(log_counts[use] - log_geo_means[use, None], axis=0))
+
+
+def normalize_counts(counts, sf=None):
+    """
+    Divide the counts of each sample by its size factor.
+    """
+    values = np.asarray(counts, dtype=np.float64)
+    sf = size_factors(values) if sf is None else sf
+    return values / sf
+
+
+def log2_cpm(counts, prior_count=2):
+    """
+    Log2 counts per million with a library-size scaled prior count (edgeR's cpm(log=TRUE)).
+    """
+    values = np.asarray(counts, dtype=np.float64)
+    lib_sizes = values.sum(axis=0)
+    prior = prior_count * lib_sizes / lib_sizes.mean()
+    return np.log2((values + prior) / (lib_sizes + 2 * prior) * 1e6)
+
+
+def moments_dispersion(norm_counts, sf):
+    """
+    Rough per-gene dispersion from the mean and variance of the normalized counts.
+
+    Returns:
+    - tuple: (means, dispersions), dispersions are NaN for all-zero genes.
+    """
+    means = norm_counts.mean(axis=1)
+    variances = norm_counts.var(axis=1, ddof=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dispersions = (variances - means * np.mean(1 / sf)) / means ** 2
+    dispersions[means <= 0] = np.nan
+    return means, dispersions
+
+
+def fit_parametric_trend(means, dispersions, min_disp=1e-8, max_iter=10):
+    """
+    Fit the trend dispersion = asymptDisp + extraPois / mean with a Gamma-family GLM
+    (identity link), dropping outlying genes between iterations like DESeq2's
+    parametricDispersionFit.
+
+    Returns:
+    - tuple: (asymptDisp, extraPois)
+    """
+    use = np.isfinite(dispersions) & (dispersions > 100 * min_disp) & (means > 0)
+    means, dispersions = means[use], dispersions[use]
+    if len(means) < 3:
+        raise ValueError('Too few genes with positive dispersion to fit a dispersion trend')
+
+    X = np.column_stack([np.ones_like(means), 1 / means])
+    coefs = np.array([0.1, 1.0])
+    keep = np.ones(len(means), dtype=bool)
+    for _ in range(max_iter):
+        fitted = X[keep] @ coefs
+        # Gamma variance is proportional to mu^2, so the IRLS weights are 1 / fitted^2
+        for _ in range(25):
+            w = 1 / np.maximum(fitted, min_disp) ** 2
+            new_coefs = np.linalg.solve(X[keep].T @ (X[keep] * w[:, None]), X[keep].T @ (w * dispersions[keep]))
+            converged = np.allclose(new_coefs, coefs, rtol=1e-6)
+            coefs = new_coefs
+            fitted = X[keep] @ coefs
+            if converged:
+                break
+        if np.any(coefs <= 0):
+            raise ValueError('Parametric dispersion fit failed, coefficients are not positive')
+
+        ratio = dispersions / (X @ coefs)
+        new_keep = (ratio > 1e-4) & (ratio < 15)
+        if np.array_equal(new_keep, keep):
+            break
+        keep = new_keep
+    return coefs[0], coefs[1]
+
+
+def vst(counts, sf=None, trend=None):
+    """
+    Variance stabilizing transformation for a parametric dispersion trend
+    (the closed form used by DESeq2's varianceStabilizingTransformation, fitType='parametric').
+
+    Parameters:
+    - counts (pd.DataFrame or np.ndarray): Raw counts, genes x samples.
+    - sf (np.ndarray, optional): Size factors, estimated if not given.
+    - trend (tuple, optional): (asymptDisp, extraPois), fitted if not given.
+
+    Returns:
+    - np.ndarray: Transformed values on the log2 scale.
+    """
+    values = np.asarray(counts, dtype=np.float64)
+    sf = size_factors(values) if sf is None else sf
+    q = values / sf
+    if trend is None:
+        trend = fit_parametric_trend(*moments_dispersion(q, sf))
+    asympt_disp, extra_pois = trend
+    return np.log((1 + extra_pois + 2 * asympt_disp * q
+                   + 2 * np.sqrt(asympt_disp * q * (1 + extra_pois + asympt_disp * q)))
+                  / (4 * asympt_disp)) / np.log(2)
+
+
+def _sorted_columns(values):
+    # Sort every column once, the order is reused to put the normalized values back
+    order = np.argsort(values, axis=0, kind='stable')
+    return order, np.take_along_axis(values, order, axis=0)
+
+
+def _tie_positions(sorted_values):
+    # Average 0-based rank of every sorted position, ties share the mean of their positions
+    n = sorted_values.shape[0]
+    positions = np.arange(n)[:, None]
+    changes = sorted_values[1:] != sorted_values[:-1]
+    first = np.vstack([np.ones((1, sorted_values.shape[1]), dtype=bool), changes])
+    last = np.vstack([changes, np.ones((1, sorted_values.shape[1]), dtype=bool)])
+    start = np.maximum.accumulate(np.where(first, positions, 0), axis=0)
+    end = np.minimum.accumulate(np.where(last, positions, n - 1)[::-1], axis=0)[::-1]
+    return (start + end) / 2
+
+
+def _smooth_weights(sorted_values, reference, group_means, window=0.05):
+    # qsmooth weights: 1 - between-group / total sum of squares per quantile, running median smoothed
+    sst = ((sorted_values - reference[:, None]) ** 2).sum(axis=1)
+    ssb = ((group_means - reference[:, None]) ** 2).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.where(sst < 1e-6, 1, 1 - ssb / sst)
+    k = max(int(window * len(weights)) // 2 * 2 + 1, 1)
+    return pd.Series(weights).rolling(k, center=True, min_periods=1).median().to_numpy()
+
+
+def smooth_quantile_normalize(counts, groups=None, window=0.05):
+    """
+    Smooth quantile normalization (qsmooth, Hicks et al. 2018). Every quantile is pulled to a
+    weighted mix of the overall reference and the mean of its group, the weight follows how
+    much the groups differ at that quantile. Without groups this is plain quantile normalization.
+
+    Tied values get the reference interpolated at their average rank, as in qsmooth. The
+    running median at the ends uses shrinking windows instead of R's runmed end rule.
+
+    Parameters:
+    - counts (pd.DataFrame or np.ndarray): Counts, genes x samples.
+    - groups (array-like, optional): Group label of every sample.
+    - window (float): Running median window as a fraction of the number of genes.
+
+    Returns:
+    - np.ndarray: Normalized values.
+    """
+    values = np.asarray(counts, dtype=np.float64)
+    order, sorted_values = _sorted_columns(values)
+    reference = sorted_values.mean(axis=1)
+
+    if groups is None or len(pd.unique(np.asarray(groups))) < 2:
+        targets = np.repeat(reference[:, None], values.shape[1], axis=1)
+    else:
+        codes, uniques = pd.factorize(np.asarray(groups))
+        group_means = np.empty_like(sorted_values)
+        for code in range(len(uniques)):
+            group_means[:, codes == code] = sorted_values[:, codes == code].mean(axis=1, keepdims=True)
+        weights = _smooth_weights(sorted_values, reference, group_means, window)[:, None]
+        targets = weights * reference[:, None] + (1 - weights) * group_means
+
+    ranks = _tie_positions(sorted_values)
+    low = np.floor(ranks).astype(int)
+    high = np.ceil(ranks).astype(int)
+    fraction = ranks - low
+    columns = np.arange(values.shape[1])
+    normalized_sorted = (1 - fraction) * targets[low, columns] + fraction * targets[high, columns]
+
+    normalized = np.empty_like(values)
+    np.put_along_axis(normalized, order, normalized_sorted, axis=0)
+    return normalized
+
+
+def quantile_log2(counts):
+    """
+    Log2 of quantile normalized counts plus one.
+    """
+    return np.log2(smooth_quantile_normalize(counts) + 1)
+
+
+def qsmooth_log2(counts, groups=None):
+    """
+    Log2 of smooth quantile normalized counts plus one, the former quantilenorm_log2 from qsmooth in R.
+    """
+    return np.log2(smooth_quantile_normalize(counts, groups) + 1)
+
+
+NATIVE_TRANSFORMATIONS = {
+    'normalize': normalize_counts,
+    'log2cpm': log2_cpm,
+    'vst_native': vst,
+    'quantile_log2': quantile_log2,
+    'quantilenorm_log2': qsmooth_log2,
+}
+
+# Transformations that take the sample groups as second argument
+GROUPED_TRANSFORMATIONS = {'quantilenorm_log2'}
+
+
+def transform(counts, transformation, groups=None):
+    """
+    Apply one of the NATIVE_TRANSFORMATIONS to a count matrix.
+
+    Parameters:
+    - counts (pd.DataFrame): Raw counts, genes x samples.
+    - transformation (str): Key in NATIVE_TRANSFORMATIONS.
+    - groups (array-like, optional): Group label of every sample, for GROUPED_TRANSFORMATIONS.
+
+    Returns:
+    - pd.DataFrame: Transformed matrix with the index and columns of counts.
+    """
+    if transformation in GROUPED_TRANSFORMATIONS:
+        values = NATIVE_TRANSFORMATIONS[transformation](counts, groups)
+    else:
+        values = NATIVE_TRANSFORMATIONS[transformation](counts)
+    return pd.DataFrame(values, index=counts.index, columns=counts.columns)
+
+
+def transform_all(counts, rlog_fit=None, groups=None):
+    """
+    Compute every native transformation in one pass. The size factors and the dispersion
+    trend are estimated once and shared by normalize, vst_native and rlog_native.
+
+    Parameters:
+    - counts (pd.DataFrame): Raw counts, genes x samples.
+    - rlog_fit (dict, optional): Result of functions.rlog.fit_rlog, fitted if not given.
+    - groups (array-like, optional): Group label of every sample, used by quantilenorm_log2.
+
+    Returns:
+    - dict: Transformation name -> pd.DataFrame.
+    """
+    # Imported here, functions.rlog builds on this module
+    from functions.rlog import fit_rlog, rlog
+
+    fit = rlog_fit or fit_rlog(counts)
+    sf = np.asarray(fit['size_factors'])
+    trend = (fit['asympt_disp'], fit['extra_pois'])
+    values = {
+        'normalize': normalize_counts(counts, sf),
+        'log2cpm': log2_cpm(counts),
+        'vst_native': vst(counts, sf, trend),
+        'rlog_native': rlog(counts, fit),
+    }
+    values['quantile_log2'] = quantile_log2(counts)
+    values['quantilenorm_log2'] = values['quantile_log2'] if groups is None else qsmooth_log2(counts, groups)
+    return {name: pd.DataFrame(v, index=counts.index, columns=counts.columns) for name, v in values.items()}
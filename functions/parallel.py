@@ -0,0 +1,175 @@
+# parallel.py
+
+#Runs gene-wise computations of the Python DE engines (GLM fits, likelihood ratio tests,
+#dispersion likelihoods) on blocks of genes in a pool of worker processes. The gene
+#matrices are copied once into shared memory and every worker maps its block from there,
+#so the count matrix is never pickled; only the small per-chunk results travel back. The
+#chunks are merged in gene order, so the result does not depend on which worker finished
+#first. The pool is started on first use and kept, like the R worker pool. A pool whose
+#worker died (crash, OOM kill) is replaced once, then the blocks run in the calling process.
+#Spawned workers import the main script again, start the app with run.py so that is not app.py.
+
+import os
+import math
+import atexit
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Worker processes for the Python DE engines, 0 or 1 runs everything in the calling process.
+# A small cap by default, every gunicorn worker starts its own pool
+DE_WORKERS = int(os.environ.get('RNALYS_DE_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Smallest block of genes sent to a worker, smaller inputs are not split
+MIN_CHUNK_GENES = int(os.environ.get('RNALYS_DE_CHUNK_GENES', '1000'))
+# Blocks per worker, more blocks even out workers that get slow genes
+CHUNKS_PER_WORKER = 4
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+
+def _get_executor(workers):
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            # spawn is available everywhere and does not fork the threads of the Dash server
+            _executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+            _executor_workers = workers
+            logging.info('Started %d DE worker processes', workers)
+        return _executor
+
+
+def _discard_executor(executor):
+    # A broken pool fails every later call, the next _get_executor starts a new one
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown():
+    """
+    Stop the worker processes.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+atexit.register(shutdown)
+
+
+def chunk_bounds(n_genes, workers, min_chunk=MIN_CHUNK_GENES):
+    """
+    Split range(n_genes) into contiguous blocks of about equal size.
+
+    Returns:
+    - list: (start, stop) of every block, in gene order.
+    """
+    n_chunks = max(1, min(workers * CHUNKS_PER_WORKER, n_genes // max(min_chunk, 1)))
+    size = math.ceil(n_genes / n_chunks)
+    return [(start, min(start + size, n_genes)) for start in range(0, n_genes, size)]
+
+
+def _detach(result):
+    # Copies arrays that still point into shared memory, the segments are closed afterwards
+    if isinstance(result, np.ndarray):
+        return result.copy() if result.base is not None else result
+    if isinstance(result, dict):
+        return {key: _detach(value) for key, value in result.items()}
+    if isinstance(result, tuple):
+        return tuple(_detach(value) for value in result)
+    return result
+
+
+def _run_chunk(func, descriptors, start, stop, shared):
+    # Worker side: map the gene matrices, run func on rows start:stop
+    segments, arrays = [], {}
+    try:
+        for name, (segment_name, shape, dtype) in descriptors.items():
+            segment = shared_memory.SharedMemory(name=segment_name)
+            segments.append(segment)
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=segment.buf)[start:stop]
+        result = _detach(func(**arrays, **shared))
+    finally:
+        arrays.clear()
+        for segment in segments:
+            segment.close()
+    return result
+
+
+def _merge(results):
+    # Concatenate chunk results along the gene axis, keeping their structure
+    first = results[0]
+    if isinstance(first, dict):
+        return {key: _merge([result[key] for result in results]) for key in first}
+    if isinstance(first, tuple):
+        return tuple(_merge([result[i] for result in results]) for i in range(len(first)))
+    if isinstance(first, np.ndarray) and first.ndim > 0:
+        return np.concatenate(results, axis=0)
+    raise TypeError(f'Can not merge chunk results of type {type(first).__name__}')
+
+
+def map_gene_chunks(func, gene_arrays, shared=None, workers=None, min_chunk=MIN_CHUNK_GENES):
+    """
+    Run func on blocks of genes in the worker pool and merge the results in gene order.
+
+    func must be a module-level function. It is called as func(**blocks, **shared), where
+    blocks holds rows start:stop of every array in gene_arrays, and returns an array with
+    genes on axis 0 or a dict or tuple of such arrays.
+
+    Parameters:
+    - func (callable): Gene-wise computation.
+    - gene_arrays (dict): Arrays with genes on axis 0, shared with the workers through shared memory.
+    - shared (dict, optional): Small arguments passed to every block as they are (design matrix, grids).
+    - workers (int, optional): Number of processes, DE_WORKERS if not given.
+    - min_chunk (int): Smallest number of genes in a block.
+
+    Returns:
+    - The merged result, the same as func on all genes.
+    """
+    shared = shared or {}
+    workers = DE_WORKERS if workers is None else workers
+    n_genes = len(next(iter(gene_arrays.values())))
+    # Fewer genes than one block are faster in the calling process than through the pool
+    if workers <= 1 or n_genes < min_chunk:
+        return func(**gene_arrays, **shared)
+    bounds = chunk_bounds(n_genes, workers, min_chunk)
+    if len(bounds) == 1:
+        return func(**gene_arrays, **shared)
+
+    segments, descriptors = [], {}
+    try:
+        for name, array in gene_arrays.items():
+            array = np.ascontiguousarray(array)
+            segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            segments.append(segment)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+            descriptors[name] = (segment.name, array.shape, array.dtype.str)
+        for attempt in range(2):
+            executor = _get_executor(workers)
+            try:
+                futures = [executor.submit(_run_chunk, func, descriptors, start, stop, shared)
+                           for start, stop in bounds]
+                # In submission order, which is gene order
+                return _merge([future.result() for future in futures])
+            except BrokenProcessPool:
+                logging.warning('A DE worker process died, %s', 'restarting the pool' if attempt == 0 else
+                                'running in the calling process')
+                _discard_executor(executor)
+        return func(**gene_arrays, **shared)
+    finally:
+        for segment in segments:
+            segment.close()
+            segment.unlink()
@@ -0,0 +1,62 @@
+# precision.py
+
+#Storage dtypes for count and normalized matrices. Counts are kept in the smallest
+#unsigned integer type that holds them, normalized values in float32 unless the
+#RNALYS_PRECISION environment variable is set to float64.
+
+import os
+
+import numpy as np
+import pandas as pd
+
+PRECISION = os.environ.get('RNALYS_PRECISION', 'float32')
+
+
+def float_dtype(precision=None):
+    """
+    Return the numpy float dtype for a precision name ('float32' or 'float64').
+    """
+    precision = precision or PRECISION
+    if precision not in ('float32', 'float64'):
+        raise ValueError(f'Unknown precision {precision}, use float32 or float64')
+    return np.dtype(precision)
+
+
+def compact_counts(df):
+    """
+    Store the numeric columns of a count matrix in the smallest unsigned integer dtype.
+
+    Columns are left untouched if any value is negative, fractional or missing.
+
+    Parameters:
+    - df (pd.DataFrame): Count matrix, genes x samples.
+
+    Returns:
+    - pd.DataFrame: Count matrix with compact integer columns.
+    """
+    numeric_columns = df.select_dtypes(include=[np.number]).columns
+    if len(numeric_columns) == 0 or df.shape[0] == 0:
+        return df
+
+    values = df[numeric_columns].to_numpy()
+    if values.dtype.kind == 'f':
+        if not np.isfinite(values).all() or not (values == np.round(values)).all():
+            return df
+    if values.min() < 0:
+        return df
+
+    dtype = np.min_scalar_type(int(values.max()))
+    compact = pd.DataFrame(values.astype(dtype), index=df.index, columns=numeric_columns)
+    if len(numeric_columns) == df.shape[1]:
+        return compact
+    df = df.copy()
+    for column in numeric_columns:
+        df[column] = compact[column]
+    return df
+
+
+def to_float(df, precision=None):
+    """
+    Cast a normalized matrix to the configured float precision.
+    """
+    return df.astype(float_dtype(precision), copy=False)
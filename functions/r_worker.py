@@ -0,0 +1,169 @@
+# r_worker.py
+
+#Pool of long-lived R processes (functions/r_worker.R) with DESeq2, edgeR and limma
+#already loaded. Jobs are sent over the worker's stdin, so a normalization or DE run
+#does not pay R startup and package loading every time. Falls back to a fresh
+#Rscript process when no worker can be started.
+
+import os
+import queue
+import atexit
+import logging
+import threading
+import subprocess
+
+# Number of R workers per Python process, 0 disables the pool
+R_WORKERS = int(os.environ.get('RNALYS_R_WORKERS', '2'))
+
+WORKER_SCRIPT = os.path.join('functions', 'r_worker.R')
+ENTRY_SCRIPTS = [
+    os.path.join('functions', 'data_transformation.R'),
+    os.path.join('functions', 'run_deseq2.R'),
+    os.path.join('functions', 'run_edgeR.R'),
+]
+
+READY = 'RNALYS_READY'
+REPLY = 'RNALYS_JOB'
+
+
+class WorkerCrashed(Exception):
+    """Raised when an R worker exits or cannot be started."""
+
+
+class RWorker:
+    """
+    One R process running functions/r_worker.R.
+    """
+
+    def __init__(self):
+        self.process = None
+        self._jobs = 0
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        # stderr is merged into stdout so the pipe can never fill up unread
+        self.process = subprocess.Popen(
+            ['Rscript', WORKER_SCRIPT] + ENTRY_SCRIPTS,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            text=True, bufsize=1)
+        self._read_until(lambda line: line == READY)
+        logging.info('Started R worker pid %s', self.process.pid)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def _read_until(self, done):
+        output = []
+        for line in self.process.stdout:
+            line = line.rstrip('\n')
+            if done(line):
+                return line, output
+            output.append(line)
+        self.stop()
+        raise WorkerCrashed('\n'.join(output[-20:]))
+
+    def run(self, script_path, args):
+        """
+        Run main() of an entry script with the given arguments.
+
+        Raises:
+        - subprocess.CalledProcessError: If the R code raised an error.
+        - WorkerCrashed: If the worker died while running the job.
+        """
+        self._jobs += 1
+        job_id = str(self._jobs)
+        script = os.path.basename(script_path)
+        try:
+            self.process.stdin.write('\t'.join([job_id, script] + [str(a) for a in args]) + '\n')
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            self.stop()
+            raise WorkerCrashed(str(e))
+
+        line, output = self._read_until(lambda line: line.startswith(f'{REPLY}\t{job_id}\t'))
+        fields = line.split('\t')
+        if fields[2] != 'OK':
+            raise subprocess.CalledProcessError(1, ['Rscript', script_path] + list(args),
+                                                output='\n'.join(output), stderr=fields[3])
+        return '\n'.join(output)
+
+
+class RWorkerPool:
+    """
+    Fixed number of R workers, started lazily and restarted when they crash.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.disabled = size < 1
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(RWorker())
+
+    def run(self, script_path, args):
+        worker = self._idle.get()
+        try:
+            if not worker.alive():
+                try:
+                    worker.start()
+                except WorkerCrashed:
+                    # R or its packages are missing, no point in trying again for every job
+                    self.disabled = True
+                    raise
+            return worker.run(script_path, args)
+        finally:
+            self._idle.put(worker)
+
+    def shutdown(self):
+        while not self._idle.empty():
+            self._idle.get().stop()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = RWorkerPool(R_WORKERS)
+            atexit.register(_pool.shutdown)
+        return _pool
+
+
+def run_rscript(script_path, args):
+    """
+    Run one of the R entry scripts, in the worker pool when possible.
+
+    Parameters:
+    - script_path (str): Path to the entry script, e.g. functions/run_deseq2.R.
+    - args (list): Command line arguments for the script.
+
+    Returns:
+    - str: Output printed by the script.
+
+    Raises:
+    - subprocess.CalledProcessError: If the R code fails.
+    """
+    pool = get_pool()
+    if not pool.disabled and script_path in ENTRY_SCRIPTS:
+        try:
+            return pool.run(script_path, args)
+        except WorkerCrashed as e:
+            logging.warning('R worker failed (%s), running %s with Rscript', e, script_path)
+        except FileNotFoundError:
+            logging.warning('Rscript not found, disabling the R worker pool')
+            pool.disabled = True
+
+    cmd = ['Rscript', script_path] + [str(a) for a in args]
+    try:
+        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    except FileNotFoundError as e:
+        raise subprocess.CalledProcessError(127, cmd, stderr=str(e))
+    return result.stdout
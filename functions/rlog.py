@@ -0,0 +1,180 @@
+# rlog.py
+
+#Approximate regularized log transformation (DESeq2's rlog, blind=TRUE) in NumPy.
+#The dispersion trend and the beta prior variance are fitted once and can be cached
+#per file_string, then the ridge-penalized NB fits of all genes are solved together.
+#Gene-wise dispersions come from moments instead of Cox-Reid likelihood, so the
+#result is close to, but not identical with, DESeq2's rlog. Compare the two with
+#
+#   python -m functions.rlog report <counts> <rlog output from data_transformation.R>
+
+import os
+import sys
+import json
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+from functions.safe_io import atomic_write
+from functions.normalization import size_factors, moments_dispersion, fit_parametric_trend
+
+
+def _weighted_quantile(x, weights, prob):
+    # Hmisc::wtd.quantile(type='quantile', normwt=TRUE) as used by DESeq2
+    order = np.argsort(x)
+    x, weights = x[order], weights[order] * len(x) / weights.sum()
+    position = 1 + (weights.sum() - 1) * prob
+    low = max(np.floor(position), 1)
+    high = min(low + 1, weights.sum())
+    cumulative = np.cumsum(weights)
+    low_x, high_x = x[np.minimum(np.searchsorted(cumulative, [low, high]), len(x) - 1)]
+    return (1 - position % 1) * low_x + position % 1 * high_x
+
+
+def beta_prior_variance(norm_counts, base_mean, disp_fit, upper_quantile=0.05):
+    """
+    Variance of the prior on the sample coefficients, matched to the upper quantile of the
+    observed log fold changes from the gene means (matchWeightedUpperQuantileForVariance).
+    """
+    log_fold_changes = np.log2(norm_counts + 0.5) - np.log2(base_mean + 0.5)[:, None]
+    weights = np.repeat(1 / (1 / base_mean + disp_fit), norm_counts.shape[1])
+    sd = _weighted_quantile(np.abs(log_fold_changes.ravel(order='F')), weights, 1 - upper_quantile)
+    return (sd / NormalDist().inv_cdf(1 - upper_quantile / 2)) ** 2
+
+
+def fit_rlog(counts):
+    """
+    Fit everything rlog needs besides the per-gene coefficients.
+
+    Parameters:
+    - counts (pd.DataFrame): Raw counts, genes x samples.
+
+    Returns:
+    - dict: samples, size_factors, asympt_disp, extra_pois and beta_prior_var.
+    """
+    values = np.asarray(counts, dtype=np.float64)
+    values = values[values.sum(axis=1) > 0]
+    sf = size_factors(values)
+    q = values / sf
+    asympt_disp, extra_pois = fit_parametric_trend(*moments_dispersion(q, sf))
+    base_mean = q.mean(axis=1)
+    prior_var = beta_prior_variance(q, base_mean, asympt_disp + extra_pois / base_mean)
+    return {'samples': [str(x) for x in counts.columns],
+            'size_factors': sf.tolist(),
+            'asympt_disp': float(asympt_disp),
+            'extra_pois': float(extra_pois),
+            'beta_prior_var': float(prior_var)}
+
+
+def cached_fit(counts, path):
+    """
+    Load the rlog fit from path if it was made for the same samples, otherwise fit and save it.
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            fit = json.load(f)
+        if fit['samples'] == [str(x) for x in counts.columns]:
+            return fit
+    fit = fit_rlog(counts)
+    with atomic_write(path) as f:
+        json.dump(fit, f)
+    return fit
+
+
+def rlog(counts, fit=None, max_iter=100, tol=1e-8, min_mu=0.5):
+    """
+    Regularized log2 transformation of a count matrix.
+
+    The design is an intercept plus one coefficient per sample with a ridge penalty, so
+    X'WX + lambda is an arrowhead matrix and every gene is solved in closed form;
+    the IRLS iterations update all genes at once.
+
+    Parameters:
+    - counts (pd.DataFrame or np.ndarray): Raw counts, genes x samples.
+    - fit (dict, optional): Result of fit_rlog, fitted if not given.
+    - max_iter (int): Maximum IRLS iterations.
+    - tol (float): Relative deviance change at which a gene is converged.
+    - min_mu (float): Lower bound for the fitted means, as in DESeq2's fitBeta.
+
+    Returns:
+    - np.ndarray: rlog values, all-zero genes are 0.
+    """
+    values = np.asarray(counts, dtype=np.float64)
+    if fit is None:
+        fit = fit_rlog(pd.DataFrame(values))
+    sf = np.asarray(fit['size_factors'])
+    result = np.zeros_like(values)
+    nonzero = values.sum(axis=1) > 0
+    y = values[nonzero]
+
+    base_mean = (y / sf).mean(axis=1)
+    alpha = (fit['asympt_disp'] + fit['extra_pois'] / base_mean)[:, None]
+    # Penalties on the natural log scale, the intercept is practically unpenalized
+    lambda_0 = 1 / 1e6 / np.log(2) ** 2
+    lambda_s = 1 / fit['beta_prior_var'] / np.log(2) ** 2
+
+    intercept = np.log(base_mean + 0.1)
+    beta = np.log(y / sf + 0.1) - intercept[:, None]
+    deviance = np.full(len(y), np.inf)
+    active = np.ones(len(y), dtype=bool)
+    for _ in range(max_iter):
+        eta = intercept[active, None] + beta[active]
+        mu = np.maximum(sf * np.exp(eta), min_mu)
+        a = alpha[active]
+        w = mu / (1 + a * mu)
+        z = np.log(mu / sf) + (y[active] - mu) / mu
+
+        # Arrowhead solve: [sum(w) + lambda_0, w'; w, diag(w + lambda_s)] [b0; b] = [sum(w z); w z]
+        d = w + lambda_s
+        wz = w * z
+        b0 = ((wz.sum(axis=1) - (w * wz / d).sum(axis=1))
+              / (w.sum(axis=1) + lambda_0 - (w ** 2 / d).sum(axis=1)))
+        b = (wz - w * b0[:, None]) / d
+        intercept[active], beta[active] = b0, b
+
+        mu = np.maximum(sf * np.exp(b0[:, None] + b), min_mu)
+        ya = y[active]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_ratio = np.where(ya > 0, ya * np.log(ya / mu), 0)
+        new_deviance = 2 * (log_ratio - (ya + 1 / a) * np.log((1 + a * ya) / (1 + a * mu))).sum(axis=1)
+        converged = np.abs(new_deviance - deviance[active]) / (np.abs(new_deviance) + 0.1) < tol
+        deviance[active] = new_deviance
+        active[np.flatnonzero(active)[converged]] = False
+        if not active.any():
+            break
+
+    result[nonzero] = (intercept[:, None] + beta) / np.log(2)
+    return result
+
+
+def accuracy_report(native, reference):
+    """
+    Compare the NumPy rlog with DESeq2's rlog for the same counts.
+
+    Parameters:
+    - native (pd.DataFrame): Output of rlog.
+    - reference (pd.DataFrame): Output of DESeq2::rlog, same genes and samples.
+
+    Returns:
+    - pd.DataFrame: Per sample Pearson correlation, median and maximum absolute difference.
+    """
+    reference = reference.loc[native.index, native.columns]
+    difference = (native - reference).abs()
+    return pd.DataFrame({'correlation': native.corrwith(reference),
+                         'median_abs_diff': difference.median(),
+                         'max_abs_diff': difference.max()})
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'report':
+        sys.exit('Usage: python -m functions.rlog report <counts> <rlog reference>')
+
+    from functions.interchange import read_matrix
+
+    counts = read_matrix(sys.argv[2])
+    native = pd.DataFrame(rlog(counts), index=counts.index, columns=counts.columns)
+    report = accuracy_report(native, read_matrix(sys.argv[3]))
+    print(report.to_string())
+    print('\nOverall: correlation %.4f, median |diff| %.4f, max |diff| %.4f' % (
+        report['correlation'].min(), report['median_abs_diff'].median(), report['max_abs_diff'].max()))
@@ -0,0 +1,104 @@
+# safe_io.py
+
+#File writes that stay correct with several app processes (e.g. gunicorn workers):
+#generated files are written to a temporary file next to the target and renamed into
+#place, so readers see either the old or the new file and never a partial one, and the
+#shared CSV logs are appended to under an exclusive lock instead of being rewritten.
+
+import os
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on path + '.lock' for the duration of the block, across processes.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.lock', 'a+') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    Yield a temporary path in the directory of path, renamed to path when the block succeeds.
+
+    The temporary file keeps the extension of path, so writers that pick the format from
+    the extension (functions.interchange.write_matrix) behave the same.
+    """
+    directory, name = os.path.split(path)
+    os.makedirs(directory or '.', exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix='.' + name + '.', suffix=os.path.splitext(name)[1])
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextmanager
+def atomic_write(path, mode='w', **kwargs):
+    """
+    Open a temporary file for writing, renamed to path when the block succeeds.
+    """
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+
+
+@contextmanager
+def locked_atomic_write(path, mode='w', **kwargs):
+    """
+    atomic_write under the lock of path, for files that several workers write.
+    """
+    with file_lock(path):
+        with atomic_write(path, mode, **kwargs) as f:
+            yield f
+
+
+def create_csv(path, df):
+    """
+    Write df as a new CSV file under the lock used by append_csv_rows, unless the file
+    already exists, so rows appended concurrently are never overwritten.
+
+    Returns:
+    - bool: Whether the file was created.
+    """
+    with file_lock(path):
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            return False
+        with atomic_path(path) as tmp_path:
+            df.to_csv(tmp_path, index=False)
+        return True
+
+
+def append_csv_rows(path, df):
+    """
+    Append the rows of df to a CSV file under a lock, writing the header if the file is new.
+    """
+    with file_lock(path):
+        new_file = not os.path.isfile(path) or os.path.getsize(path) == 0
+        df.to_csv(path, mode='a', header=new_file, index=False)
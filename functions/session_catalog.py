@@ -0,0 +1,298 @@
+# session_catalog.py
+
+#Catalog of transformed datasets, replacing the data/datasets/session_file.txt scans.
+#Sessions are stored in SQLite and keyed by a hash of the count values, the sample list,
+#the transformation and the confounder, so a new upload with the same sample names
+#never picks up the output of an old one. DE results are cached in the same database,
+#keyed by every DE parameter plus a hash of the DE input. Inspect or clean the catalog with
+#
+#   python -m functions.session_catalog list|stats|invalidate <file_string|all>
+
+import os
+import sys
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+
+CATALOG_PATH = os.environ.get('RNALYS_SESSION_CATALOG', os.path.join('data', 'datasets', 'sessions.sqlite'))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    session_key TEXT PRIMARY KEY,
+    file_string TEXT NOT NULL,
+    counts_hash TEXT NOT NULL,
+    samples TEXT NOT NULL,
+    transformation TEXT NOT NULL,
+    rm_confounding TEXT NOT NULL,
+    id_name TEXT,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS sessions_counts_hash ON sessions (counts_hash);
+CREATE INDEX IF NOT EXISTS sessions_file_string ON sessions (file_string);
+CREATE TABLE IF NOT EXISTS de_results (
+    de_key TEXT PRIMARY KEY,
+    file_string TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    parameters TEXT NOT NULL,
+    result_files TEXT NOT NULL,
+    runtime REAL NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS de_results_file_string ON de_results (file_string);
+CREATE TABLE IF NOT EXISTS live_references (
+    file_string TEXT PRIMARY KEY,
+    last_seen REAL NOT NULL
+);
+'''
+
+
+def counts_hash(df):
+    """
+    Hash of the values, gene names and sample names of a count table.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    digest.update('\x1f'.join(str(c) for c in df.columns).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def session_key(content_hash, samples, transformation, rm_confounding='None'):
+    """
+    Key of one transformed dataset.
+    """
+    parts = [content_hash, '\x1f'.join(str(s) for s in samples), str(transformation), str(rm_confounding)]
+    return hashlib.blake2b('\x1e'.join(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def labels_hash(labels):
+    """
+    Hash of a list of labels, e.g. the sample groups of a grouped transformation.
+    """
+    return hashlib.blake2b('\x1f'.join(str(x) for x in labels).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def frames_hash(*frames):
+    """
+    Combined hash of several tables, e.g. the counts and the sample information used for DE.
+    """
+    return hashlib.blake2b(''.join(counts_hash(df) for df in frames).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def de_key(input_hash, parameters):
+    """
+    Key of one DE result, parameters is a dict of everything that changes the result.
+    """
+    text = input_hash + json.dumps(parameters, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class SessionCatalog:
+    """
+    SQLite table of sessions, one connection per call so it can be used from any Dash thread.
+    """
+
+    def __init__(self, path=CATALOG_PATH):
+        self.path = path
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    @contextmanager
+    def _connect(self):
+        # Commits on success, rolls back on errors and always closes the connection
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        try:
+            if not self._initialized:
+                with self._init_lock:
+                    connection.executescript(SCHEMA)
+                    self._initialized = True
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def lookup(self, key):
+        """
+        Return the file_string stored under key, or None.
+        """
+        with self._connect() as connection:
+            row = connection.execute('SELECT file_string FROM sessions WHERE session_key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE sessions SET hits = hits + 1, last_used = ? WHERE session_key = ?',
+                               (time.time(), key))
+            return row['file_string']
+
+    def register(self, key, file_string, content_hash, samples, transformation, rm_confounding='None', id_name=None):
+        """
+        Store a session, replacing an earlier one with the same key.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)',
+                (key, file_string, content_hash, ' '.join(str(s) for s in samples), transformation,
+                 str(rm_confounding), id_name, now, now))
+
+    def touch(self, file_string):
+        """
+        Mark the sessions of a file_string as used now, see functions.artifact_store for pinning.
+        """
+        with self._connect() as connection:
+            connection.execute('UPDATE sessions SET last_used = ? WHERE file_string = ?', (time.time(), file_string))
+
+    def heartbeat(self, file_strings):
+        """
+        Record that an open page still refers to the artifacts of these file_strings (runs or
+        upload sessions), so they stay pinned while the page is open.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO live_references VALUES (?, ?)',
+                                   [(file_string, now) for file_string in file_strings if file_string])
+
+    def last_used(self):
+        """
+        Return the last time every file_string was looked up, registered, had a DE run or was
+        referred to by an open page.
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                'SELECT file_string, MAX(last_used) AS last_used FROM ('
+                'SELECT file_string, last_used FROM sessions UNION ALL '
+                'SELECT file_string, last_used FROM de_results UNION ALL '
+                'SELECT file_string, last_seen FROM live_references) GROUP BY file_string').fetchall()
+        return {row['file_string']: row['last_used'] for row in rows}
+
+    def list_sessions(self):
+        """
+        Return all sessions as a DataFrame, most recently used first.
+        """
+        with self._connect() as connection:
+            return pd.read_sql_query('SELECT * FROM sessions ORDER BY last_used DESC', connection)
+
+    def invalidate(self, file_string=None, content_hash=None):
+        """
+        Remove the sessions of a file_string or of an upload, all sessions if neither is given.
+
+        Returns:
+        - int: Number of removed sessions.
+        """
+        query, params = 'DELETE FROM sessions', ()
+        if file_string is not None:
+            query, params = query + ' WHERE file_string = ?', (file_string,)
+        elif content_hash is not None:
+            query, params = query + ' WHERE counts_hash = ?', (content_hash,)
+        with self._connect() as connection:
+            removed = connection.execute(query, params).rowcount
+            # DE results of removed sessions can not be looked up anymore
+            connection.execute('DELETE FROM de_results WHERE file_string NOT IN (SELECT file_string FROM sessions)')
+            if file_string is None and content_hash is None:
+                connection.execute('DELETE FROM live_references')
+            elif file_string is not None:
+                connection.execute('DELETE FROM live_references WHERE file_string = ?', (file_string,))
+            return removed
+
+    def lookup_de(self, key):
+        """
+        Return the result files of a cached DE run, or None if it is unknown or a file is gone.
+        """
+        with self._connect() as connection:
+            row = connection.execute('SELECT result_files FROM de_results WHERE de_key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            result_files = json.loads(row['result_files'])
+            if not all(os.path.isfile(f) for f in result_files):
+                connection.execute('DELETE FROM de_results WHERE de_key = ?', (key,))
+                return None
+            connection.execute('UPDATE de_results SET hits = hits + 1, last_used = ? WHERE de_key = ?',
+                               (time.time(), key))
+            return result_files
+
+    def invalidate_de(self, key):
+        """
+        Remove a cached DE run, e.g. before it is computed again.
+        """
+        with self._connect() as connection:
+            connection.execute('DELETE FROM de_results WHERE de_key = ?', (key,))
+
+    def register_de(self, key, file_string, input_hash, parameters, result_files, runtime):
+        """
+        Store a DE run with its runtime in seconds and the total size of its result files.
+        """
+        now = time.time()
+        size = sum(os.path.getsize(f) for f in result_files if os.path.isfile(f))
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO de_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)',
+                (key, file_string, input_hash, json.dumps(parameters, sort_keys=True, default=str),
+                 json.dumps(result_files), runtime, size, now, now))
+
+    def list_de_results(self):
+        """
+        Return all cached DE runs as a DataFrame, most recently used first.
+        """
+        with self._connect() as connection:
+            return pd.read_sql_query('SELECT * FROM de_results ORDER BY last_used DESC', connection)
+
+    def stats(self):
+        """
+        Return the number of sessions, uploads and lookup hits, overall and per transformation.
+        """
+        with self._connect() as connection:
+            total = connection.execute(
+                'SELECT COUNT(*) AS sessions, COUNT(DISTINCT counts_hash) AS uploads, '
+                'COALESCE(SUM(hits), 0) AS hits FROM sessions').fetchone()
+            by_transformation = pd.read_sql_query(
+                'SELECT transformation, COUNT(*) AS sessions, SUM(hits) AS hits '
+                'FROM sessions GROUP BY transformation ORDER BY sessions DESC', connection)
+            de = connection.execute(
+                'SELECT COUNT(*) AS runs, COALESCE(SUM(hits), 0) AS hits, COALESCE(SUM(runtime), 0) AS runtime, '
+                'COALESCE(SUM(runtime * hits), 0) AS saved, COALESCE(SUM(size_bytes), 0) AS size_bytes '
+                'FROM de_results').fetchone()
+        return {'sessions': total['sessions'], 'uploads': total['uploads'], 'hits': total['hits'],
+                'by_transformation': by_transformation, 'de_runs': de['runs'], 'de_hits': de['hits'],
+                'de_runtime': de['runtime'], 'de_saved': de['saved'], 'de_size_bytes': de['size_bytes']}
+
+
+_catalog = None
+
+
+def get_catalog():
+    global _catalog
+    if _catalog is None:
+        os.makedirs(os.path.dirname(CATALOG_PATH) or '.', exist_ok=True)
+        _catalog = SessionCatalog(CATALOG_PATH)
+    return _catalog
+
+
+if __name__ == '__main__':
+    commands = ('list', 'stats', 'invalidate')
+    if len(sys.argv) < 2 or sys.argv[1] not in commands or (sys.argv[1] == 'invalidate' and len(sys.argv) != 3):
+        sys.exit('Usage: python -m functions.session_catalog list|stats|invalidate <file_string|all>')
+
+    catalog = get_catalog()
+    if sys.argv[1] == 'list':
+        print(catalog.list_sessions().to_string(index=False))
+        print()
+        print(catalog.list_de_results()[['file_string', 'parameters', 'runtime', 'size_bytes', 'hits']]
+              .to_string(index=False))
+    elif sys.argv[1] == 'stats':
+        stats = catalog.stats()
+        print('Sessions: %(sessions)s, uploads: %(uploads)s, hits: %(hits)s' % stats)
+        print(stats['by_transformation'].to_string(index=False))
+        print('DE runs: %(de_runs)s, hits: %(de_hits)s, compute time %(de_runtime).1f s, '
+              'saved by hits %(de_saved).1f s, size %(de_size_bytes)s bytes' % stats)
+    else:
+        file_string = None if sys.argv[2] == 'all' else sys.argv[2]
+        print('Removed %d sessions' % catalog.invalidate(file_string=file_string))
@@ -0,0 +1,81 @@
+# validation.py
+
+#Checks on uploaded tables that only need the sample/gene id lists and a small
+#schema summary computed once at upload, never the matrices themselves.
+
+from collections import Counter
+
+import numpy as np
+
+
+def _duplicates(values):
+    return [k for k, v in Counter(values).items() if v > 1]
+
+
+def summarize_schema(df):
+    """
+    Summarize an uploaded table for later validation.
+
+    Parameters:
+    - df (pd.DataFrame): Uploaded counts or sample information table.
+
+    Returns:
+    - dict: Shape, numeric dtype, non-numeric columns, duplicated row/column ids and
+      whether any numeric value is negative.
+    """
+    numeric = df.select_dtypes(include=[np.number])
+    return {
+        'n_rows': int(df.shape[0]),
+        'n_columns': int(df.shape[1]),
+        'dtype': str(numeric.to_numpy().dtype) if numeric.shape[1] else None,
+        'non_numeric_columns': [str(c) for c in df.columns if c not in numeric.columns],
+        'duplicate_index': [str(x) for x in _duplicates(df.index)],
+        'duplicate_columns': [str(x) for x in _duplicates(df.columns)],
+        'negative_values': bool(numeric.shape[1] and (numeric.to_numpy() < 0).any()),
+    }
+
+
+def reconcile_samples(counts_columns, info_index, counts_schema=None):
+    """
+    Compare the sample ids of the count matrix with the rows of the sample information.
+
+    Parameters:
+    - counts_columns (list): Column ids of the count matrix.
+    - info_index (list): Row ids of the sample information table.
+    - counts_schema (dict, optional): summarize_schema output for the counts.
+
+    Returns:
+    - list: Problems found, empty if the tables match.
+    """
+    problems = []
+
+    if list(counts_columns) != list(info_index):
+        list1 = set(counts_columns)
+        list2 = set(info_index)
+        diff1 = [item for item in list1 if item not in list2]
+        diff2 = [item for item in list2 if item not in list1]
+        problems.append('Columns in Count data does not match Rows in Info data \n'
+                        'Items in counts columns but not in info index: {} \n'
+                        'Items in info index but not in counts column: {}'.format(diff1, diff2))
+
+        # Ids that only differ in type, e.g. 1 in one table and '1' in the other
+        type_mismatch = sorted(set(map(str, diff1)) & set(map(str, diff2)))
+        if type_mismatch:
+            problems.append('Ids with different types in counts and info: {}'.format(type_mismatch))
+
+    duplicated_samples = _duplicates(counts_columns)
+    if duplicated_samples:
+        problems.append('Duplicated samples in count data: {}'.format(duplicated_samples))
+    duplicated_info = _duplicates(info_index)
+    if duplicated_info:
+        problems.append('Duplicated samples in info data: {}'.format(duplicated_info))
+
+    if counts_schema:
+        if counts_schema['duplicate_index']:
+            problems.append('Duplicated genes in count data: {}'.format(counts_schema['duplicate_index'][:20]))
+        if counts_schema['non_numeric_columns']:
+            problems.append('Non-numeric columns in count data: {}'.format(counts_schema['non_numeric_columns']))
+        if counts_schema['negative_values']:
+            problems.append('Count data contains negative values')
+
+    return problems
@@ -200,7 +200,11 @@ layout_page1 = html.Div(
                                html.Div([
                                    dcc.Dropdown(
                                        id='transformation',
-                                       options=[{'label': j, 'value': j} for j in ['Sizefactor normalization', 'vsd','rlog','quantilenorm_log2']],
+                                       options=[{'label': label, 'value': value} for label, value in [
+                                           ('Sizefactor normalization', 'normalize'), ('vsd', 'vsd'), ('rlog', 'rlog'),
+                                           ('quantilenorm_log2', 'quantilenorm_log2'), ('quantile_log2', 'quantile_log2'),
+                                           ('log2 CPM (fast)', 'log2cpm'), ('vst (fast)', 'vst_native'),
+                                           ('rlog (fast)', 'rlog_native')]],
                                        multi=False, 
                                        placeholder='Select transformation',
                                        value='vsd')
@@ -217,7 +221,7 @@ layout_page1 = html.Div(
                                 dcc.Dropdown(
                                     id='rm_confounding',
                                     #options=[{'label': j, 'value': j} for j in df_meta_combined.columns],
-                                    multi=False,
+                                    multi=True,
                                     value=None)
                             ], style={'display': 'inline-block', 'width': '100%', 'verticalAlign': "midd    le"})
                         ], style={'display': 'flex', 'verticalAlign': "middle", 'width': '80%'}),
@@ -226,13 +230,19 @@ layout_page1 = html.Div(
                         [
                             # LEFT SIDE
                             html.Div(
-                                    dbc.Switch(
+                                    [dbc.Switch(
                                         id="force_run",
                                         label="Force Re-run",
                                         value=False,
                                     ),
+                                    dbc.Switch(
+                                        id="precompute_all",
+                                        label="Precompute all transformations",
+                                        value=False,
+                                    )],
                                     style={
                                         'display': 'flex', 
+                                        'flex-direction': 'column', 
                                         'align-items': 'left', 
                                         'justify-content': 'left',  
                                         'margin-top': '50px', 
@@ -312,7 +322,7 @@ layout_page1 = html.Div(
                 ),
             ], style={'display':'none'}),#style={'textAlign': 'left', 'width': '30%', 'margin-top': 5}),
 
-            html.Div([
+            html.Div(id='alert_main_table_div', children=[
                 dmc.Alert(
                     "Select transformation",
                     id="alert_main_table",
@@ -590,13 +600,26 @@ layout_page1 = html.Div(
 
                             dcc.Dropdown(
                                 id='program',
-                                options=[{'label': j, 'value': j} for j in ['DESeq2', 'edgeR', 'limma']],
+                                options=[{'label': j, 'value': j} for j in ['DESeq2', 'edgeR', 'edgeR exact', 'limma']],
                                 value='DESeq2',
                                 multi=False,
                                 style={'height': '35px', 'width': '70%', 'display': 'inline-block', 'verticalAlign': "middle"}
                             )
                         ], style={'display': 'flex', 'verticalAlign': "middle", 'width': '100%', 'margin-bottom': '10px', 'margin-top':'240px'}),
 
+                        html.Div([
+                            html.P('Engine:',
+                                style={'width': '140px', 'display': 'inline-block', 'verticalAlign': "middle", 'padding': '5px'}),
+                            dcc.Dropdown(
+                                id='de_engine',
+                                options=[{'label': 'R', 'value': 'R'}, {'label': 'Python (in-process)', 'value': 'Python'}],
+                                value='R',
+                                multi=False,
+                                clearable=False,
+                                style={'height': '35px', 'width': '70%', 'display': 'inline-block', 'verticalAlign': "middle"}
+                            )
+                        ], style={'display': 'flex', 'verticalAlign': "middle", 'width': '100%', 'margin-bottom': '10px'}),
+
                         # Second section
                         html.Div([
                             html.P('Row sum >:',
@@ -625,6 +648,20 @@ layout_page1 = html.Div(
                                     style={'height': '35px','width': '70%', 'display': 'inline-block', 'verticalAlign': "middle"})
                         ], style={'display': 'flex', 'verticalAlign': "middle", 'width': '100%', 'margin-bottom': '10px'}),
 
+                        # Comparisons of the levels of the last design variable, all from one model fit
+                        html.Div([
+                            html.P('Contrasts:',
+                                style={'width': '140px', 'display': 'inline-block', 'verticalAlign': "middle", 'padding': '5px'}),
+                            dcc.Dropdown(
+                                id='contrasts',
+                                options=[],
+                                value=[],
+                                multi=True,
+                                placeholder='Last variable vs reference',
+                                style={'width': '70%', 'display': 'inline-block', 'verticalAlign': "middle"}
+                            )
+                        ], style={'display': 'flex', 'verticalAlign': "middle", 'width': '100%', 'margin-bottom': '10px'}),
+
                         # X, Y selection for plot
                         html.Div([
                             html.P('Display, X, Y',
@@ -681,7 +718,9 @@ layout_page1 = html.Div(
 
 
                     html.Div([
-                        dbc.Tabs([
+                        # One tab per contrast, selects the table behind the plots and the DE table
+                        dbc.Tabs(id='contrast_tabs', children=[]),
+                        dbc.Tabs(id='de_plot_tabs', children=[
                             dbc.Tab(label='Volcano Plot', children=[
                                 html.Div([
                                     html.Div(
@@ -718,6 +757,12 @@ layout_page1 = html.Div(
                                         dcc.Graph(id='ma_plot', style={'width': '100%', 'margin': 'auto', 'height': '600px', 'width': '800px'}),
                                                     label="MA-plot"
                                                 ),
+
+                            # Filled when the tab is opened, not in every DE run
+                            dbc.Tab([
+                                dcc.Graph(id='dispersion_plot', style={'height': '600px', 'width': '800px'}),
+                                dcc.Graph(id='mds_plot', style={'height': '600px', 'width': '800px'}),
+                            ], label='Diagnostics', tab_id='diagnostics'),
                                     
                                 ],)# style=tabs_styles)#style={'height': '20px'})
                         ])#, style={'width': '70%', 'display': 'inline-block', 'padding': '10px', 'height':'1%'})
@@ -728,6 +773,9 @@ layout_page1 = html.Div(
                     html.P(id='export_placeholder'),
                     
                     html.Div(id='temp', style={'display': 'none'}),
+                    # Keeps the artifacts of an open page pinned, see functions/artifact_store.py
+                    dcc.Interval(id='heartbeat', interval=5 * 60 * 1000),
+                    html.Div(id='heartbeat_done', style={'display': 'none'}),
                     html.Div(id='pvalue', style={'display': 'none'}),
                     html.Div(id='export_plot_clicked'),
 
@@ -0,0 +1,13 @@
+# run.py
+
+#Starts the development server. The DE worker processes of functions/parallel.py are
+#spawned and import the main script again, so the app is only imported under the main
+#guard here instead of being the main script itself.
+#   python run.py
+
+if __name__ == '__main__':
+    import pyfiglet
+    from app import app
+
+    print(pyfiglet.figlet_format("\\\ Rnalys"))
+    app.run_server(debug=True, dev_tools_ui=True, dev_tools_props_check=True)
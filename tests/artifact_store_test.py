@@ -0,0 +1,94 @@
+# artifact_store_test.py
+
+import os
+import json
+import time
+import shutil
+import importlib.util
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from functions import artifact_store, data_store
+from functions.session_catalog import SessionCatalog
+
+
+class ArtifactStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.catalog = SessionCatalog(os.path.join(self.directory, 'sessions.sqlite'))
+        self.generated = os.path.join(self.directory, 'generated')
+        self.uploads = os.path.join(self.directory, 'sessions')
+        patches = [mock.patch.object(artifact_store, 'get_catalog', return_value=self.catalog),
+                   mock.patch.object(data_store, 'ARTIFACT_DIR', self.generated),
+                   mock.patch.object(data_store, 'DATA_STORE_DIR', self.uploads)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def put_old_artifact(self, file_string, age, name='de_table', df=None):
+        df = pd.DataFrame({'log2FoldChange': [1.0]}) if df is None else df
+        artifact_id = data_store.put_artifact(file_string, name, df)
+        path = os.path.join(self.generated, f'{artifact_id}.pkl')
+        os.utime(path, (time.time() - age, time.time() - age))
+        return artifact_id
+
+    def test_live_reference_is_not_evicted(self):
+        held = self.put_old_artifact('held', age=3 * 3600)
+        dropped = self.put_old_artifact('dropped', age=3 * 3600)
+        # Only the page showing 'held' is still open
+        self.catalog.heartbeat(['held'])
+
+        evicted = artifact_store.evict(self.generated, quota=0, ttl=3600, pin=2 * 3600, uploads_directory=self.uploads)
+        self.assertEqual(evicted, ['dropped'])
+        self.assertIsNotNone(data_store.get_artifact(held))
+        self.assertIsNone(data_store.get_artifact(dropped))
+
+    def test_uploads_are_evicted_with_their_session(self):
+        handles = {}
+        for session in ('open', 'closed'):
+            handles[session] = data_store.save_frame(pd.DataFrame({'a': [1, 2]}), 'counts', session)
+            folder = os.path.join(self.uploads, session)
+            for file_name in os.listdir(folder):
+                os.utime(os.path.join(folder, file_name), (time.time() - 3 * 3600,) * 2)
+        self.catalog.heartbeat(['open'])
+
+        evicted = artifact_store.evict(self.generated, quota=0, ttl=3600, pin=2 * 3600, uploads_directory=self.uploads)
+        self.assertEqual(evicted, ['closed'])
+        self.assertFalse(os.path.isdir(os.path.join(self.uploads, 'closed')))
+        self.assertIsNotNone(data_store.load_frame(handles['open']))
+        self.assertIsNone(data_store.load_frame(handles['closed']))
+
+    @unittest.skipUnless(importlib.util.find_spec('dash'), 'needs the Dash environment of requirements.txt')
+    def test_callbacks_stop_on_evicted_artifacts(self):
+        import app
+        from dash.exceptions import PreventUpdate
+
+        meta = pd.DataFrame({'condition': ['ctrl', 'trt', 'ctrl', 'trt']}, index=['s1', 's2', 's3', 's4'])
+        counts = pd.DataFrame(np.arange(40.0).reshape(10, 4), columns=meta.index)
+        indata = json.dumps({'meta': self.put_old_artifact('gone', 3 * 3600, 'meta', meta),
+                             'counts_norm': self.put_old_artifact('gone', 3 * 3600, 'counts_norm', counts)})
+        self.assertEqual(artifact_store.evict(self.generated, quota=0, ttl=3600, pin=2 * 3600,
+                                              uploads_directory=self.uploads), ['gone'])
+
+        # A cache miss stops the callbacks instead of failing on None
+        with self.assertRaises(PreventUpdate):
+            app.contrast_options('~ condition', 'ctrl', indata)
+        with self.assertRaises(PreventUpdate):
+            app.update_pca_and_barplot(indata, False, None, None, None, 'condition', 'condition', 'condition')
+
+    def test_plan_eviction_keeps_pinned_sessions(self):
+        now = time.time()
+        sessions = pd.DataFrame({'size': [10, 10, 10], 'last_used': [now - 100, now - 5000, now - 9000]},
+                                index=['new', 'old', 'expired'])
+        self.assertEqual(artifact_store.plan_eviction(sessions, quota=0, ttl=8000, pin=1000, now=now),
+                         ['expired', 'old'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# batch_correction_test.py
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from functions.batch_correction import batch_design, remove_batch_effect, split_confounders
+
+
+class BatchCorrectionTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(10)
+        samples = [f's{i}' for i in range(12)]
+        self.meta = pd.DataFrame({'batch': np.repeat(['b1', 'b2', 'b3'], 4), 'group': np.tile(['a', 'b'], 6),
+                                  'age': rng.uniform(20, 80, 12)}, index=samples)
+        self.clean = rng.normal(5, 1, (300, 12))
+        self.values = pd.DataFrame(self.clean, index=[f'g{i}' for i in range(300)], columns=samples)
+
+    def test_batch_design(self):
+        X = batch_design(self.meta, ['batch'], ['age'])
+        # Sum-to-zero coding of three batches and the centered covariate
+        np.testing.assert_array_equal(X[[0, 4, 8], :2], [[1, 0], [0, 1], [-1, -1]])
+        self.assertAlmostEqual(X[:, 2].sum(), 0)
+        self.assertEqual(split_confounders(self.meta, ['batch', 'age']), (['batch'], ['age']))
+
+    def test_removes_batch_and_covariate(self):
+        level = np.arange(300.0)[:, None]
+        shift = np.array([2.0, -1.0, 0.5])[pd.factorize(self.meta['batch'])[0]]
+        slope = 0.03 * (self.meta['age'].to_numpy() - self.meta['age'].mean())
+        values = pd.DataFrame(level + shift + slope, index=self.values.index, columns=self.values.columns)
+        corrected = remove_batch_effect(values, self.meta, batch=['batch'], covariates=['age'])
+        # Sum-to-zero coding keeps the mean of the batch levels, (2 - 1 + 0.5) / 3, as limma
+        np.testing.assert_allclose(corrected.to_numpy(), np.repeat(level + 0.5, 12, axis=1), atol=1e-10)
+
+        # With noise the batch means are equal after the correction
+        noisy = remove_batch_effect(self.values + shift, self.meta, batch=['batch'])
+        batch_means = noisy.T.groupby(self.meta['batch']).mean().T
+        np.testing.assert_allclose(batch_means.sub(batch_means.mean(axis=1), axis=0), 0, atol=1e-10)
+
+    def test_keeps_the_design(self):
+        effect = np.where(self.meta['group'] == 'b', 3.0, 0.0)
+        shift = np.where(self.meta['batch'] == 'b2', 2.0, 0.0)
+        design = np.column_stack([np.ones(12), effect > 0])
+        corrected = remove_batch_effect(self.values + effect + shift, self.meta, batch=['batch'], design=design)
+        group_difference = corrected.loc[:, effect > 0].mean(axis=1) - corrected.loc[:, effect == 0].mean(axis=1)
+        self.assertAlmostEqual(group_difference.mean(), 3, delta=0.1)
+        # Nothing to remove
+        self.assertIs(remove_batch_effect(self.values, self.meta), self.values)
+
+
+if __name__ == '__main__':
+    unittest.main()
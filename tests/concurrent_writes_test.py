@@ -0,0 +1,98 @@
+# concurrent_writes_test.py
+
+#Stress test for functions/safe_io.py: many processes append to the same CSV log and
+#rewrite the same matrix while others read it, as several gunicorn workers would.
+
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from functions.safe_io import append_csv_rows, create_csv
+from functions.interchange import write_matrix, read_matrix
+
+WRITERS = 8
+ROWS_PER_WRITER = 50
+MATRIX_SHAPE = (2000, 20)
+
+
+def _append_rows(args):
+    path, writer = args
+    for i in range(ROWS_PER_WRITER):
+        append_csv_rows(path, pd.DataFrame({'writer': [writer], 'row': [i], 'text': ['x' * 200]}))
+
+
+def _create_and_append(args):
+    path, writer = args
+    # Like load_dataset creating datasets.csv while others save datasets
+    for i in range(ROWS_PER_WRITER):
+        create_csv(path, pd.DataFrame(columns=['writer', 'row', 'text']))
+        append_csv_rows(path, pd.DataFrame({'writer': [writer], 'row': [i], 'text': ['x' * 200]}))
+
+
+def _write_matrices(args):
+    path, writer = args
+    # Every writer writes a matrix filled with its own number, a mix of two writers is a torn file
+    for _ in range(10):
+        write_matrix(pd.DataFrame(np.full(MATRIX_SHAPE, writer, dtype=np.int64)), path)
+
+
+def _read_matrices(path):
+    values = []
+    for _ in range(40):
+        if os.path.isfile(path):
+            df = read_matrix(path)
+            values.append((df.shape, np.unique(df.to_numpy()).tolist()))
+    return values
+
+
+class ConcurrentWritesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pool = multiprocessing.get_context('spawn').Pool(WRITERS)
+
+    def tearDown(self):
+        self.pool.terminate()
+        self.pool.join()
+        shutil.rmtree(self.directory)
+
+    def test_appends_keep_every_row(self):
+        path = os.path.join(self.directory, 'datasets.csv')
+        self.pool.map(_append_rows, [(path, writer) for writer in range(WRITERS)])
+
+        df = pd.read_csv(path)
+        self.assertEqual(len(df), WRITERS * ROWS_PER_WRITER)
+        self.assertEqual(list(df.columns), ['writer', 'row', 'text'])
+        for writer in range(WRITERS):
+            self.assertEqual(sorted(df.loc[df['writer'] == writer, 'row']), list(range(ROWS_PER_WRITER)))
+
+    def test_create_keeps_appended_rows(self):
+        path = os.path.join(self.directory, 'datasets.csv')
+        self.pool.map(_create_and_append, [(path, writer) for writer in range(WRITERS)])
+
+        df = pd.read_csv(path)
+        self.assertEqual(len(df), WRITERS * ROWS_PER_WRITER)
+        self.assertEqual(list(df.columns), ['writer', 'row', 'text'])
+
+    def test_matrix_writes_are_atomic(self):
+        for extension in ('.rbin', '.tab'):
+            path = os.path.join(self.directory, 'normalized' + extension)
+            readers = [self.pool.apply_async(_read_matrices, (path,)) for _ in range(2)]
+            self.pool.map(_write_matrices, [(path, writer) for writer in range(WRITERS - 2)])
+
+            for reader in readers:
+                for shape, values in reader.get(timeout=120):
+                    self.assertEqual(shape, MATRIX_SHAPE)
+                    self.assertEqual(len(values), 1)
+            self.assertEqual(read_matrix(path).shape, MATRIX_SHAPE)
+            # No temporary files are left behind
+            self.assertEqual([f for f in os.listdir(self.directory) if f.startswith('.')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
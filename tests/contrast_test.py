@@ -0,0 +1,59 @@
+# contrast_test.py
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from functions.deseq2 import run_deseq2
+from functions.design import contrast_vector, model_matrix, pairwise_contrasts, parse_contrasts
+from functions.edgeR import run_edger
+from tests.simulate import nb_counts
+
+
+class ContrastTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # g0-g99 go up in b, g100-g199 go down in c
+        cls.counts, cls.meta, _ = nb_counts(['a', 'b', 'c'] * 3, n_genes=2000, seed=4,
+                                            changes={'b': (slice(0, 100), 4), 'c': (slice(100, 200), 0.25)})
+        cls.pairs = pairwise_contrasts(['a', 'b', 'c'])
+
+    def test_parse_contrasts(self):
+        self.assertEqual(self.pairs, [('b', 'a'), ('c', 'a'), ('c', 'b')])
+        self.assertEqual(parse_contrasts(['all'], ['a', 'b', 'c']), self.pairs)
+        self.assertEqual(parse_contrasts(['c vs b', 'c vs b'], ['a', 'b', 'c']), [('c', 'b')])
+        with self.assertRaises(ValueError):
+            parse_contrasts(['d vs a'], ['a', 'b', 'c'])
+        X = model_matrix(self.meta, '~ condition', 'a')
+        np.testing.assert_array_equal(contrast_vector(X.columns, 'condition', 'c', 'b', 'a'), [0, -1, 1])
+
+    def test_deseq2_contrasts(self):
+        single, _, _ = run_deseq2(self.counts, self.meta, '~ condition', 'a', 0)
+        res, ma_table, _ = run_deseq2(self.counts, self.meta, '~ condition', 'a', 0, contrasts=self.pairs)
+        self.assertEqual(list(res.columns[:2]), ['contrast', 'baseMean'])
+        self.assertEqual(list(res['contrast'].unique()), ['b_vs_a', 'c_vs_a', 'c_vs_b'])
+        self.assertEqual(len(ma_table), len(res))
+        # The last coefficient is c vs a
+        c_vs_a = res[res['contrast'] == 'c_vs_a'].drop(columns='contrast')
+        pd.testing.assert_frame_equal(c_vs_a, single.loc[c_vs_a.index])
+        # Fold changes of one fit are consistent
+        lfc = res.pivot(columns='contrast', values='log2FoldChange')
+        np.testing.assert_allclose(lfc['c_vs_b'], lfc['c_vs_a'] - lfc['b_vs_a'], atol=1e-10)
+
+    def test_edger_contrasts(self):
+        single, _, _ = run_edger(self.counts, self.meta, '~ condition', 'a')
+        res, _, _ = run_edger(self.counts, self.meta, '~ condition', 'a', contrasts=self.pairs)
+        c_vs_a = res[res['contrast'] == 'c_vs_a'].drop(columns='contrast')
+        pd.testing.assert_frame_equal(c_vs_a, single.loc[c_vs_a.index], rtol=1e-8)
+        top = res[res['contrast'] == 'b_vs_a'].index[:100]
+        self.assertGreaterEqual(len(set(top) & {f'g{i}' for i in range(100)}), 90)
+
+        exact, _, _ = run_edger(self.counts, self.meta, '~ condition', 'a', test='exact', contrasts=self.pairs)
+        top = exact[exact['contrast'] == 'c_vs_b'].index[:200]
+        self.assertGreaterEqual(len(set(top) & {f'g{i}' for i in range(200)}), 180)
+
+
+if __name__ == '__main__':
+    unittest.main()
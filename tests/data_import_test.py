@@ -0,0 +1,71 @@
+# data_import_test.py
+
+import base64
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from functions import data_import
+from functions.data_import import read_counts_upload, read_table_upload
+
+
+def upload(text):
+    # The 'contents' property of dcc.Upload
+    return 'data:text/csv;base64,' + base64.b64encode(text.encode()).decode()
+
+
+class DataImportTest(unittest.TestCase):
+
+    def test_counts(self):
+        df = read_counts_upload(upload('gene,a,b\ng1,1,2\ng2,3,4\n'), 'counts.csv')
+        self.assertEqual(list(df.columns), ['a', 'b'])
+        self.assertEqual(df.loc['g2', 'b'], 4)
+
+    def test_r_style_header(self):
+        # write.table with row names leaves out the name of the index column
+        contents = upload('a\tb\ng1\t1\t2\ng2\t3\t4\n')
+        df = read_counts_upload(contents, 'counts.tsv')
+        with mock.patch.object(data_import, 'pa_csv', None):
+            df_pandas = read_counts_upload(contents, 'counts.tsv')
+        for result in (df, df_pandas):
+            self.assertEqual(list(result.columns), ['a', 'b'])
+            self.assertIsNone(result.index.name)
+            self.assertEqual(result.loc['g2', 'a'], 3)
+        with self.assertRaisesRegex(ValueError, 'Duplicate column names.*a'):
+            read_counts_upload(upload('a\ta\ng1\t1\t2\n'), 'counts.tsv')
+
+    def test_info_table_parsers_agree(self):
+        for text, filename in [('sample,group,note\ns1,x,\ns2,y,z\n', 'info.csv'),
+                               ('group\tnote\ns1\tx\t\ns2\ty\tz\n', 'info.tsv')]:
+            df = read_table_upload(upload(text), filename)
+            with mock.patch.object(data_import, 'pa_csv', None):
+                df_pandas = read_table_upload(upload(text), filename)
+            self.assertEqual(list(df.columns), ['group', 'note'])
+            # Empty fields are missing values in both parsers
+            self.assertTrue(pd.isna(df.loc['s1', 'note']))
+            pd.testing.assert_frame_equal(df, df_pandas)
+
+    def test_duplicate_sample_names(self):
+        contents = upload('gene,a,b,a\ng1,1,2,3\n')
+        with self.assertRaisesRegex(ValueError, 'Duplicate column names.*a'):
+            read_counts_upload(contents, 'counts.csv')
+        # Also without pyarrow
+        with mock.patch.object(data_import, 'pa_csv', None):
+            with self.assertRaisesRegex(ValueError, 'Duplicate column names'):
+                read_counts_upload(contents, 'counts.csv')
+        with self.assertRaisesRegex(ValueError, 'Duplicate column names'):
+            read_table_upload(upload('sample,group,group\ns1,x,y\n'), 'info.csv')
+
+    def test_empty_upload(self):
+        with self.assertRaisesRegex(ValueError, 'empty'):
+            read_counts_upload(upload(''), 'counts.csv')
+        with mock.patch.object(data_import, 'pa_csv', None):
+            with self.assertRaisesRegex(ValueError, 'empty'):
+                read_counts_upload(upload(''), 'counts.csv')
+        with self.assertRaisesRegex(ValueError, 'empty'):
+            read_table_upload(upload(''), 'info.csv')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# data_store_test.py
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from functions import data_store
+
+
+class DataStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        patches = [mock.patch.object(data_store, 'ARTIFACT_DIR', self.directory),
+                   mock.patch.object(data_store, 'DATA_STORE_DIR', self.directory),
+                   mock.patch.object(data_store, '_memory', data_store.OrderedDict()),
+                   mock.patch.object(data_store, '_memory_bytes', 0)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_memory_is_bounded_in_bytes(self):
+        frame = pd.DataFrame(np.zeros((1000, 10)))
+        nbytes = frame.memory_usage(index=True, deep=True).sum()
+        with mock.patch.object(data_store, 'MEMORY_BYTES', int(2.5 * nbytes)):
+            ids = [data_store.put_artifact('run', f'table{i}', frame.copy()) for i in range(4)]
+            # The two most recently used frames fit
+            self.assertEqual(list(data_store._memory), ids[2:])
+            self.assertLessEqual(data_store._memory_bytes, data_store.MEMORY_BYTES)
+            # A frame larger than the whole budget is not kept in memory
+            data_store.put_artifact('run', 'large', pd.DataFrame(np.zeros((10000, 10))))
+            self.assertNotIn('run_large', data_store._memory)
+            # Evicted from memory, still on disk
+            self.assertTrue(data_store.get_artifact(ids[0]).equals(frame))
+
+    def test_overwritten_files_are_reloaded(self):
+        artifact_id = data_store.put_artifact('run', 'meta', pd.DataFrame({'group': ['a', 'b']}))
+        # Another worker replaces the file, this process still holds the old frame in memory
+        path = os.path.join(self.directory, f'{artifact_id}.pkl')
+        pd.DataFrame({'group': ['a', 'b', 'c']}).to_pickle(path)
+        os.utime(path, ns=(os.stat(path).st_mtime_ns + 10 ** 9,) * 2)
+        self.assertEqual(list(data_store.get_artifact(artifact_id)['group']), ['a', 'b', 'c'])
+
+        handle = data_store.save_frame(pd.DataFrame({'a': [1]}), 'info', 'session')
+        os.remove(os.path.join(self.directory, 'session', f"info_{handle['dataset_id']}.pkl"))
+        self.assertIsNone(data_store.load_frame(handle))
+        self.assertNotIn(handle['dataset_id'], data_store._memory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+# diagnostics_test.py
+
+import unittest
+
+import numpy as np
+
+from functions.diagnostics import dispersion_plot_data, mds_coordinates
+from functions.edgeR import run_edger
+from tests.simulate import nb_counts
+
+
+def simulate():
+    # g0-g199 go up eightfold in trt
+    counts, meta, _ = nb_counts(['ctrl', 'trt'] * 4, changes={'trt': (slice(0, 200), 8)}, seed=7, size=20)
+    return counts, meta
+
+
+class DiagnosticsTest(unittest.TestCase):
+
+    def test_mds_separates_groups(self):
+        counts, meta = simulate()
+        mds = mds_coordinates(counts, top=100)
+        self.assertEqual(list(mds.index), list(counts.columns))
+        first = mds['dim1'].groupby(meta['condition']).agg(['min', 'max'])
+        # All treated samples on one side of the first dimension
+        self.assertTrue(first.loc['ctrl', 'max'] < first.loc['trt', 'min'] or
+                        first.loc['trt', 'max'] < first.loc['ctrl', 'min'])
+        # Distances along the first dimension are about log2(8) = 3 between the groups
+        gap = abs(mds['dim1'].groupby(meta['condition']).mean().diff().iloc[-1])
+        self.assertAlmostEqual(gap, 3, delta=0.5)
+
+    def test_dispersion_plot_data(self):
+        counts, meta = simulate()
+        _, _, dispersions = run_edger(counts, meta, '~ condition', 'ctrl')
+        data, xlabel, ylabel, log_scale = dispersion_plot_data(dispersions)
+        self.assertEqual(len(data), 3 * len(dispersions))
+        self.assertEqual(set(data['estimate']), {'Tagwise', 'Trend', 'Common'})
+        self.assertFalse(log_scale)
+        np.testing.assert_allclose(data.loc[data['estimate'] == 'Common', 'y'],
+                                   np.sqrt(dispersions['common.dispersion']))
+
+
+if __name__ == '__main__':
+    unittest.main()
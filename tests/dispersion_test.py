@@ -0,0 +1,45 @@
+# dispersion_test.py
+
+import unittest
+
+import numpy as np
+
+from functions.design import model_matrix
+from functions.dispersion import estimate_dispersions, weighted_likelihood_eb
+from functions.normalization import size_factors
+from tests.simulate import nb_counts
+
+def simulate():
+    # Dispersions follow a known trend in the mean
+    counts, meta, dispersion = nb_counts(['a', 'b'] * 4, n_genes=3000, seed=1, mean=4, sd=1.5,
+                                         dispersion=lambda base: 0.05 + 1 / base, sample_factors=(0.7, 1.4))
+    keep = (counts.sum(axis=1) > 0).to_numpy()
+    return counts[keep], meta, dispersion[keep]
+
+
+class DispersionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.counts, meta, self.true_dispersion = simulate()
+        self.X = model_matrix(meta, '~ condition')
+
+    def log_error(self, estimate):
+        return np.median(np.abs(np.log(np.asarray(estimate) / self.true_dispersion)))
+
+    def test_map_shrinks_towards_trend(self):
+        result = estimate_dispersions(self.counts, self.X, size_factors(self.counts))
+        self.assertEqual(list(result.index), list(self.counts.index))
+        # Shrinkage gives estimates closer to the truth than the gene-wise MLEs
+        self.assertLess(self.log_error(result['dispersion']), 0.5 * self.log_error(result['dispGeneEst']))
+        self.assertLess(self.log_error(result['dispFit']), 0.15)
+        self.assertTrue((result['dispersion'] >= 1e-8).all())
+
+    def test_weighted_likelihood_eb(self):
+        result = weighted_likelihood_eb(self.counts, self.X, self.counts.sum().to_numpy())
+        self.assertEqual(result['common.dispersion'].nunique(), 1)
+        self.assertLess(self.log_error(result['trended.dispersion']), 0.15)
+        self.assertLess(self.log_error(result['tagwise.dispersion']), 0.4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# edger_test.py
+
+import unittest
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from functions.edgeR import calc_norm_factors, exact_test_double_tail, run_edger
+from tests.simulate import nb_counts
+
+
+class EdgeRTest(unittest.TestCase):
+
+    def test_tmm_corrects_composition(self):
+        rng = np.random.default_rng(2)
+        expected = rng.gamma(2, 200, 5000)
+        counts = pd.DataFrame({'a': rng.poisson(expected), 'b': rng.poisson(expected)})
+        # 10% of the genes double in b, the others get a smaller share of its library
+        counts.loc[:499, 'b'] = rng.poisson(2 * expected[:500])
+        factors = calc_norm_factors(counts)
+        extra = expected[:500].sum() / expected.sum()
+        self.assertAlmostEqual(factors['b'] / factors['a'], 1 / (1 + extra), delta=0.01)
+        self.assertAlmostEqual(np.prod(factors), 1)
+
+    def test_exact_test_matches_negative_binomial_sums(self):
+        s1, s2 = np.array([3, 10, 50, 200, 0]), np.array([20, 40, 80, 150, 30])
+        dispersions = np.array([0.1, 0.2, 0.05, 0.3, 0.1])
+        pvalues = exact_test_double_tail(s1, s2, 3, 3, dispersions, dispersion_bin=1e-9)
+        for p, x1, x2, d in zip(pvalues, s1, s2, dispersions):
+            # edgeR's definition: twice the probability of the smaller tail given the total
+            s, size = x1 + x2, 3 / d
+            prob = size / (size + 3 * (x1 + x2) / 6)
+            tail = sum(stats.nbinom.pmf(i, size, prob) * stats.nbinom.pmf(s - i, size, prob) for i in range(min(x1, x2) + 1))
+            expected = min(2 * tail / stats.nbinom.pmf(s, 2 * size, 2 * size / (2 * size + s)), 1)
+            self.assertAlmostEqual(p / expected, 1, places=8)
+
+    def test_run_edger(self):
+        counts, meta, _ = nb_counts(['ctrl', 'trt'] * 4, n_genes=2000, changes={'trt': (slice(0, 100), 4)}, seed=3)
+
+        res, ma_table, dispersions = run_edger(counts, meta, '~ condition', 'ctrl')
+        self.assertEqual(list(res.columns), ['logFC', 'logCPM', 'LR', 'PValue', 'FDR'])
+        self.assertTrue(res['PValue'].is_monotonic_increasing)
+        self.assertGreaterEqual(len(set(res.index[:100]) & {f'g{i}' for i in range(100)}), 95)
+        self.assertAlmostEqual(res['logFC'].iloc[:100].median(), 2, delta=0.15)
+        self.assertAlmostEqual(dispersions['common.dispersion'].iloc[0], 0.1, delta=0.03)
+
+        exact, _, _ = run_edger(counts, meta, '~ condition', 'ctrl', test='exact')
+        self.assertEqual(list(exact.columns), ['logFC', 'logCPM', 'PValue', 'FDR'])
+        self.assertGreaterEqual(len(set(exact.index[:100]) & {f'g{i}' for i in range(100)}), 95)
+        self.assertAlmostEqual(exact['logFC'].iloc[:100].median(), 2, delta=0.15)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# limma_test.py
+
+import unittest
+
+import numpy as np
+
+from functions.limma import lm_fit, run_limma, squeeze_var
+from tests.simulate import nb_counts
+
+
+class LimmaTest(unittest.TestCase):
+
+    def test_weighted_fit_matches_least_squares(self):
+        rng = np.random.default_rng(5)
+        X = np.column_stack([np.ones(8), [0, 1] * 4, rng.normal(size=8)])
+        E, weights = rng.normal(size=(20, 8)), rng.uniform(0.2, 3, (20, 8))
+        fit = lm_fit(E, X, weights)
+        for g in range(20):
+            sw = np.sqrt(weights[g])
+            beta, residuals = np.linalg.lstsq(sw[:, None] * X, sw * E[g], rcond=None)[:2]
+            np.testing.assert_allclose(fit['coefficients'][g], beta)
+            np.testing.assert_allclose(fit['r_inverse'][g] @ fit['r_inverse'][g].T,
+                                       np.linalg.inv(X.T @ (weights[g][:, None] * X)))
+            self.assertAlmostEqual(fit['sigma'][g] ** 2, residuals[0] / 5)
+
+    def test_squeeze_var_recovers_prior(self):
+        rng = np.random.default_rng(6)
+        # Scaled inverse chi-square true variances with 8 prior degrees of freedom around 0.5
+        true_var = 0.5 * 8 / rng.chisquare(8, 20000)
+        var = true_var * rng.chisquare(4, 20000) / 4
+        var_post, df_prior, var_prior = squeeze_var(var, 4)
+        self.assertAlmostEqual(df_prior, 8, delta=1)
+        self.assertAlmostEqual(var_prior, 0.5, delta=0.03)
+        self.assertLess(np.mean((np.log(var_post) - np.log(true_var)) ** 2),
+                        np.mean((np.log(var) - np.log(true_var)) ** 2))
+
+    def test_run_limma(self):
+        counts, meta, _ = nb_counts(['ctrl', 'trt'] * 5, n_genes=3000, changes={'trt': (slice(0, 150), 3)}, seed=3,
+                                    sd=1.5, sample_factors=(0.5, 1.5))
+
+        res, ma_table, mean_variance = run_limma(counts, meta, '~ condition', 'ctrl')
+        self.assertEqual(list(res.columns), ['logFC', 'AveExpr', 't', 'P.Value', 'adj.P.Val'])
+        self.assertTrue(res['P.Value'].is_monotonic_increasing)
+        self.assertEqual(list(ma_table.columns), ['AveExpr', 'logFC'])
+        self.assertGreaterEqual(len(set(res.index[:150]) & {f'g{i}' for i in range(150)}), 140)
+        self.assertAlmostEqual(res['logFC'].iloc[:150].median(), np.log2(3), delta=0.2)
+        significant = res.index[res['adj.P.Val'] < 0.05]
+        self.assertLess(np.mean([int(gene[1:]) >= 150 for gene in significant]), 0.1)
+        # The square root standard deviation falls with the mean count
+        self.assertGreater(mean_variance['trend'].iloc[mean_variance['sx'].argmin()],
+                           mean_variance['trend'].iloc[mean_variance['sx'].argmax()])
+
+
+if __name__ == '__main__':
+    unittest.main()
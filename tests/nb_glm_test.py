@@ -0,0 +1,37 @@
+# nb_glm_test.py
+
+import unittest
+
+import numpy as np
+
+from functions.nb_glm import fit_nb_glm, wald_test
+
+
+class NbGlmTest(unittest.TestCase):
+
+    def test_recovers_known_coefficients(self):
+        rng = np.random.default_rng(8)
+        n_genes, dispersion = 4000, 0.1
+        X = np.column_stack([np.ones(12), np.repeat([0, 1], 6), np.tile([0, 0, 1], 4)])
+        size_factors = rng.uniform(0.5, 2, 12)
+        beta = np.column_stack([rng.uniform(np.log(20), np.log(2000), n_genes), rng.normal(0, 1, n_genes),
+                                rng.normal(0, 0.5, n_genes)])
+        mu = size_factors * np.exp(beta @ X.T)
+        counts = rng.negative_binomial(1 / dispersion, 1 / (1 + dispersion * mu))
+
+        fit = fit_nb_glm(counts, X, size_factors, np.full(n_genes, dispersion))
+        self.assertTrue(fit['converged'].all())
+        error = fit['beta'] - beta
+        # Unbiased, and the standard errors match the spread of the estimates
+        np.testing.assert_allclose(error.mean(axis=0), 0, atol=0.02)
+        coverage = (np.abs(error) < 1.96 * fit['se']).mean(axis=0)
+        np.testing.assert_allclose(coverage, 0.95, atol=0.02)
+
+        np.testing.assert_allclose(wald_test(fit['beta'][:, 1], fit['se'][:, 1])[0], fit['beta'][:, 1] / np.log(2))
+        # Under the null the p-values of the true coefficient are uniform
+        _, _, _, null_pvalues = wald_test(error[:, 1], fit['se'][:, 1])
+        self.assertAlmostEqual((null_pvalues < 0.05).mean(), 0.05, delta=0.015)
+
+
+if __name__ == '__main__':
+    unittest.main()
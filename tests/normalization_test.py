@@ -0,0 +1,76 @@
+# normalization_test.py
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from functions.normalization import (fit_parametric_trend, log2_cpm, moments_dispersion, size_factors,
+                                     smooth_quantile_normalize, transform_all, vst)
+
+
+class NormalizationTest(unittest.TestCase):
+
+    def test_size_factors(self):
+        base = np.array([10, 50, 200, 3, 80], dtype=float)
+        # Geometric mean 1 over the samples, as DESeq2
+        np.testing.assert_allclose(size_factors(base[:, None] * [1, 2, 4]), [0.5, 1, 2])
+        with self.assertRaises(ValueError):
+            size_factors(np.array([[0, 1], [2, 0]]))
+
+    def test_log2_cpm(self):
+        # Library sizes 100 and 200, prior counts 4/3 and 8/3: log2((10 + 4/3) / (100 + 8/3) * 1e6)
+        np.testing.assert_allclose(log2_cpm(np.array([[10, 20], [90, 180]])),
+                                   [[16.752245, 16.752245], [19.762814, 19.762814]], atol=1e-6)
+
+    def test_vst_known_values(self):
+        # DESeq2's closed form for asymptDisp 0.1 and extraPois 1, log2(5) at zero
+        np.testing.assert_allclose(vst(np.array([[0.0], [100.0], [1e4]]), sf=np.ones(1), trend=(0.1, 1.0)).ravel(),
+                                   [2.321928, 6.778370, 13.289154], atol=1e-6)
+
+    def test_dispersion_trend(self):
+        rng = np.random.default_rng(9)
+        mean = np.exp(rng.uniform(np.log(5), np.log(5000), 5000))
+        dispersion = 0.05 + 2 / mean
+        mu = mean[:, None] * rng.uniform(0.6, 1.6, 20)
+        counts = rng.negative_binomial(1 / dispersion[:, None], 1 / (1 + dispersion[:, None] * mu))
+        sf = size_factors(counts)
+        asympt_disp, extra_pois = fit_parametric_trend(*moments_dispersion(counts / sf, sf))
+        self.assertAlmostEqual(asympt_disp, 0.05, delta=0.005)
+        self.assertAlmostEqual(extra_pois, 2, delta=0.2)
+
+        # The shared pass gives the same matrices as the single transformations
+        df = pd.DataFrame(counts[:500], columns=[f's{i}' for i in range(20)])
+        everything = transform_all(df)
+        np.testing.assert_allclose(everything['log2cpm'], log2_cpm(df))
+        np.testing.assert_allclose(everything['quantile_log2'], np.log2(smooth_quantile_normalize(df) + 1))
+
+    def test_quantile_normalize(self):
+        values = np.array([[5, 4, 3], [2, 1, 4], [3, 4, 6], [4, 2, 8]], dtype=float)
+        # limma's normalizeQuantiles gives the mean of the sorted columns, ties average their ranks
+        expected = np.array([[5.666667, 5.166667, 2.0], [2.0, 2.0, 3.0], [3.0, 5.166667, 4.666667],
+                             [4.666667, 3.0, 5.666667]])
+        np.testing.assert_allclose(smooth_quantile_normalize(values), expected, atol=1e-6)
+
+    def test_groups_share_their_quantiles(self):
+        rng = np.random.default_rng(4)
+        groups = np.array(['a'] * 3 + ['b'] * 4)
+        values = rng.gamma(2, 50, (500, 7)) * np.where(groups == 'b', 3, 1)
+        normalized = np.sort(smooth_quantile_normalize(values, groups), axis=0)
+        for group in ('a', 'b'):
+            columns = normalized[:, groups == group]
+            np.testing.assert_allclose(columns, columns[:, [0]].repeat(columns.shape[1], axis=1))
+        # The groups differ everywhere, so the weights are close to 0 and they keep their own quantiles
+        self.assertGreater(normalized[:, groups == 'b'].mean(), 2 * normalized[:, groups == 'a'].mean())
+
+    def test_identical_groups_are_unchanged(self):
+        # Every sample of a group has the same values, so SSB equals SST and qsmooth returns the
+        # group quantiles themselves
+        rng = np.random.default_rng(5)
+        a, b = rng.permutation(500).astype(float), rng.permutation(500) * 2.0 + 1000
+        values = np.column_stack([a, rng.permutation(a), b, rng.permutation(b)])
+        np.testing.assert_allclose(smooth_quantile_normalize(values, ['a', 'a', 'b', 'b']), values)
+
+
+if __name__ == '__main__':
+    unittest.main()
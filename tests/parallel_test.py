@@ -0,0 +1,91 @@
+# parallel_test.py
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from functions import parallel
+from functions.parallel import chunk_bounds, map_gene_chunks, shutdown
+from functions.nb_glm import fit_nb_glm
+
+
+def _row_statistics(values, weights, offset):
+    return {'total': values @ weights + offset, 'extremes': (values.min(axis=1), values.max(axis=1))}
+
+
+def _crash_once(values, marker):
+    # The first block to get here kills its worker, like an OOM kill
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        return values.sum(axis=1)
+    os._exit(1)
+
+
+class ParallelTest(unittest.TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        shutdown()
+
+    def test_chunk_bounds(self):
+        bounds = chunk_bounds(10001, workers=4, min_chunk=1000)
+        self.assertEqual(bounds[0][0], 0)
+        self.assertEqual(bounds[-1][1], 10001)
+        self.assertTrue(all(stop == start for (_, stop), (start, _) in zip(bounds, bounds[1:])))
+        self.assertEqual(chunk_bounds(500, workers=4, min_chunk=1000), [(0, 500)])
+
+    @unittest.skipIf('RNALYS_DE_WORKERS' in os.environ, 'worker count set in the environment')
+    def test_default_workers_are_capped(self):
+        self.assertLessEqual(parallel.DE_WORKERS, 4)
+        self.assertGreaterEqual(parallel.DE_WORKERS, 1)
+
+    def test_small_inputs_skip_the_pool(self):
+        values = np.ones((999, 3))
+        with mock.patch.object(parallel, '_get_executor') as get_executor:
+            result = map_gene_chunks(_row_statistics, {'values': values}, {'weights': np.ones(3), 'offset': 0.0},
+                                     workers=4, min_chunk=1000)
+        get_executor.assert_not_called()
+        np.testing.assert_array_equal(result['total'], np.full(999, 3.0))
+
+    def test_broken_pool_is_replaced(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        values = np.random.default_rng(2).normal(size=(4000, 5))
+        result = map_gene_chunks(_crash_once, {'values': values}, {'marker': os.path.join(directory, 'crashed')},
+                                 workers=2, min_chunk=500)
+        np.testing.assert_allclose(result, values.sum(axis=1))
+        # The next call gets a working pool
+        chunked = map_gene_chunks(_row_statistics, {'values': values}, {'weights': np.ones(5), 'offset': 0.0},
+                                  workers=2, min_chunk=500)
+        np.testing.assert_allclose(chunked['total'], values.sum(axis=1))
+
+    def test_merge_keeps_gene_order(self):
+        values = np.random.default_rng(0).normal(size=(5000, 6))
+        weights = np.arange(6.0)
+        serial = _row_statistics(values, weights, 1.0)
+        chunked = map_gene_chunks(_row_statistics, {'values': values}, {'weights': weights, 'offset': 1.0},
+                                  workers=3, min_chunk=400)
+        np.testing.assert_array_equal(chunked['total'], serial['total'])
+        np.testing.assert_array_equal(chunked['extremes'][0], serial['extremes'][0])
+        np.testing.assert_array_equal(chunked['extremes'][1], serial['extremes'][1])
+
+    def test_glm_fit_in_chunks(self):
+        rng = np.random.default_rng(1)
+        counts = rng.poisson(rng.gamma(2, 50, (3000, 1)) * np.ones((1, 6))).astype(np.float64)
+        X = np.column_stack([np.ones(6), [0, 0, 0, 1, 1, 1]])
+        arguments = {'X': X, 'size_factors': np.ones(6)}
+        dispersions = np.full(3000, 0.1)
+        serial = fit_nb_glm(counts, dispersions=dispersions, **arguments)
+        chunked = map_gene_chunks(fit_nb_glm, {'counts': counts, 'dispersions': dispersions}, arguments,
+                                  workers=2, min_chunk=500)
+        np.testing.assert_allclose(chunked['beta'], serial['beta'], rtol=1e-10)
+        np.testing.assert_array_equal(chunked['converged'], serial['converged'])
+
+
+if __name__ == '__main__':
+    unittest.main()
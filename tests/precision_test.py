@@ -0,0 +1,41 @@
+# precision_test.py
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from functions.precision import compact_counts, float_dtype, to_float
+
+
+class PrecisionTest(unittest.TestCase):
+
+    def test_compact_counts_dtype_boundaries(self):
+        for maximum, dtype in [(255, np.uint8), (256, np.uint16), (65535, np.uint16), (65536, np.uint32),
+                               (2 ** 32, np.uint64)]:
+            df = compact_counts(pd.DataFrame({'a': [0, maximum], 'b': [1, 2]}))
+            self.assertEqual(list(df.dtypes), [dtype, dtype])
+            self.assertEqual(df['a'].iloc[1], maximum)
+        # Whole floats are counts too
+        self.assertEqual(compact_counts(pd.DataFrame({'a': [1.0, 300.0]}))['a'].dtype, np.uint16)
+
+    def test_compact_counts_leaves_other_values(self):
+        for values in ([1, -1], [1.5, 2.0], [1.0, np.nan], [1.0, np.inf]):
+            df = pd.DataFrame({'a': values})
+            self.assertIs(compact_counts(df), df)
+        # Only the numeric columns are cast, the others are kept
+        df = compact_counts(pd.DataFrame({'gene': ['x', 'y'], 'a': [1, 2]}, index=['g1', 'g2']))
+        self.assertEqual(list(df.columns), ['gene', 'a'])
+        self.assertEqual(df['a'].dtype, np.uint8)
+        self.assertEqual(list(df['gene']), ['x', 'y'])
+
+    def test_float_precision(self):
+        df = pd.DataFrame({'a': [1.5, 2.5]})
+        self.assertEqual(to_float(df, 'float32')['a'].dtype, np.float32)
+        self.assertEqual(to_float(df, 'float64')['a'].dtype, np.float64)
+        with self.assertRaises(ValueError):
+            float_dtype('float16')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# rlog_test.py
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from functions.rlog import cached_fit, fit_rlog, rlog
+
+
+def _fit(beta_prior_var, n_samples):
+    return {'samples': [f's{i}' for i in range(n_samples)], 'size_factors': [1.0] * n_samples,
+            'asympt_disp': 0.05, 'extra_pois': 1.0, 'beta_prior_var': beta_prior_var}
+
+
+class RlogTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(11)
+        mean = np.exp(rng.uniform(np.log(20), np.log(2000), (1000, 1)))
+        dispersion = 0.05 + 2 / mean
+        self.counts = rng.negative_binomial(1 / dispersion, 1 / (1 + dispersion * mean), (1000, 6)) + 10
+
+    def test_prior_limits(self):
+        # Without shrinkage every sample keeps its own log2 count
+        np.testing.assert_allclose(rlog(self.counts, _fit(1e8, 6)), np.log2(self.counts), atol=1e-3)
+        # With full shrinkage every sample gets the gene mean, the NB maximum likelihood estimate
+        np.testing.assert_allclose(rlog(self.counts, _fit(1e-10, 6)),
+                                   np.repeat(np.log2(self.counts.mean(axis=1, keepdims=True)), 6, axis=1), atol=1e-3)
+        # All-zero genes stay 0
+        counts = np.vstack([self.counts, np.zeros(6)])
+        self.assertTrue((rlog(counts, _fit(1.0, 6))[-1] == 0).all())
+
+    def test_shrinks_towards_the_mean(self):
+        values = rlog(self.counts)
+        raw = np.log2(self.counts / fit_rlog(pd.DataFrame(self.counts))['size_factors'])
+        self.assertLess(values.std(axis=1).mean(), raw.std(axis=1).mean())
+        np.testing.assert_allclose(values.mean(axis=1), raw.mean(axis=1), atol=0.3)
+
+    def test_cached_fit(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'fit.json')
+        counts = pd.DataFrame(self.counts, columns=[f's{i}' for i in range(6)])
+        fit = cached_fit(counts, path)
+        with open(path) as f:
+            self.assertEqual(json.load(f), fit)
+
+        # Reused for the same samples, refitted for others
+        with open(path, 'w') as f:
+            json.dump({**fit, 'beta_prior_var': 123.0}, f)
+        self.assertEqual(cached_fit(counts, path)['beta_prior_var'], 123.0)
+        self.assertEqual(cached_fit(counts.iloc[:, :5], path)['samples'], [f's{i}' for i in range(5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
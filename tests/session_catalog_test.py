@@ -0,0 +1,94 @@
+# session_catalog_test.py
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from functions.session_catalog import SessionCatalog, counts_hash, de_key, frames_hash, labels_hash, session_key
+
+
+class SessionCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.catalog = SessionCatalog(os.path.join(self.directory, 'sessions.sqlite'))
+        self.counts = pd.DataFrame(np.arange(12).reshape(4, 3), index=list('abcd'), columns=['s1', 's2', 's3'])
+
+    def test_counts_hash(self):
+        self.assertEqual(counts_hash(self.counts), counts_hash(self.counts.copy()))
+        changed = self.counts.copy()
+        changed.iloc[0, 0] += 1
+        renamed = self.counts.rename(columns={'s1': 'x1'})
+        self.assertEqual(len({counts_hash(self.counts), counts_hash(changed), counts_hash(renamed)}), 3)
+
+    def test_session_key_covers_every_part(self):
+        key = session_key('hash', ['s1', 's2'], 'vsd')
+        self.assertEqual(key, session_key('hash', ('s1', 's2'), 'vsd', 'None'))
+        others = [session_key('other', ['s1', 's2'], 'vsd'), session_key('hash', ['s2', 's1'], 'vsd'),
+                  session_key('hash', ['s1'], 'vsd'), session_key('hash', ['s1', 's2'], 'rlog'),
+                  session_key('hash', ['s1', 's2'], 'vsd', 'Batch'),
+                  # Joined ids can not collide with other splits of the same text
+                  session_key('hash', ['s1s2'], 'vsd')]
+        self.assertNotIn(key, others)
+        self.assertEqual(len(set(others)), len(others))
+        self.assertNotEqual(labels_hash(['a', 'b']), labels_hash(['b', 'a']))
+
+    def test_register_and_lookup(self):
+        content_hash = counts_hash(self.counts)
+        key = session_key(content_hash, ['s1', 's2'], 'vsd')
+        self.assertIsNone(self.catalog.lookup(key))
+        self.catalog.register(key, 'abc1234', content_hash, ['s1', 's2'], 'vsd')
+        self.assertEqual(self.catalog.lookup(key), 'abc1234')
+        self.assertEqual(self.catalog.lookup(key), 'abc1234')
+
+        sessions = self.catalog.list_sessions()
+        self.assertEqual(sessions.loc[0, 'samples'], 's1 s2')
+        self.assertEqual(sessions.loc[0, 'hits'], 2)
+        # A new upload of other counts removes only its own sessions
+        self.assertEqual(self.catalog.invalidate(content_hash='other'), 0)
+        self.assertEqual(self.catalog.invalidate(content_hash=content_hash), 1)
+        self.assertIsNone(self.catalog.lookup(key))
+
+    def test_de_key(self):
+        parameters = {'program': 'DESeq2', 'design': '~ condition', 'reference': 'ctrl'}
+        input_hash = frames_hash(self.counts, pd.DataFrame({'condition': ['ctrl', 'trt', 'trt']}))
+        # Independent of the parameter order, changed by any parameter or input
+        self.assertEqual(de_key(input_hash, parameters), de_key(input_hash, dict(reversed(parameters.items()))))
+        self.assertNotEqual(de_key(input_hash, parameters), de_key(input_hash, {**parameters, 'reference': 'trt'}))
+        self.assertNotEqual(de_key(input_hash, parameters), de_key(frames_hash(self.counts), parameters))
+
+    def test_lookup_de_drops_missing_files(self):
+        files = [os.path.join(self.directory, f'run_DE{i}.tab') for i in range(2)]
+        for path in files:
+            self.counts.to_csv(path, sep='\t')
+        self.catalog.register('session', 'run', 'hash', ['s1'], 'vsd')
+        self.catalog.register_de('key', 'run', 'input', {'program': 'edgeR'}, files, runtime=2.5)
+        self.assertEqual(self.catalog.lookup_de('key'), files)
+        self.assertEqual(self.catalog.list_de_results().loc[0, 'size_bytes'], sum(map(os.path.getsize, files)))
+
+        # One file evicted, the entry is dropped instead of pointing at a partial result
+        os.remove(files[1])
+        self.assertIsNone(self.catalog.lookup_de('key'))
+        self.assertEqual(len(self.catalog.list_de_results()), 0)
+        self.assertIsNone(self.catalog.lookup_de('key'))
+
+    def test_de_results_follow_their_session(self):
+        path = os.path.join(self.directory, 'run_DE.tab')
+        self.counts.to_csv(path, sep='\t')
+        self.catalog.register('session', 'run', 'hash', ['s1'], 'vsd')
+        self.catalog.register_de('key', 'run', 'input', {}, [path], runtime=1)
+        self.catalog.invalidate_de('key')
+        self.assertIsNone(self.catalog.lookup_de('key'))
+
+        self.catalog.register_de('key', 'run', 'input', {}, [path], runtime=1)
+        self.catalog.invalidate(file_string='run')
+        self.assertIsNone(self.catalog.lookup_de('key'))
+
+
+if __name__ == '__main__':
+    unittest.main()
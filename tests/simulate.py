@@ -0,0 +1,46 @@
+# simulate.py
+
+#Negative binomial counts with known fold changes and dispersions, shared by the DE tests.
+
+import numpy as np
+import pandas as pd
+
+
+def nb_counts(condition, n_genes=1000, changes=None, seed=0, mean=5, sd=1, size=10, dispersion=None,
+              sample_factors=None):
+    """
+    Simulate a count table for the samples of a condition vector.
+
+    Parameters:
+    - condition (list): Level of every sample.
+    - n_genes (int): Number of genes, named g0, g1, ...
+    - changes (dict, optional): Level -> (genes, fold change), e.g. {'trt': (slice(0, 100), 4)}.
+    - seed (int): Seed of the random generator.
+    - mean, sd (float): Mean and standard deviation of the log base expression.
+    - size (float): Negative binomial size, the dispersion of every gene is 1 / size.
+    - dispersion (callable, optional): Gene-wise dispersions from the base expression, replaces size.
+    - sample_factors (tuple, optional): Range of uniform factors multiplying the means of each sample.
+
+    Returns:
+    - tuple: (counts, meta with the condition column, gene-wise dispersions)
+    """
+    rng = np.random.default_rng(seed)
+    condition = np.asarray(condition)
+    base = np.exp(rng.normal(mean, sd, n_genes))
+    fold_change = {level: np.ones(n_genes) for level in np.unique(condition)}
+    for level, (genes, change) in (changes or {}).items():
+        fold_change[level][genes] = change
+    mu = np.column_stack([base * fold_change[level] for level in condition])
+    if sample_factors is not None:
+        mu = mu * rng.uniform(*sample_factors, len(condition))
+
+    if dispersion is None:
+        dispersions = np.full(n_genes, 1 / size)
+        values = rng.negative_binomial(size, size / (size + mu))
+    else:
+        dispersions = dispersion(base)
+        values = rng.negative_binomial(1 / dispersions[:, None], 1 / (1 + dispersions[:, None] * mu))
+
+    counts = pd.DataFrame(values, index=[f'g{i}' for i in range(n_genes)],
+                          columns=[f's{i}' for i in range(len(condition))])
+    return counts, pd.DataFrame({'condition': condition}, index=counts.columns), dispersions
@@ -2,3 +2,4 @@
 test_file("./tests/test_data_transformation.R")
 test_file("./tests/test_edgeR.R")
 test_file("./tests/test_deseq2.R")
+test_file("./tests/test_interchange.R")
@@ -0,0 +1,46 @@
+# validation_test.py
+
+import unittest
+
+import pandas as pd
+
+from functions.validation import reconcile_samples, summarize_schema
+
+
+class ValidationTest(unittest.TestCase):
+
+    def test_summarize_schema(self):
+        df = pd.DataFrame([[1, -2, 'x'], [3, 4, 'y'], [5, 6, 'z']], index=['g1', 'g2', 'g1'],
+                          columns=['s1', 's2', 'symbol'])
+        schema = summarize_schema(df)
+        self.assertEqual((schema['n_rows'], schema['n_columns']), (3, 3))
+        self.assertEqual(schema['dtype'], 'int64')
+        self.assertEqual(schema['non_numeric_columns'], ['symbol'])
+        self.assertEqual(schema['duplicate_index'], ['g1'])
+        self.assertEqual(schema['duplicate_columns'], [])
+        self.assertTrue(schema['negative_values'])
+
+    def test_matching_tables(self):
+        schema = summarize_schema(pd.DataFrame({'s1': [1, 2], 's2': [3, 4]}, index=['g1', 'g2']))
+        self.assertEqual(reconcile_samples(['s1', 's2'], ['s1', 's2'], schema), [])
+
+    def test_reconcile_samples(self):
+        problems = reconcile_samples(['s1', 1, 's3', 's3'], ['s1', '1', 's3', 's4'])
+        self.assertIn('Items in counts columns but not in info index: [1]', problems[0])
+        # Built from sets, in any order
+        only_info = problems[0].split('\n')[2]
+        self.assertTrue(only_info.startswith('Items in info index but not in counts column'))
+        self.assertIn("'1'", only_info)
+        self.assertIn("'s4'", only_info)
+        self.assertEqual(problems[1], "Ids with different types in counts and info: ['1']")
+        self.assertEqual(problems[2], "Duplicated samples in count data: ['s3']")
+
+        schema = summarize_schema(pd.DataFrame({'s1': [1, -1], 'name': ['a', 'b']}, index=['g1', 'g1']))
+        problems = reconcile_samples(['s1'], ['s1'], schema)
+        self.assertEqual(problems, ["Duplicated genes in count data: ['g1']",
+                                    "Non-numeric columns in count data: ['name']",
+                                    'Count data contains negative values'])
+
+
+if __name__ == '__main__':
+    unittest.main()